@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*- #
+"""*********************************************************************************************"""
+#   FileName     [ benchmark.py ]
+#   Synopsis     [ training throughput benchmark over modes and shapes with synthetic batches ]
+#   Author       [ Ting-Wei Liu (Andi611) ]
+#   Copyright    [ Copyleft(c), NTUEE, NTU, Taiwan ]
+"""*********************************************************************************************"""
+
+
+###############
+# IMPORTATION #
+###############
+import os
+import sys
+import csv
+import json
+import copy
+import time
+import argparse
+import resource
+import tempfile
+import itertools
+import torch
+import numpy as np
+import multiprocessing as mp
+from torch.profiler import profile, ProfilerActivity
+from hps.hps import Hps, hp
+from trainer import Trainer
+from utils import load_benchmark_results
+from model.model import Encoder, Decoder, Spectrogram_Patcher, ConvBank
+from model.tacotron_integrate.tacotron import Tacotron
+
+
+############
+# CONSTANT #
+############
+MODES = {
+	# name : (trainer mode, target_guided, loaders)
+	'pretrain_AE' : ('pretrain_AE', False, 'single'),
+	'patchGAN' : ('patchGAN', False, 'duo'),
+	'patchGAN_tgat' : ('patchGAN', True, 'duo'),
+	'autolocker' : ('autolocker', True, 'duo'),
+	't_classify' : ('t_classify', False, 'single'),
+	'train_Tacotron' : ('train_Tacotron', False, 'mel'),
+}
+ITERS = {
+	'pretrain_AE' : 'enc_pretrain_iters',
+	'patchGAN' : 'patch_iters',
+	'autolocker' : 'patch_iters',
+	't_classify' : 'tclf_iters',
+	'train_Tacotron' : 'tacotron_iters',
+}
+FIELDS = ['mode', 'batch_size', 'seg_len', 'enc_mode', 'threads', 'steps', 'samples_per_sec', 'p50_ms', 'p90_ms', 'p99_ms', 'peak_rss_mb']
+
+
+##################
+# CONFIGURATIONS #
+##################
+def get_config():
+	parser = argparse.ArgumentParser(description='training throughput benchmark arguments')
+	parser.add_argument('--hps_path', type=str, default='./hps/zerospeech_english.json', help='hyperparameters the benchmarked shapes are applied to')
+	parser.add_argument('--modes', type=str, nargs='+', default=list(MODES.keys()), choices=list(MODES.keys()), help='training modes to benchmark')
+	parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32], help='batch sizes to sweep')
+	parser.add_argument('--seg_lens', type=int, nargs='+', default=[128], help='segment lengths to sweep')
+	parser.add_argument('--enc_modes', type=str, nargs='+', default=['set_from_hps'], help='encoder modes to sweep')
+	parser.add_argument('--threads', type=int, nargs='+', default=[torch_threads()], help='intra-op thread counts to sweep')
+	parser.add_argument('--steps', type=int, default=20, help='timed training iterations per case')
+	parser.add_argument('--warmup', type=int, default=3, help='untimed training iterations before the timed ones')
+	parser.add_argument('--output', type=str, default='./result/benchmark', help='results are written to <output>.json and <output>.csv')
+	parser.add_argument('--baseline', type=str, default=None, help='a previous <output>.json to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='relative samples/sec drop against --baseline reported as a regression')
+	parser.add_argument('--copies', action='store_true', help='instead of training, count the tensor copies of one Encoder, Decoder and Spectrogram_Patcher forward')
+	parser.add_argument('--conv_banks', action='store_true', help='instead of training, time the Encoder and Tacotron convolution banks as one zero padded convolution and as one convolution per kernel size on every device, to choose main.py --fused_conv_banks')
+	args = parser.parse_args()
+	return args
+
+
+def torch_threads():
+	return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+####################
+# SYNTHETIC LOADER #
+####################
+class SyntheticLoader(object):
+	"""
+		Cycles over a few pre-generated in-memory batches with the layout of dataloader.DataLoader,
+		so that the benchmark measures the training step only.
+	"""
+	def __init__(self, batch_size, seg_len, speaker_range, n_mels=None, n_batches=4):
+		rng = np.random.RandomState(0)
+		self.batches = []
+		for _ in range(n_batches):
+			batch = [torch.from_numpy(rng.randint(speaker_range[0], speaker_range[1], size=batch_size)),
+					 torch.from_numpy(rng.rand(batch_size, seg_len, 513).astype(np.float32))]
+			if n_mels is not None:
+				batch.append(torch.from_numpy(rng.rand(batch_size, seg_len, n_mels).astype(np.float32)))
+			self.batches.append(batch)
+		self.batches = itertools.cycle(self.batches)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return next(self.batches)
+
+
+#############
+# BENCHMARK #
+#############
+def run_case(case, hps_path, steps, warmup, queue):
+	# runs in a fresh process, so that the thread count and the peak RSS belong to this case only
+	torch.set_num_threads(case['threads'])
+	mode, target_guided, loaders = MODES[case['mode']]
+
+	hps = Hps(hps_path).get_tuple()
+	enc_mode = hps.enc_mode if case['enc_mode'] == 'set_from_hps' else case['enc_mode']
+	g_mode = 'tacotron' if mode == 'train_Tacotron' else (hps.g_mode if hps.g_mode != 'tacotron' else 'targeted')
+	hps = hps._replace(batch_size=case['batch_size'], seg_len=case['seg_len'], enc_mode=enc_mode, g_mode=g_mode,
+					   valid_interval=0, log_interval=steps + warmup, **{ITERS[mode] : steps + warmup})
+	shift_c = hps.n_speakers - hps.n_target_speakers
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		if loaders == 'mel':
+			data_loader = SyntheticLoader(hps.batch_size, hps.seg_len, (shift_c, hps.n_speakers), n_mels=hp.n_mels)
+		else:
+			data_loader = SyntheticLoader(hps.batch_size, hps.seg_len, (0, hps.n_speakers))
+		trainer = Trainer(hps, data_loader, g_mode, enc_mode, log_dir=os.path.join(tmp_dir, 'log'))
+		if loaders == 'duo':
+			trainer.add_duo_loader(SyntheticLoader(hps.batch_size, hps.seg_len, (0, shift_c)),
+								   SyntheticLoader(hps.batch_size, hps.seg_len, (shift_c, hps.n_speakers)))
+
+		# every training mode calls profile_step at the start of an iteration
+		stamps = []
+		profile_step = trainer.profile_step
+		def timed_profile_step(iteration, mode):
+			stamps.append(time.perf_counter())
+			profile_step(iteration, mode)
+		trainer.profile_step = timed_profile_step
+		trainer.train(os.path.join(tmp_dir, 'model.pth'), flag='benchmark', mode=mode, target_guided=target_guided)
+		stamps.append(time.perf_counter())
+
+	latency = np.diff(stamps)[warmup:]
+	result = dict(case)
+	result.update({'enc_mode' : enc_mode,
+				   'steps' : steps,
+				   'samples_per_sec' : round(float(hps.batch_size * len(latency) / np.sum(latency)), 3),
+				   'p50_ms' : round(float(np.percentile(latency, 50) * 1000), 2),
+				   'p90_ms' : round(float(np.percentile(latency, 90) * 1000), 2),
+				   'p99_ms' : round(float(np.percentile(latency, 99) * 1000), 2),
+				   'peak_rss_mb' : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., 1)}) # kilobytes on Linux
+	queue.put(result)
+
+
+def run_benchmark(args):
+	ctx = mp.get_context('spawn')
+	results = []
+	for mode, batch_size, seg_len, enc_mode, threads in itertools.product(args.modes, args.batch_sizes, args.seg_lens, args.enc_modes, args.threads):
+		case = {'mode' : mode, 'batch_size' : batch_size, 'seg_len' : seg_len, 'enc_mode' : enc_mode, 'threads' : threads}
+		queue = ctx.Queue()
+		process = ctx.Process(target=run_case, args=(case, args.hps_path, args.steps, args.warmup, queue))
+		process.start()
+		process.join()
+		if process.exitcode != 0:
+			print('[Benchmark] - Failed: {}'.format(case))
+			continue
+		result = queue.get()
+		results.append(result)
+		print('[Benchmark] - {mode}, batch_size={batch_size}, seg_len={seg_len}, enc_mode={enc_mode}, threads={threads}: '
+			  '{samples_per_sec:.1f} samples/sec, p50={p50_ms:.1f}ms, p90={p90_ms:.1f}ms, p99={p99_ms:.1f}ms, peak RSS={peak_rss_mb:.0f}MB'.format(**result))
+	return results
+
+
+def write_results(results, output):
+	os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+	with open(output + '.json', 'w') as f:
+		json.dump(results, f, indent=4)
+	with open(output + '.csv', 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=FIELDS)
+		writer.writeheader()
+		writer.writerows(results)
+	print('[Benchmark] - Results saved to: {}.json, {}.csv'.format(output, output))
+
+
+def compare_baseline(results, baseline_path, tolerance):
+	baseline = {tuple(r[k] for k in FIELDS[:5]) : r for r in load_benchmark_results(baseline_path)}
+	regressions = 0
+	for result in results:
+		key = tuple(result[k] for k in FIELDS[:5])
+		if key not in baseline:
+			continue
+		change = result['samples_per_sec'] / baseline[key]['samples_per_sec'] - 1
+		regressed = change < -tolerance
+		regressions += int(regressed)
+		print('[Benchmark] - {} {}: {:.1f} -> {:.1f} samples/sec ({:+.1%}){}'.format('REGRESSION' if regressed else 'ok', key,
+			  baseline[key]['samples_per_sec'], result['samples_per_sec'], change, '' if not regressed else ', below -{:.0%}'.format(tolerance)))
+	print('[Benchmark] - {} regression(s) against {}'.format(regressions, baseline_path))
+	return regressions
+
+
+def count_copies(hps_path, batch_size, seg_len, steps):
+	# tensor copies (clone / contiguous / reshape of a strided tensor) and forward latency of the models that shuffle layouts
+	hps = Hps(hps_path).get_tuple()
+	models = [('Encoder', Encoder(ns=hps.ns, enc_size=hps.enc_size, seg_len=seg_len, enc_mode=hps.enc_mode), [513]),
+			  ('Decoder', Decoder(ns=hps.ns, c_in=hps.enc_size, c_h=hps.emb_size, c_a=hps.n_speakers, seg_len=seg_len), [hps.enc_size, seg_len // 8]),
+			  ('Spectrogram_Patcher', Spectrogram_Patcher(ns=hps.ns, c_in=513, c_h=hps.emb_size, c_a=hps.n_speakers, seg_len=seg_len), [513])]
+	c = torch.zeros(batch_size, dtype=torch.long)
+	for name, model, shape in models:
+		model.eval()
+		x = torch.rand(batch_size, *shape) if len(shape) == 2 else torch.rand(batch_size, seg_len, *shape).permute(0, 2, 1) # as fed by the Trainer
+		forward = (lambda: model(x)) if name == 'Encoder' else (lambda: model(x, c))
+		with torch.no_grad():
+			forward()
+			with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+				forward()
+			copies = [e for e in prof.events() if e.name == 'aten::clone']
+			megabytes = sum([np.prod(e.input_shapes[0]) * 4 for e in copies]) / 1024. ** 2
+			latency = []
+			for _ in range(steps):
+				start = time.perf_counter()
+				forward()
+				latency.append(time.perf_counter() - start)
+		print('[Benchmark] - {}, batch_size={}, seg_len={}: {} copies, {:.1f}MB copied, p50={:.1f}ms'.format(
+			  name, batch_size, seg_len, len(copies), megabytes, np.percentile(latency, 50) * 1000))
+
+
+def time_conv_banks(hps_path, batch_size, seg_len, steps):
+	# forward and forward + backward latency of both ConvBank paths, at the input shapes of one Encoder and Tacotron forward
+	hps = Hps(hps_path).get_tuple()
+	encoder = Encoder(ns=hps.ns, enc_size=hps.enc_size, seg_len=seg_len, enc_mode=hps.enc_mode)
+	tacotron = Tacotron(hps.enc_size, hps.n_target_speakers, mel_dim=hp.n_mels, linear_dim=int(hp.n_fft/2)+1)
+	banks = []
+	hooks = [m.register_forward_pre_hook(lambda m, inputs, name=name: banks.append((name, m, inputs[0].shape)))
+			 for model in [encoder, tacotron] for name, m in model.named_modules() if isinstance(m, ConvBank)]
+	with torch.no_grad():
+		enc_act, _ = encoder(torch.rand(batch_size, 513, seg_len))
+		tacotron(enc_act, torch.rand(batch_size, seg_len, hp.n_mels).transpose(1, 2), torch.zeros(batch_size, dtype=torch.long),
+				 input_lengths=torch.tensor([enc_act.size(2)] * batch_size))
+	for hook in hooks:
+		hook.remove()
+
+	def latency(bank, x, fused, backward):
+		times = []
+		for step in range(steps + 1): # the first one is untimed
+			start = time.perf_counter()
+			if backward:
+				bank(x, fused=fused).sum().backward()
+			else:
+				with torch.no_grad():
+					bank(x, fused=fused)
+			if x.is_cuda: torch.cuda.synchronize()
+			if step > 0: times.append(time.perf_counter() - start)
+		return np.percentile(times, 50) * 1000
+
+	devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+	for device in devices:
+		totals = {}
+		for name, bank, shape in banks:
+			bank = copy.deepcopy(bank).to(device)
+			x = torch.rand(*shape, device=device, requires_grad=True)
+			p50 = {(fused, backward) : latency(bank, x, fused, backward) for fused in [True, False] for backward in [False, True]}
+			for key in p50:
+				totals[key] = totals.get(key, 0) + p50[key]
+			print('[Benchmark] - {} {}, kernels 1-{}, input {}: forward fused={:.1f}ms per kernel={:.1f}ms, forward + backward fused={:.1f}ms per kernel={:.1f}ms'.format(
+				  device, name, max(bank.kernel_sizes), tuple(shape), p50[(True, False)], p50[(False, False)], p50[(True, True)], p50[(False, True)]))
+		print('[Benchmark] - {}, batch_size={}, seg_len={}: training is faster {}, inference is faster {}'.format(device, batch_size, seg_len,
+			  'fused' if totals[(True, True)] < totals[(False, True)] else 'per kernel', 'fused' if totals[(True, False)] < totals[(False, False)] else 'per kernel'))
+
+
+########
+# MAIN #
+########
+def main():
+	args = get_config()
+	if args.copies:
+		for batch_size, seg_len, threads in itertools.product(args.batch_sizes, args.seg_lens, args.threads):
+			torch.set_num_threads(threads)
+			count_copies(args.hps_path, batch_size, seg_len, args.steps)
+		return
+	if args.conv_banks:
+		for batch_size, seg_len, threads in itertools.product(args.batch_sizes, args.seg_lens, args.threads):
+			torch.set_num_threads(threads)
+			time_conv_banks(args.hps_path, batch_size, seg_len, args.steps)
+		return
+	results = run_benchmark(args)
+	write_results(results, args.output)
+	if args.baseline is not None and compare_baseline(results, args.baseline, args.tolerance) > 0:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
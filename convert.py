@@ -14,19 +14,26 @@ import os
 import glob
 import h5py
 import json
-import copy
+import time
 import torch
 import librosa
 import numpy as np
 import soundfile as sf
+import multiprocessing as mp
 import speech_recognition as sr
 from jiwer import wer
 from tqdm import tqdm
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
 from scipy import signal
-from trainer import Trainer
+from trainer import Trainer, MODE_REQUIREMENTS, CODE_ENC_MODES
+from model.model import pack_codes
+from model.vocoder import GriffinLim
+from utils import to_var
 from hps.hps import hp, Hps
-from torch.autograd import Variable
 from preprocess import get_spectrograms
+from dataloader import pack_encodings, get_valid_set
 from model.tacotron.text.symbols import symbols
 
 
@@ -34,32 +41,155 @@ from model.tacotron.text.symbols import symbols
 # CONSTANT #
 ############
 MIN_LEN = 9
+VOCODER = None # built on first use by get_vocoder()
+
+
+def get_vocoder():
+	global VOCODER
+	if VOCODER is None:
+		VOCODER = GriffinLim(hp.n_fft, hp.hop_length, hp.win_length, hp.n_iter, momentum=hp.gl_momentum, tolerance=hp.gl_tolerance)
+	return VOCODER
 
 
 def griffin_lim(spectrogram): # Applies Griffin-Lim's raw.
-	
-	def _invert_spectrogram(spectrogram): # spectrogram: [f, t]
-		return librosa.istft(spectrogram, hp.hop_length, win_length=hp.win_length, window="hann")
-
-	X_best = copy.deepcopy(spectrogram)
-	for i in range(hp.n_iter):
-		X_t = _invert_spectrogram(X_best)
-		est = librosa.stft(X_t, hp.n_fft, hp.hop_length, win_length=hp.win_length)
-		phase = est / np.maximum(1e-8, np.abs(est))
-		X_best = spectrogram * phase
-	X_t = _invert_spectrogram(X_best)
-	y = np.real(X_t)
-	return y
+	return get_vocoder()([spectrogram])[0]
 
 
 def spectrogram2wav(mag): # Generate wave file from spectrogram
-	mag = mag.T # transpose
-	mag = (np.clip(mag, 0, 1) * hp.max_db) - hp.max_db + hp.ref_db # de-noramlize
-	mag = np.power(10.0, mag * 0.05) # to amplitude
-	wav = griffin_lim(mag) # wav reconstruction
-	wav = signal.lfilter([1], [1, -hp.preemphasis], wav) # de-preemphasis
-	wav, _ = librosa.effects.trim(wav) # trim
-	return wav.astype(np.float32)
+	return spectrograms2wav([mag])[0]
+
+
+def spectrograms2wav(mags, batch_size=16): # Generate wave files from spectrograms, batch_size at a time in the vocoder
+	wavs = [None] * len(mags)
+	order = np.argsort([len(mag) for mag in mags]) # similar lengths together, less zero padding
+	for idx in range(0, len(order), batch_size):
+		batch = order[idx:idx+batch_size]
+		mags_batch = []
+		for i in batch:
+			mag = mags[i].T # transpose
+			mag = (np.clip(mag, 0, 1) * hp.max_db) - hp.max_db + hp.ref_db # de-noramlize
+			mags_batch.append(np.power(10.0, mag * 0.05)) # to amplitude
+		for i, wav in zip(batch, get_vocoder()(mags_batch)): # wav reconstruction
+			wav = signal.lfilter([1], [1, -hp.preemphasis], wav) # de-preemphasis
+			wav, _ = librosa.effects.trim(wav) # trim
+			wavs[i] = wav.astype(np.float32)
+	return wavs
+
+
+def vocode_to_files(mags, wav_paths, batch_size=16): # spectrograms2wav() and write the wav files, returns the vocoder iterations and spectral convergence
+	iterations, convergence = [], []
+	for idx in range(0, len(mags), batch_size):
+		for wav_path, wav_data in zip(wav_paths[idx:idx+batch_size], spectrograms2wav(mags[idx:idx+batch_size], batch_size)):
+			sf.write(wav_path, wav_data, hp.sr, 'PCM_16')
+		iterations += get_vocoder().iterations
+		convergence += get_vocoder().convergence
+	return wav_paths, iterations, convergence
+
+
+def _init_vocoder_worker(n_threads):
+	torch.set_num_threads(n_threads)
+
+
+def _vocode_shared(shm_name, shapes, wav_paths, batch_size):
+	shm = shared_memory.SharedMemory(name=shm_name)
+	try:
+		offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+		flat = np.ndarray((offsets[-1],), dtype=np.float32, buffer=shm.buf)
+		mags = [flat[offsets[i]:offsets[i+1]].reshape(shape) for i, shape in enumerate(shapes)] # views, read in place
+		result = vocode_to_files(mags, wav_paths, batch_size)
+		del flat, mags
+	finally:
+		shm.close()
+	return result
+
+
+class VocoderPool(object):
+	"""
+		Vocodes spectrograms and writes their wav files in n_workers processes, while the caller converts the next ones.
+		Every submit() copies its spectrograms once into a shared memory block that the worker reads in place, instead of
+		pickling them through a pipe. Results are returned in submission order by collect(), with at most max_pending
+		submissions in flight: submit() waits for the oldest one beyond that, so finished spectrograms do not pile up.
+		Use it in a with block, or call close(), so that the shared memory is freed even when a worker or the caller raises.
+		The workers start in the background, and the intra-op threads of the cpus are split over them.
+		n_workers=0 vocodes in the calling process.
+	"""
+	def __init__(self, n_workers, batch_size=16, max_pending=None):
+		self.n_workers = n_workers
+		self.batch_size = batch_size
+		self.max_pending = max_pending if max_pending is not None else 2 * max(n_workers, 1)
+		self.pending = deque() # (future, shared memory block, tag) in submission order
+		self.executor = None
+		if n_workers > 0:
+			n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+			if 'forkserver' in mp.get_all_start_methods(): # the workers are forked from a server that imported this module once (from the working directory), instead of importing it each
+				ctx = mp.get_context('forkserver')
+				ctx.set_forkserver_preload([__name__, 'librosa.effects', 'librosa.feature.spectral']) # librosa imports these lazily on the first trim
+			else:
+				ctx = mp.get_context('spawn')
+			self.executor = ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=_init_vocoder_worker, initargs=(n_threads,))
+
+	def submit(self, mags, wav_paths, tag=None):
+		# mags: list of (t_step, 513) normalized magnitudes, vocoded to wav_paths, tag is returned with the result by collect()
+		if self.executor is None:
+			future = Future()
+			future.set_result(vocode_to_files(mags, wav_paths, self.batch_size))
+			self.pending.append((future, None, tag))
+			return
+		shapes = [mag.shape for mag in mags]
+		shm = shared_memory.SharedMemory(create=True, size=max(1, 4 * sum([mag.size for mag in mags])))
+		try:
+			offset = 0
+			for mag in mags:
+				np.ndarray(mag.shape, dtype=np.float32, buffer=shm.buf, offset=offset)[:] = mag
+				offset += 4 * mag.size
+			future = self.executor.submit(_vocode_shared, shm.name, shapes, wav_paths, self.batch_size)
+		except:
+			shm.close()
+			shm.unlink()
+			raise
+		self.pending.append((future, shm, tag))
+		if len(self.pending) > self.max_pending:
+			self.pending[0][0].result()
+
+	def collect(self, wait=False):
+		# [(tag, wav_paths, iterations, convergence)] of the oldest submissions that are done, of all of them with wait=True
+		results = []
+		while len(self.pending) > 0 and (wait or self.pending[0][0].done()):
+			future, shm, tag = self.pending.popleft()
+			try:
+				results.append((tag,) + future.result())
+			finally:
+				if shm is not None:
+					shm.close()
+					shm.unlink()
+		return results
+
+	def close(self):
+		try:
+			return self.collect(wait=True)
+		finally:
+			self.terminate()
+
+	def terminate(self):
+		# drops the submissions still in flight, frees their shared memory and stops the workers
+		if self.executor is not None:
+			self.executor.shutdown(wait=True, cancel_futures=True)
+			self.executor = None
+		while len(self.pending) > 0:
+			_, shm, _ = self.pending.popleft()
+			if shm is not None:
+				shm.close()
+				shm.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# an exception of the caller or of a worker drops the rest, the shared memory is freed either way
+		if exc_type is None:
+			self.close()
+		else:
+			self.terminate()
 
 
 def synthesis(f0, sp, ap, sr=16000):
@@ -68,7 +198,7 @@ def synthesis(f0, sp, ap, sr=16000):
 
 
 def convert_x(x, c, trainer, enc_only, verbose=False):
-	c_var = Variable(torch.from_numpy(np.array([c]))).cuda()
+	c_var = to_var(torch.from_numpy(np.array([c])), requires_grad=False)
 	tensor = torch.from_numpy(np.expand_dims(x, axis=0)).type(torch.FloatTensor)
 	converted, enc = trainer.test_step(tensor, c_var, enc_only=enc_only, verbose=verbose)
 	converted = converted.squeeze(axis=0).transpose((1, 0))
@@ -76,23 +206,398 @@ def convert_x(x, c, trainer, enc_only, verbose=False):
 	return converted, enc
 
 
+def convert_targets_x(x, tar_ids, trainer, enc_only):
+	# x: (n_segments, t_step, 513) consecutive segments of one source, converted in one batch and joined back along time
+	c_var = to_var(torch.from_numpy(np.array(tar_ids)), requires_grad=False)
+	tensor = torch.from_numpy(np.asarray(x)).type(torch.FloatTensor)
+	converted, enc = trainer.test_targets_step(tensor, c_var, enc_only=enc_only)
+	converted = converted.transpose((0, 1, 3, 2)).reshape(len(tar_ids), -1, converted.shape[2]) # (n_targets, n_segments * t_step, 513)
+	enc = enc.transpose((0, 2, 1)).reshape(-1, enc.shape[1])
+	return converted, enc
+
+
 def encode_x(x, trainer):
-	tensor = torch.from_numpy(np.expand_dims(x, axis=0)).type(torch.FloatTensor)
+	# x: (n_segments, t_step, 513) consecutive segments of one source, encoded in one batch and joined back along time
+	tensor = torch.from_numpy(np.asarray(x)).type(torch.FloatTensor)
 	enc = trainer.encoder_test_step(tensor)
-	enc = enc.squeeze(axis=0).transpose((1, 0))
+	enc = enc.transpose((0, 2, 1)).reshape(-1, enc.shape[1])
 	return enc
 
 
-def get_trainer(hps_path, model_path, g_mode, enc_mode, clf_path):
+def prepare_segments(src_speaker_spec, seg_len):
+	# the batches of equal length segments an utterance is converted in, and the number of encoding steps to keep (None for all)
+
+	# pad spec to minimum len
+	n_enc = None
+	if len(src_speaker_spec) < MIN_LEN:
+		padding = np.zeros((MIN_LEN - src_speaker_spec.shape[0], src_speaker_spec.shape[1]))
+		src_speaker_spec = np.concatenate((src_speaker_spec, padding), axis=0)
+		n_enc = MIN_LEN//8 # truncate the encoding of zero paddings
+
+	if len(src_speaker_spec) <= seg_len:
+		return [src_speaker_spec[None]], n_enc
+	return split_segments(src_speaker_spec, seg_len), n_enc
+
+
+def split_segments(spec, seg_len):
+	"""
+		The fragments an utterance longer than seg_len is converted in, as batches of equal length: the seg_len fragments,
+		and the tail that runs to the second last frame and is between seg_len and 2 * seg_len - 2 frames long.
+		The tail is kept apart instead of padded, as the instance norms and GRUs would see the padding.
+	"""
+	n_full = max(0, (len(spec) - 2 * seg_len) // seg_len + 1) # fragments with idx + 2 * seg_len <= len(spec)
+	if n_full == 0 and len(spec) - 1 < seg_len:
+		raise RuntimeError('Please check if input is too short!')
+	batches = [spec[:n_full * seg_len].reshape(n_full, seg_len, spec.shape[1])] if n_full > 0 else []
+	tail = spec[n_full * seg_len:-1]
+	if len(tail) >= seg_len:
+		if len(tail) == seg_len and n_full > 0:
+			batches[0] = np.concatenate([batches[0], tail[None]], axis=0)
+		else:
+			batches.append(tail[None])
+	return batches
+
+
+def load_valid_set(data_path, speaker2id_path, dset, seg_len, n_segments):
+	# get_valid_set() with the speaker ids read from speaker2id_path
+	with open(speaker2id_path, 'r') as f_json:
+		speaker2id = json.load(f_json)
+	return get_valid_set(data_path, speaker2id, dset, seg_len, n_segments)
+
+
+def get_trainer(hps_path, model_path, g_mode, enc_mode, clf_path, quantize=False, student=False, deterministic=False):
 	HPS = Hps(hps_path)
 	hps = HPS.get_tuple()
 	global MIN_LEN
 	MIN_LEN = MIN_LEN if hps.enc_mode != 'gumbel_t' else hps.seg_len
-	trainer = Trainer(hps, None, g_mode, enc_mode)
-	trainer.load_model(model_path, load_model_list=hps.load_model_list, clf_path = clf_path)
+	trainer = Trainer(hps, None, g_mode, enc_mode, student=student)
+	load_model_list = ', '.join([net for net in hps.load_model_list.split(', ') if net in MODE_REQUIREMENTS['test'][0]]) # skip training-only networks
+	trainer.load_model(model_path, load_model_list=load_model_list, clf_path = clf_path)
+	trainer.Encoder.sample = not deterministic # argmax encodings instead of sampling gumbel noise
+	if quantize: trainer.quantize()
 	return trainer
 
 
+def quantization_report(trainer, valid_set, enc_only, batch_size=16):
+	"""
+		Convert the held-out segments to the first target speaker with the fp32 networks,
+		quantize the trainer in place and compare the int8 outputs against the fp32 ones.
+	"""
+	x_all = torch.from_numpy(valid_set[0])
+	c_all = np.full(len(x_all), trainer.hps.n_speakers - trainer.hps.n_target_speakers)
+	results = {}
+	for precision in ['fp32', 'int8']:
+		if precision == 'int8': trainer.quantize()
+		c = to_var(torch.from_numpy(c_all[:batch_size]), requires_grad=False)
+		trainer.test_step(x_all[:batch_size], c, enc_only=enc_only, verbose=False) # warm up
+		torch.manual_seed(0) # identical gumbel noise for both passes
+		outputs, encodings, start = [], [], time.time()
+		for idx in range(0, len(x_all), batch_size):
+			c = to_var(torch.from_numpy(c_all[idx:idx+batch_size]), requires_grad=False)
+			converted, enc = trainer.test_step(x_all[idx:idx+batch_size], c, enc_only=enc_only, verbose=False)
+			outputs.append(converted)
+			encodings.append(enc)
+		results[precision] = (np.concatenate(outputs), np.concatenate(encodings), time.time() - start)
+
+	(spec_fp, enc_fp, time_fp), (spec_q, enc_q, time_q) = results['fp32'], results['int8']
+	print('[Tester] - Quantization report on {} segments:'.format(len(x_all)))
+	print('[Tester] - spectrogram L1 to fp32: {:.5f} (fp32 mean magnitude {:.5f})'.format(np.abs(spec_q - spec_fp).mean(), np.abs(spec_fp).mean()))
+	if trainer.enc_mode == 'continues':
+		print('[Tester] - encoding L1 to fp32: {:.5f}'.format(np.abs(enc_q - enc_fp).mean()))
+	elif trainer.enc_mode in CODE_ENC_MODES: # independent bits, compared unit by unit as in Trainer.validate()
+		print('[Tester] - encoding units matching fp32: {:.4f}'.format(np.mean((enc_q > 0.5) == (enc_fp > 0.5))))
+	else: # one unit on per step
+		print('[Tester] - encoding steps matching fp32: {:.4f}'.format(np.mean(enc_q.argmax(axis=1) == enc_fp.argmax(axis=1))))
+	print('[Tester] - fp32: {:.3f} sec, int8: {:.3f} sec, speed up: {:.2f}x'.format(time_fp, time_q, time_fp / time_q))
+
+
+def student_report(trainer, teacher_path, valid_set, enc_only, batch_size=16):
+	"""
+		Convert the held-out segments to the first target speaker with the student networks of the trainer
+		and with the teacher restored from teacher_path, then compare their outputs, sizes and speed.
+	"""
+	trainer.load_teacher(teacher_path)
+	trainer.set_eval()
+	x_all = torch.from_numpy(valid_set[0])
+	c_all = np.full(len(x_all), trainer.hps.n_speakers - trainer.hps.n_target_speakers)
+	students = {'decoder' : trainer.Decoder, 'generator' : None if enc_only else trainer.Generator}
+	results = {}
+	for role, nets in [('teacher', trainer.teacher), ('student', students)]:
+		def run(idx):
+			x = to_var(x_all[idx:idx+batch_size], requires_grad=False).permute(0, 2, 1)
+			c = to_var(torch.from_numpy(c_all[idx:idx+batch_size]), requires_grad=False)
+			enc, _ = trainer.Encoder(x)
+			return trainer.generate_step(enc, c, enc_only=enc_only, decoder=nets['decoder'], generator=nets['generator']).data.cpu().numpy()
+		with torch.no_grad():
+			run(0) # warm up
+			torch.manual_seed(0) # identical gumbel noise for both passes
+			start = time.time()
+			outputs = np.concatenate([run(idx) for idx in range(0, len(x_all), batch_size)])
+			elapsed = time.time() - start
+		n_params = sum([p.numel() for net in ['decoder'] + ([] if enc_only else ['generator']) for p in nets[net].parameters()])
+		results[role] = (outputs, elapsed, n_params)
+	trainer.teacher = None
+
+	(spec_t, time_t, size_t), (spec_s, time_s, size_s) = results['teacher'], results['student']
+	print('[Tester] - Distillation report on {} segments:'.format(len(x_all)))
+	print('[Tester] - spectrogram L1 to teacher: {:.5f} (teacher mean magnitude {:.5f})'.format(np.abs(spec_s - spec_t).mean(), np.abs(spec_t).mean()))
+	print('[Tester] - parameters, teacher: {}, student: {} ({:.1f}%)'.format(size_t, size_s, 100. * size_s / size_t))
+	print('[Tester] - teacher: {:.3f} sec, student: {:.3f} sec, speed up: {:.2f}x'.format(time_t, time_s, time_t / time_s))
+
+
+def check_code_parity(trainer, valid_set, enc_only, batch_size=16, tolerance=1e-4):
+	"""
+		Decode the encodings of held-out segments both as dense inputs and as integer codes looked up in the
+		table of all binary encodings, and compare outputs and speed. The codes are also checked against the
+		bit order of dataloader.pack_encodings, which the encoding cache and write_encodings share.
+	"""
+	if not trainer.use_codes():
+		raise NotImplementedError('Integer codes need binary encodings of at most 16 units, enc_mode={}!'.format(trainer.enc_mode))
+	trainer.set_eval()
+	x_all = torch.from_numpy(valid_set[0])
+	c_all = np.full(len(x_all), trainer.hps.n_speakers - trainer.hps.n_target_speakers)
+	diffs, packed_match, times = [], True, {'dense' : 0., 'codes' : 0.}
+	with torch.no_grad():
+		for idx in range(0, len(x_all), batch_size):
+			x = to_var(x_all[idx:idx+batch_size], requires_grad=False).permute(0, 2, 1)
+			c = to_var(torch.from_numpy(c_all[idx:idx+batch_size]), requires_grad=False)
+			enc, _ = trainer.Encoder(x)
+			codes = pack_codes(enc)
+			packed = pack_encodings(enc.data.cpu().numpy(), trainer.enc_mode).astype(np.int64) # (batch_size, n_bytes, t_step), first byte most significant
+			n_bytes = packed.shape[1]
+			packed = sum([packed[:, i] << (8 * (n_bytes - 1 - i)) for i in range(n_bytes)]) >> (8 * n_bytes - enc.size(1))
+			packed_match = packed_match and np.array_equal(packed, codes.data.cpu().numpy())
+			outputs = {}
+			for path in ['dense', 'codes']:
+				start = time.time()
+				outputs[path] = trainer.generate_step(enc, c, enc_only=enc_only, codes=codes if path == 'codes' else None)
+				times[path] += time.time() - start
+			diffs.append((outputs['codes'] - outputs['dense']).abs().max().item())
+	passed = packed_match and max(diffs) < tolerance
+	print('[Tester] - Integer code decoding on {} segments: max diff to dense {:.2e}, codes {} the packed encodings'.format(len(x_all), max(diffs), 'match' if packed_match else 'DO NOT match'))
+	print('[Tester] - dense: {:.3f} sec, codes: {:.3f} sec, speed up: {:.2f}x'.format(times['dense'], times['codes'], times['dense'] / times['codes']))
+	print('[Tester] - Integer code parity {}!'.format('passed' if passed else 'FAILED'))
+	return passed
+
+
+class ConversionGraph(torch.nn.Module):
+	"""
+		Encoder -> Decoder -> Generator of a trainer as one module for export,
+		spec: (batch_size, t_step, 513), speaker: (batch_size,) absolute speaker ids.
+	"""
+	def __init__(self, trainer, enc_only=False):
+		super(ConversionGraph, self).__init__()
+		if not enc_only and trainer.g_mode == 'tacotron':
+			raise NotImplementedError('The autoregressive Tacotron generator can not be exported!')
+		self.trainer = trainer
+		self.enc_only = enc_only
+		self.encoder = trainer.Encoder
+		self.decoder = trainer.Decoder
+		self.generator = None if enc_only else trainer.Generator
+
+	def forward(self, spec, speaker):
+		enc_act, enc = self.encoder(spec.permute(0, 2, 1))
+		converted = self.trainer.generate_step(enc_act, speaker, enc_only=self.enc_only, decoder=self.decoder, generator=self.generator)
+		return converted.permute(0, 2, 1), enc_act, enc
+
+
+def export_onnx(trainer, onnx_path, enc_only=False, opset=17):
+	trainer.set_eval()
+	graph = ConversionGraph(trainer, enc_only).eval()
+	spec = torch.rand(2, trainer.hps.seg_len, 513)
+	speaker = torch.full((2,), trainer.hps.n_speakers - trainer.hps.n_target_speakers, dtype=torch.long)
+	with torch.no_grad():
+		torch.onnx.export(graph, (spec, speaker), onnx_path, dynamo=False, opset_version=opset,
+						  input_names=['spec', 'speaker'], output_names=['converted', 'enc', 'enc_logits'],
+						  dynamic_axes={'spec' : {0 : 'batch', 1 : 't_step'}, 'speaker' : {0 : 'batch'}, 'converted' : {0 : 'batch', 1 : 't_step'},
+										'enc' : {0 : 'batch', 2 : 'enc_step'}, 'enc_logits' : {0 : 'batch', 2 : 'enc_step'}})
+	print('[Tester] - Exported {} to: {}'.format('Encoder -> Decoder' if enc_only else 'Encoder -> Decoder -> Generator', onnx_path))
+
+
+def check_onnx_parity(trainer, onnx_path, valid_set, enc_only=False, tolerance=1e-3):
+	"""
+		Run the exported graph with onnxruntime on held-out segments at several batch sizes and lengths.
+		The encoder logits are compared with the trainer directly, the conversion is compared with
+		Trainer.generate_step on the exported encodings, as the gumbel noise of the two runtimes differs.
+	"""
+	import onnxruntime
+	session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+	trainer.set_eval()
+	x_all = valid_set[0]
+	shapes = [x_all, x_all[:1, :x_all.shape[1] // 2], np.concatenate([x_all[:2], x_all[-2:]], axis=1)]
+	passed = True
+	for spec in shapes:
+		speaker = np.full(len(spec), trainer.hps.n_speakers - trainer.hps.n_target_speakers, dtype=np.int64)
+		converted, enc, enc_logits = session.run(None, {'spec' : spec, 'speaker' : speaker})
+		with torch.no_grad():
+			_, ref_logits = trainer.Encoder(to_var(torch.from_numpy(spec), requires_grad=False).permute(0, 2, 1))
+			ref = trainer.generate_step(to_var(torch.from_numpy(enc), requires_grad=False), to_var(torch.from_numpy(speaker), requires_grad=False), enc_only=enc_only)
+		diff_enc = np.abs(enc_logits - ref_logits.data.cpu().numpy()).max()
+		diff_conv = np.abs(converted - ref.permute(0, 2, 1).data.cpu().numpy()).max()
+		passed = passed and diff_enc < tolerance and diff_conv < tolerance
+		print('[Tester] - ONNX parity, input {}: encoder max diff {:.2e}, conversion max diff {:.2e}'.format(spec.shape, diff_enc, diff_conv))
+	print('[Tester] - ONNX parity {}!'.format('passed' if passed else 'FAILED'))
+	return passed
+
+
+def stream_lookahead(trainer, enc_only=False):
+	"""
+		Future frames that reach an output frame through the convolutions of the conversion networks,
+		rounded up to whole encoding steps of 8 frames. The GRUs and instance norms see the whole window instead.
+	"""
+	def encoder_frames(encoder):
+		frames, scale = encoder.conv1s.right, 1
+		for conv in [encoder.conv2, encoder.conv3, encoder.conv4, encoder.conv5, encoder.conv6, encoder.conv7, encoder.conv8]:
+			frames += (conv.kernel_size[0] - 1) // 2 * scale # right padding of pad_layer
+			scale *= conv.stride[0]
+		return frames
+
+	def decoder_frames(decoder):
+		frames, scale = 0, 8
+		for i, conv in enumerate([decoder.conv1, decoder.conv2, decoder.conv3, decoder.conv4, decoder.conv5, decoder.conv6]):
+			frames += (conv.kernel_size[0] - 1) // 2 * scale
+			if i % 2 == 0: scale //= 2 # pixel shuffle after conv1, conv3 and conv5
+		return frames
+
+	frames = encoder_frames(trainer.Encoder) + decoder_frames(trainer.Decoder)
+	if not enc_only:
+		if trainer.g_mode == 'tacotron':
+			raise NotImplementedError('The autoregressive Tacotron generator can not be streamed!')
+		elif trainer.g_mode == 'enhanced':
+			frames += encoder_frames(trainer.Generator.Encoder) + decoder_frames(trainer.Generator.Decoder) # stacked on the decoder output
+	return int(np.ceil(frames / 8.)) * 8
+
+
+class StreamingConverter(object):
+	"""
+		Converts a stream of spectrogram frames (or of audio samples) to the speaker tar_id, with a fixed lookahead.
+		Frames are converted in blocks of `hop` frames: once `lookahead` frames past a block have arrived, the block
+		is converted within the seg_len window that ends there and is returned by push(). The bidirectional GRUs
+		and instance norms therefore see seg_len - hop - lookahead frames of past context and `lookahead` of future context,
+		and a frame is returned at most (hop + lookahead) * hp.frame_shift seconds after it arrives, plus the compute time.
+		By default the lookahead is the smallest that covers the receptive field of the convolutions, see stream_lookahead().
+	"""
+	def __init__(self, trainer, tar_id, enc_only=False, hop=32, lookahead=None):
+		self.trainer = trainer
+		self.tar_id = tar_id
+		self.enc_only = enc_only
+		self.window = trainer.hps.seg_len
+		self.hop = hop
+		self.lookahead = stream_lookahead(trainer, enc_only) if lookahead is None else lookahead
+		if self.hop <= 0 or self.hop % 8 != 0 or self.lookahead % 8 != 0 or self.hop + self.lookahead > self.window:
+			raise ValueError('hop and lookahead must be multiples of 8 frames, and fit in a window of seg_len={} frames!'.format(self.window))
+		self.latency = (self.hop + self.lookahead) * hp.frame_shift # seconds
+		self.reset()
+
+	def reset(self):
+		self.frames = np.zeros((0, 513), dtype=np.float32) # buffered input, from stream frame self.start on
+		self.start = 0
+		self.emitted = 0
+		self.samples = np.zeros(0, dtype=np.float32) # pre-emphasized audio of push_audio() not analyzed yet
+		self.last_sample = None
+		self.padded = False
+
+	def push(self, frames):
+		# frames: (t_step, 513) normalized magnitudes as made by preprocess.get_spectrograms, returns the converted frames that are ready
+		self.frames = np.concatenate([self.frames, np.asarray(frames, dtype=np.float32).reshape(-1, 513)], axis=0)
+		outputs = [np.zeros((0, 513), dtype=np.float32)]
+		while self.start + len(self.frames) >= self.emitted + self.hop + self.lookahead:
+			outputs.append(self.convert_block(self.emitted + self.hop + self.lookahead, self.hop))
+		return np.concatenate(outputs, axis=0)
+
+	def flush(self):
+		# end of stream, converts the frames still waiting for their lookahead and resets the converter
+		end = self.start + len(self.frames)
+		output = self.convert_block(end, end - self.emitted) if end > self.emitted else np.zeros((0, 513), dtype=np.float32)
+		self.reset()
+		return output
+
+	def convert_block(self, end, n_frames):
+		# converts stream frames [emitted, emitted + n_frames) within the window that ends at stream frame `end`
+		begin = max(self.start, int(np.ceil(max(0, end - self.window) / 8.)) * 8) # windows start on encoding steps
+		x = self.frames[begin - self.start:end - self.start]
+		n_pad = max(MIN_LEN, int(np.ceil(len(x) / 8.)) * 8) - len(x) # zero frames up to a whole encoding step
+		x = np.concatenate([x, np.zeros((n_pad, x.shape[1]), dtype=np.float32)], axis=0) if n_pad > 0 else x
+		converted, _ = convert_x(x, self.tar_id, self.trainer, enc_only=self.enc_only)
+		output = converted[self.emitted - begin:self.emitted - begin + n_frames]
+		self.emitted += n_frames
+		keep = int(np.ceil(max(0, self.emitted + self.hop + self.lookahead - self.window) / 8.)) * 8 # where the next window starts
+		self.frames = self.frames[keep - self.start:]
+		self.start = keep
+		return output
+
+	def push_audio(self, samples, last=False):
+		# samples: audio at hp.sr, analyzed like preprocess.get_spectrograms without the silence trimming, last=True also flushes the stream
+		samples = np.asarray(samples, dtype=np.float32)
+		if len(samples) > 0:
+			first = samples[0] if self.last_sample is None else samples[0] - hp.preemphasis * self.last_sample
+			self.samples = np.concatenate([self.samples, [first], samples[1:] - hp.preemphasis * samples[:-1]]).astype(np.float32)
+			self.last_sample = samples[-1]
+		output = self.push(self.analyze(last))
+		if last:
+			output = np.concatenate([output, self.flush()], axis=0)
+		return output
+
+	def analyze(self, last=False):
+		# the stft frames whose samples have all arrived, padded at both ends of the stream like librosa.stft(center=True)
+		if not self.padded:
+			if len(self.samples) <= hp.n_fft // 2 and not last:
+				return np.zeros((0, 513), dtype=np.float32)
+			self.samples = np.pad(self.samples, (hp.n_fft // 2, 0), mode='reflect')
+			self.padded = True
+		if last:
+			self.samples = np.pad(self.samples, (0, hp.n_fft // 2), mode='reflect')
+		if len(self.samples) < hp.n_fft:
+			return np.zeros((0, 513), dtype=np.float32)
+		n_frames = 1 + (len(self.samples) - hp.n_fft) // hp.hop_length
+		linear = librosa.stft(y=self.samples[:(n_frames - 1) * hp.hop_length + hp.n_fft], n_fft=hp.n_fft, hop_length=hp.hop_length,
+							  win_length=hp.win_length, center=False)
+		self.samples = self.samples[n_frames * hp.hop_length:]
+		mag = 20 * np.log10(np.maximum(1e-5, np.abs(linear)))
+		mag = np.clip((mag - hp.ref_db + hp.max_db) / hp.max_db, 1e-8, 1)
+		return mag.T.astype(np.float32)
+
+
+def stream_report(trainer, seg_len, utterances, enc_only=False, hop=32, lookahead=None):
+	"""
+		Stream every (spectrogram, target id) of utterances through a StreamingConverter in blocks of hop frames,
+		and compare with the offline conversion of convert_spectrogram(). The offline conversion is also repeated,
+		as with sampled encodings (gumbel noise) two offline runs differ as well.
+	"""
+	streamer = StreamingConverter(trainer, tar_id=0, enc_only=enc_only, hop=hop, lookahead=lookahead)
+	l1_stream, l1_offline, block_times, n_frames, stream_time, offline_time = [], [], [], 0, 0., 0.
+	for spec, tar_id in utterances:
+		start = time.time()
+		offline, _ = convert_spectrogram(trainer, seg_len, spec, tar_id, enc_only=enc_only)
+		offline_time += time.time() - start
+		repeated, _ = convert_spectrogram(trainer, seg_len, spec, tar_id, enc_only=enc_only)
+
+		streamer.tar_id = tar_id
+		outputs = []
+		for idx in range(0, len(spec), hop): # frames arrive hop at a time
+			start = time.time()
+			outputs.append(streamer.push(spec[idx:idx+hop]))
+			block_times.append(time.time() - start)
+			stream_time += block_times[-1]
+		start = time.time()
+		outputs.append(streamer.flush())
+		stream_time += time.time() - start
+		streamed = np.concatenate(outputs, axis=0)
+		assert len(streamed) == len(spec)
+
+		n = min(len(offline), len(streamed))
+		l1_stream.append(np.abs(streamed[:n] - offline[:n]).mean())
+		l1_offline.append(np.abs(repeated[:n] - offline[:n]).mean())
+		n_frames += len(spec)
+
+	duration = n_frames * hp.frame_shift
+	print('[Tester] - Streaming report on {} utterances ({:.1f} sec of speech), hop={} frames, lookahead={} frames:'.format(len(utterances), duration, streamer.hop, streamer.lookahead))
+	print('[Tester] - algorithmic latency: {:.0f} ms (hop {:.0f} ms + lookahead {:.0f} ms), compute per hop: {:.1f} ms mean, {:.1f} ms max'.format(
+		  streamer.latency * 1000, streamer.hop * hp.frame_shift * 1000, streamer.lookahead * hp.frame_shift * 1000, np.mean(block_times) * 1000, np.max(block_times) * 1000))
+	print('[Tester] - real-time factor, streaming: {:.3f}, offline: {:.3f}'.format(stream_time / duration, offline_time / duration))
+	print('[Tester] - spectrogram L1 to offline, streaming: {:.5f}, repeated offline: {:.5f}'.format(np.mean(l1_stream), np.mean(l1_offline)))
+
+
 def asr(fname):
 	r = sr.Recognizer()
 	with sr.WavFile(fname) as source:
@@ -125,6 +630,50 @@ def write_encodings(path, encodings):
 			file.write('\n')
 
 
+def convert_spectrogram(trainer, seg_len, src_speaker_spec, tar_id, enc_only=True):
+	converted_results, encodings = convert_spectrogram_targets(trainer, seg_len, src_speaker_spec, [tar_id], enc_only=enc_only)
+	return converted_results[0], encodings
+
+
+def convert_spectrogram_targets(trainer, seg_len, src_speaker_spec, tar_ids, enc_only=True):
+	# encodes src_speaker_spec once and converts it to every speaker id of tar_ids, returns a list of spectrograms in the order of tar_ids
+	batches, n_enc = prepare_segments(src_speaker_spec, seg_len)
+	outputs = [convert_targets_x(segments, tar_ids, trainer, enc_only=enc_only) for segments in batches]
+	converted_results = np.concatenate([converted for converted, _ in outputs], axis=1)
+	encodings = np.concatenate([enc for _, enc in outputs], axis=0)[:n_enc]
+	return list(converted_results), encodings
+
+
+def convert_utterances(trainer, seg_len, specs, tar_ids, enc_only=True, batch_size=16):
+	"""
+		convert_spectrogram() for many utterances, specs[i] is converted to the speaker id tar_ids[i].
+		The segments of all the utterances are bucketed by target speaker and length, converted
+		batch_size at a time and joined back per utterance. Returns the lists of spectrograms and encodings.
+	"""
+	buckets, n_encs, n_segments = OrderedDict(), [], []
+	for i, (spec, tar_id) in enumerate(zip(specs, tar_ids)):
+		batches, n_enc = prepare_segments(spec, seg_len)
+		segments = [segment for segments in batches for segment in segments]
+		for j, segment in enumerate(segments):
+			buckets.setdefault((tar_id, len(segment)), []).append((i, j, segment))
+		n_encs.append(n_enc)
+		n_segments.append(len(segments))
+
+	results = {}
+	for (tar_id, _), bucket in buckets.items():
+		for idx in range(0, len(bucket), batch_size):
+			batch = bucket[idx:idx+batch_size]
+			c_var = to_var(torch.from_numpy(np.array([tar_id])), requires_grad=False)
+			tensor = torch.from_numpy(np.stack([segment for _, _, segment in batch])).type(torch.FloatTensor)
+			converted, enc = trainer.test_targets_step(tensor, c_var, enc_only=enc_only)
+			for b, (i, j, _) in enumerate(batch):
+				results[(i, j)] = (converted[0, b].T, enc[b].T)
+
+	converted_results = [np.concatenate([results[(i, j)][0] for j in range(n_segments[i])], axis=0) for i in range(len(specs))]
+	encodings = [np.concatenate([results[(i, j)][1] for j in range(n_segments[i])], axis=0)[:n_encs[i]] for i in range(len(specs))]
+	return converted_results, encodings
+
+
 def convert(trainer,
 			seg_len,
 			src_speaker_spec, 
@@ -136,37 +685,7 @@ def convert(trainer,
 			enc_only=True,
 			save=['wav', 'enc']): 
 	
-	# pad spec to minimum len
-	PADDED = False
-	if len(src_speaker_spec) < MIN_LEN:
-		padding = np.zeros((MIN_LEN - src_speaker_spec.shape[0], src_speaker_spec.shape[1]))
-		src_speaker_spec = np.concatenate((src_speaker_spec, padding), axis=0)
-		PADDED = True
-		
-	if len(src_speaker_spec) <= seg_len:
-		converted_results, encodings = convert_x(src_speaker_spec, speaker2id[tar_speaker], trainer, enc_only=enc_only)
-		if PADDED: 
-			encodings = encodings[:MIN_LEN//8] # truncate the encoding of zero paddings
-
-	else:
-		converted_results = []
-		encodings = []
-		for idx in range(0, len(src_speaker_spec), seg_len):
-			if idx + (seg_len*2) > len(src_speaker_spec):
-				spec_frag = src_speaker_spec[idx:-1]
-			else:
-				spec_frag = src_speaker_spec[idx:idx+seg_len]
-
-			if len(spec_frag) >= seg_len:
-				converted_x, enc = convert_x(spec_frag, speaker2id[tar_speaker], trainer, enc_only=enc_only)
-				converted_results.append(converted_x)
-				encodings.append(enc)
-			elif idx == 0:
-				raise RuntimeError('Please check if input is too short!')
-
-		converted_results = np.concatenate(converted_results, axis=0)
-		encodings = np.concatenate(encodings, axis=0)
-
+	converted_results, encodings = convert_spectrogram(trainer, seg_len, src_speaker_spec, speaker2id[tar_speaker], enc_only=enc_only)
 	wav_data = spectrogram2wav(converted_results)
 	if len(save) != 0:
 		if 'wav' in save: 
@@ -186,33 +705,8 @@ def encode(src_speaker_spec, trainer, seg_len, s_speaker=None, utt_id=None, resu
 		assert s_speaker != None
 		assert utt_id != None
 
-	# pad spec to minimum len
-	PADDED = False
-	if len(src_speaker_spec) < MIN_LEN:
-		padding = np.zeros((MIN_LEN - src_speaker_spec.shape[0], src_speaker_spec.shape[1]))
-		src_speaker_spec = np.concatenate((src_speaker_spec, padding), axis=0)
-		PADDED = True
-		
-	if len(src_speaker_spec) <= seg_len:
-		encodings = encode_x(src_speaker_spec, trainer)
-		if PADDED: 
-			encodings = encodings[:MIN_LEN//8] # truncate the encoding of zero paddings
-
-	else:
-		encodings = []
-		for idx in range(0, len(src_speaker_spec), seg_len):
-			if idx + (seg_len*2) > len(src_speaker_spec):
-				spec_frag = src_speaker_spec[idx:-1]
-			else:
-				spec_frag = src_speaker_spec[idx:idx+seg_len]
-
-			if len(spec_frag) >= seg_len:
-				enc = encode_x(spec_frag, trainer)
-				encodings.append(enc)
-			elif idx == 0:
-				raise RuntimeError('Please check if input is too short!')
-
-		encodings = np.concatenate(encodings, axis=0)
+	batches, n_enc = prepare_segments(src_speaker_spec, seg_len)
+	encodings = np.concatenate([encode_x(segments, trainer) for segments in batches], axis=0)[:n_enc]
 
 	if save:
 		enc_path = os.path.join(result_dir, f"{s_speaker}_{utt_id}.txt")
@@ -221,7 +715,7 @@ def encode(src_speaker_spec, trainer, seg_len, s_speaker=None, utt_id=None, resu
 		return encodings
 
 
-def test_from_list(trainer, seg_len, synthesis_list, data_path, speaker2id_path, result_dir, enc_only, flag='test', run_asr=False):
+def test_from_list(trainer, seg_len, synthesis_list, data_path, speaker2id_path, result_dir, enc_only, flag='test', run_asr=False, batch_size=16, n_workers=0):
 	
 	with open(speaker2id_path, 'r') as f_json:
 		speaker2id = json.load(f_json)
@@ -239,33 +733,65 @@ def test_from_list(trainer, seg_len, synthesis_list, data_path, speaker2id_path,
 	dir_path = os.path.join(result_dir, f'{flag}/')
 	os.makedirs(dir_path, exist_ok=True)
 
-	err_results = []
-	with h5py.File(data_path, 'r') as f_h5:
-		for feed in tqdm(feeds):
-			conv_audio, n_frames = convert(trainer,
-								 		   seg_len,
-								 		   src_speaker_spec=f_h5[f"test/{feed['s_id']}/{feed['utt_id']}/lin"][()], 
-								 		   src_speaker=feed['s_id'],
-								 		   tar_speaker=feed['t_id'],
-								 		   utt_id=feed['utt_id'],
-								 		   speaker2id=speaker2id,
-								 		   result_dir=dir_path,
-								 		   enc_only=enc_only,
-								 		   save=['wav'])
-			n_frames = len(f_h5[f"test/{feed['s_id']}/{feed['utt_id']}/lin"][()])
-			if run_asr:
-				if hp.frame_shift * (n_frames - 1) + hp.frame_length >= 3.0:
-					orig_audio = spectrogram2wav(f_h5[f"test/{feed['s_id']}/{feed['utt_id']}/lin"][()])
-					sf.write('orig_audio.wav', orig_audio, hp.sr, 'PCM_16')
-					err_results.append(compare_asr(s_wav='orig_audio.wav', t_wav=conv_audio))
-					os.remove(path='orig_audio.wav')
+	with VocoderPool(n_workers, batch_size) as pool: # the workers start while the utterances are converted
+
+		# every spectrogram is read once, and the segments of all the utterances are converted in batches
+		with h5py.File(data_path, 'r') as f_h5:
+			specs = [f_h5[f"test/{feed['s_id']}/{feed['utt_id']}/lin"][()] for feed in feeds]
+		start = time.time()
+		converted_results, _ = convert_utterances(trainer, seg_len, specs, [speaker2id[feed['t_id']] for feed in feeds], enc_only=enc_only, batch_size=batch_size)
+		elapsed = time.time() - start
+		n_frames = sum([len(spec) for spec in specs])
+		print('[Tester] - Converted {} utterances ({} frames) in {:.2f} sec with batch size {}: {:.1f} utterances/sec, {:.0f} frames/sec'.format(
+			  len(feeds), n_frames, elapsed, batch_size, len(feeds) / elapsed, n_frames / elapsed))
+
+		# vocoded and written by the workers of the pool while the next batches are submitted, reported in order
+		err_results = []
+		gl_iterations, gl_convergence = [], []
+		wav_paths = [os.path.join(dir_path, f"{feed['t_id']}_{feed['utt_id']}.wav") for feed in feeds]
+		order = np.argsort([len(converted) for converted in converted_results]) # vocoded in batches of similar lengths
+		progress = tqdm(total=len(feeds))
+		start = time.time()
+		for idx in range(0, len(order), batch_size):
+			batch = order[idx:idx+batch_size]
+			pool.submit([converted_results[i] for i in batch], [wav_paths[i] for i in batch], tag=batch)
+			for done, _, iterations, convergence in pool.collect(wait=idx + batch_size >= len(order)):
+				gl_iterations += iterations
+				gl_convergence += convergence
+				progress.update(len(done))
+				for i in done:
+					if run_asr and hp.frame_shift * (len(specs[i]) - 1) + hp.frame_length >= 3.0:
+						orig_audio = spectrogram2wav(specs[i])
+						sf.write('orig_audio.wav', orig_audio, hp.sr, 'PCM_16')
+						err_results.append(compare_asr(s_wav='orig_audio.wav', t_wav=wav_paths[i]))
+						os.remove(path='orig_audio.wav')
+	progress.close()
+	elapsed = time.time() - start
+	print('[Tester] - Vocoded {} utterances in {:.2f} sec with {} workers: {:.1f} utterances/sec'.format(len(feeds), elapsed, n_workers, len(feeds) / elapsed))
+	print('[Tester] - Griffin-Lim: {:.1f} iterations on average (at most {}), spectral convergence {:.4f} on average'.format(
+		  np.mean(gl_iterations), hp.n_iter, np.mean(gl_convergence)))
 
 	if run_asr:
 		err_mean = np.mean(err_results, axis=0)
 		print('WERR: {:.3f}  CERR: {:.3f}, computed over {} samples'.format(err_mean[0], err_mean[1], len(err_results)))
 
 
-def cross_test(trainer, seg_len, data_path, speaker2id_path, result_dir, enc_only, flag):
+def test_stream(trainer, seg_len, synthesis_list, data_path, speaker2id_path, enc_only, hop=32, lookahead=None, n_utterances=20):
+
+	with open(speaker2id_path, 'r') as f_json:
+		speaker2id = json.load(f_json)
+
+	utterances = []
+	with open(synthesis_list, 'r') as f, h5py.File(data_path, 'r') as f_h5:
+		for line in f.readlines()[:n_utterances]:
+			line = line.split('\n')[0].split(' ')
+			s_id, utt_id = line[0].split('/')[1].split('_')
+			utterances.append((f_h5[f'test/{s_id}/{utt_id}/lin'][()], speaker2id[line[1]]))
+
+	stream_report(trainer, seg_len, utterances, enc_only=enc_only, hop=hop, lookahead=lookahead)
+
+
+def cross_test(trainer, seg_len, data_path, speaker2id_path, result_dir, enc_only, flag, n_workers=0):
 
 	with h5py.File(data_path, 'r') as f_h5:
 
@@ -282,22 +808,27 @@ def cross_test(trainer, seg_len, data_path, speaker2id_path, result_dir, enc_onl
 		print('[Tester] - Source speakers: %i, Target speakers: %i' % (len(source_speakers), len(target_speakers)))
 		print('[Tester] - Converting all testing utterances from source speakers to target speakers, this may take a while...')
 	
-		for src_speaker in tqdm(source_speakers):
-			for tar_speaker in target_speakers:
-				assert src_speaker != tar_speaker
-				dir_path = os.path.join(result_dir, f'{src_speaker}_to_{tar_speaker}')
-				os.makedirs(dir_path, exist_ok=True)
+		# every utterance is converted to all the target speakers in one batch, and vocoded by the workers of the pool
+		# while the next ones are converted, the completed utterances are reported in order
+		with VocoderPool(n_workers, batch_size=len(target_speakers)) as pool:
+			progress = tqdm(total=sum([len(f_h5[f'test/{src_speaker}']) for src_speaker in source_speakers]))
+			start = time.time()
+			for src_speaker in source_speakers:
+				assert src_speaker not in target_speakers
+				dir_paths = [os.path.join(result_dir, f'{src_speaker}_to_{tar_speaker}') for tar_speaker in target_speakers]
+				for dir_path in dir_paths:
+					os.makedirs(dir_path, exist_ok=True)
 
 				for utt_id in f_h5[f'test/{src_speaker}']:
 					src_speaker_spec = f_h5[f'test/{src_speaker}/{utt_id}/lin'][()]
-					convert(trainer,
-							seg_len,
-							src_speaker_spec, 
-							tar_speaker,
-							utt_id=utt_id,
-							speaker2id=speaker2id,
-							result_dir=dir_path,
-							enc_only=enc_only)
+					converted_results, encodings = convert_spectrogram_targets(trainer, seg_len, src_speaker_spec, [speaker2id[t] for t in target_speakers], enc_only=enc_only)
+					for dir_path in dir_paths:
+						write_encodings(os.path.join(dir_path, f'{src_speaker}_{utt_id}.txt'), encodings)
+					pool.submit(converted_results, [os.path.join(dir_path, f'{tar_speaker}_{utt_id}.wav') for tar_speaker, dir_path in zip(target_speakers, dir_paths)])
+					progress.update(len(pool.collect()))
+			progress.update(len(pool.close()))
+		progress.close()
+		print('[Tester] - Converted and vocoded {} utterances in {:.2f} sec with {} workers'.format(progress.n, time.time() - start, n_workers))
 
 
 def test_single(trainer, seg_len, speaker2id_path, result_dir, enc_only, s_speaker, t_speaker):
@@ -361,11 +892,11 @@ def test_encode(trainer, seg_len, test_path, data_path, result_dir, flag='test')
 			
 
 
-def target_classify(trainer, seg_len, synthesis_list, result_dir, flag='test'):
+def target_classify(trainer, seg_len, synthesis_list, result_dir, flag='test', batch_size=16):
 	dir_path = os.path.join(result_dir, f'{flag}/')
 	with open(synthesis_list, 'r') as f:
 		file = f.readlines()
-	acc = []
+	specs, tar_speakers = [], []
 	for line in file:
 		# get wav path
 		line = line.split('\n')[0].split(' ')
@@ -380,24 +911,20 @@ def target_classify(trainer, seg_len, synthesis_list, result_dir, flag='test'):
 		if len(spec) < seg_len:
 			padding = np.zeros((seg_len - spec.shape[0], spec.shape[1]))
 			spec = np.concatenate((spec, padding), axis=0)
-		
-		# classification
-		logits = []
-		for idx in range(0, len(spec), seg_len):
-			if idx + (seg_len*2) > len(spec):
-				spec_frag = spec[idx:-1]
-			else:
-				spec_frag = spec[idx:idx+seg_len]
-
-			if len(spec_frag) >= seg_len:
-				x = torch.from_numpy(np.expand_dims(spec_frag[:seg_len, :], axis=0)).type(torch.FloatTensor)
-				logit = trainer.classify(x)
-				logits.append(logit)
-			elif idx == 0:
-				raise RuntimeError('Please check if input is too short!')
-		logits = np.concatenate(logits, axis=0)
-		#logits = np.sum(logits, axis = 0)
-		for logit in logits:
+		specs.append(spec)
+		tar_speakers.append(tar_speaker)
+
+	# classification: whole utterances in zero padded batches of similar lengths
+	acc = []
+	order = np.argsort([len(spec) for spec in specs])
+	for idx in range(0, len(order), batch_size):
+		batch = order[idx:idx+batch_size]
+		lengths = np.array([len(specs[i]) for i in batch])
+		x = np.zeros((len(batch), lengths.max(), specs[batch[0]].shape[1]), dtype=np.float32)
+		for j, i in enumerate(batch):
+			x[j, :lengths[j]] = specs[i]
+		logits = trainer.classify(torch.from_numpy(x), lengths=torch.from_numpy(lengths))
+		for i, logit in zip(batch, logits):
 			am = logit.argmax()
 			if am == 0:
 				clf_speaker = 'V001'
@@ -405,12 +932,7 @@ def target_classify(trainer, seg_len, synthesis_list, result_dir, flag='test'):
 				clf_speaker = 'V002'
 			else:
 				clf_speaker = 'None'
-			if clf_speaker == tar_speaker:
-				acc.append(1)
-				#print('[info]: {} is classified to {}'.format(wav_path, clf_speaker))
-			else:
-				acc.append(0)
-				#print('[Error]: {} is classified to {}'.format(wav_path, clf_speaker))
+			acc.append(1 if clf_speaker == tar_speakers[i] else 0)
 	print('Classification Acc: {:.3f}'.format(np.sum(acc)/float(len(acc))))
 
 
@@ -464,4 +986,29 @@ def encode_for_tacotron(target, trainer, seg_len, multi2idx_path, wav_path, resu
 			file.write('\n')
 
 
-	
+def encode_for_cache(trainer, dataset, cache_path, batch_size=256):
+	"""
+		Runs the frozen stage 1 encoder once over every training crop of `dataset`
+		and stores the encodings in the same order as its index file.
+		The encoder runs in eval mode, so the cache holds one encoding per crop without dropout
+		and with a single gumbel sample, where training without the cache re-encodes every batch
+		in train mode with fresh dropout and gumbel noise.
+	"""
+	n_samples = len(dataset)
+	print('[Converter] - Number of segments to be encoded: ', n_samples)
+
+	with h5py.File(cache_path, 'w') as f_h5:
+		for start in tqdm(range(0, n_samples, batch_size)):
+			end = min(start + batch_size, n_samples)
+			batch = np.array([dataset[i][1] for i in range(start, end)])
+			with torch.no_grad():
+				enc = trainer.encoder_test_step(torch.from_numpy(batch).type(torch.FloatTensor)) # shape: (batch_size, enc_size, t_step)
+			packed = pack_encodings(enc, trainer.enc_mode)
+			if start == 0:
+				f_h5.create_dataset('enc', shape=(n_samples,) + packed.shape[1:], dtype=packed.dtype)
+			f_h5['enc'][start:end] = packed
+
+		f_h5.attrs['enc_mode'] = trainer.enc_mode
+		f_h5.attrs['enc_size'] = enc.shape[1]
+		f_h5.attrs['seg_len'] = dataset.seg_len
+	print('[Converter] - Encoding cache saved to: ', cache_path)
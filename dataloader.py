@@ -52,18 +52,70 @@ class DataLoader(object):
 		return tuple(batch_tensor)
 
 
+############
+# CONSTANT #
+############
+BINARY_ENC_MODES = ['one_hot', 'binary', 'multilabel_binary', 'gumbel_t']
+
+
+"""
+	Encoding cache helpers, binary encodings are bit-packed along the encoding axis,
+	continues encodings are stored in half precision.
+	enc: (N, enc_size, T) 
+"""
+def pack_encodings(enc, enc_mode):
+	if enc_mode in BINARY_ENC_MODES:
+		return np.packbits(enc > 0.5, axis=1)
+	return enc.astype(np.float16)
+
+
+def unpack_encodings(packed, enc_size):
+	if packed.dtype == np.uint8:
+		return np.unpackbits(packed, axis=-2, count=enc_size).astype(np.float32)
+	return packed.astype(np.float32)
+
+
+def get_valid_set(h5_path, speaker2id, dset='test', seg_len=128, n_segments=256):
+	"""
+		Fixed held-out segments: the first seg_len frames of every utterance long enough,
+		taken round-robin over the speakers of `dset` in sorted order.
+		Returns x: (n_segments, seg_len, 513) and c: (n_segments,), c is -1 for speakers without an id.
+	"""
+	with h5py.File(h5_path, 'r') as f_h5:
+		speaker_utts = []
+		for speaker in sorted(f_h5[dset].keys()):
+			utts = [utt for utt in sorted(f_h5[f'{dset}/{speaker}'].keys()) if f_h5[f'{dset}/{speaker}/{utt}/lin'].shape[0] >= seg_len]
+			speaker_utts.append((speaker, utts))
+		xs, cs = [], []
+		for i in range(max([len(utts) for _, utts in speaker_utts] + [0])):
+			for speaker, utts in speaker_utts:
+				if i < len(utts) and len(xs) < n_segments:
+					xs.append(f_h5[f'{dset}/{speaker}/{utts[i]}/lin'][:seg_len])
+					cs.append(speaker2id.get(speaker, -1))
+	print('[Dataset] - Held-out segments from the {} set: {}'.format(dset, len(xs)))
+	return np.array(xs, dtype=np.float32), np.array(cs, dtype=np.int64)
+
+
 class Dataset(data.Dataset):
-	def __init__(self, h5_path, index_path, dset='train', seg_len=64, load_mel=False):
+	def __init__(self, h5_path, index_path, dset='train', seg_len=64, load_mel=False, enc_cache_path=None, rank=0, world_size=1):
 		self.dataset = h5py.File(h5_path, 'r')
 		with open(index_path) as f_index:
 			self.indexes = json.load(f_index)
+		self.sample_ids = list(range(rank, len(self.indexes), world_size)) # disjoint shard of the index for each process
 		self.indexer = namedtuple('index', ['speaker', 'i', 't'])
 		self.seg_len = seg_len
 		self.dset = dset
 		self.load_mel = load_mel
+		self.load_enc = enc_cache_path is not None
+		if self.load_enc:
+			self.enc_cache = h5py.File(enc_cache_path, 'r')
+			self.enc_size = int(self.enc_cache.attrs['enc_size'])
+			if len(self.enc_cache['enc']) != len(self.indexes) or self.enc_cache.attrs['seg_len'] != seg_len:
+				raise RuntimeError('Encoding cache {} does not match the index file {}!'.format(enc_cache_path, index_path))
 
 	def __getitem__(self, i):
-		index = self.indexes[i]
+		sample_id = self.sample_ids[i]
+		index = self.indexes[sample_id]
 		index = self.indexer(**index)
 		speaker = index.speaker
 		i, t = index.i, index.t
@@ -72,8 +124,10 @@ class Dataset(data.Dataset):
 			data = [speaker, self.dataset[f'{self.dset}/{i}/lin'][t:t+seg_len], self.dataset[f'{self.dset}/{i}/mel'][t:t+seg_len]]
 		else:
 			data = [speaker, self.dataset[f'{self.dset}/{i}/lin'][t:t+seg_len]]
+		if self.load_enc:
+			data.append(unpack_encodings(self.enc_cache['enc'][sample_id], self.enc_size))
 		return tuple(data)
 
 	def __len__(self):
-		return len(self.indexes)
+		return len(self.sample_ids)
 
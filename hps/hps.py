@@ -27,7 +27,9 @@ class processing_hyperparams(object):
 		self.win_length = int(self.sr*self.frame_length) # samples.
 		self.n_mels = 80 # Number of Mel banks to generate
 		self.power = 1.2 # Exponent for amplifying the predicted magnitude
-		self.n_iter = 300 # Number of inversion iterations
+		self.n_iter = 300 # Maximum number of inversion iterations
+		self.gl_momentum = 0.99 # Fast Griffin-Lim momentum, 0 for plain Griffin-Lim
+		self.gl_tolerance = 5e-3 # Stop once an iteration improves the spectral convergence by less than this fraction, None to always run n_iter
 		self.preemphasis = .97 # or None
 		self.max_db = 100
 		self.ref_db = 20
@@ -71,7 +73,19 @@ class Hps(object):
 			'tacotron_iters',
 			'tclf_iters',
 			'max_to_keep',
-			]
+			'log_interval',
+			'gp_interval',
+			'gp_batch_size',
+			'valid_interval',
+			'valid_segments',
+			'valid_batch_size',
+			'ckpt_fp16',
+			'grad_checkpoint',
+			'student_emb_size',
+			'student_dense_blocks',
+			'distill_iters',
+			],
+			defaults=[100, 1, 0, 0, 256, 64, False, False, 256, 1, 50000]
 		)
 		if not path is None:
 			self.load(path)
@@ -12,11 +12,15 @@
 ###############
 import os
 import argparse
+import torch
+import torch.distributed as dist
 from hps.hps import Hps
 from trainer import Trainer
 from preprocess import preprocess
-from convert import test_from_list, cross_test, test_single, test_encode, target_classify, get_trainer, encode_for_tacotron
+from convert import test_from_list, cross_test, test_single, test_stream, test_encode, target_classify, get_trainer, load_valid_set, encode_for_tacotron, encode_for_cache, quantization_report, student_report, export_onnx, check_onnx_parity, check_code_parity
 from dataloader import Dataset, DataLoader
+from utils import single_process_throughput
+from model.model import ConvBank
 
 
 ###################
@@ -33,6 +37,7 @@ def argument_runner():
 	parser.add_argument('--train_al', default=False, action='store_true', help='start auto-locker training with target guided training')
 	parser.add_argument('--train_c', default=False, action='store_true', help='start target classifier training')
 	parser.add_argument('--train_t', default=False, action='store_true', help='start tacotron training')
+	parser.add_argument('--train_d', default=False, action='store_true', help='distill the decoder and generator restored from --load_train_model_name into a compact student')
 
 	parser.add_argument('--test', default=False, action='store_true', help='test the trained model on the testing list provided at --synthesis_list')
 	parser.add_argument('--test_asr', default=False, action='store_true', help='test the trained model with asr on the testing list provided at --synthesis_list')
@@ -40,8 +45,12 @@ def argument_runner():
 	parser.add_argument('--test_single', default=False, action='store_true', help='test the trained model on a single file')
 	parser.add_argument('--test_encode', default=False, action='store_true', help='test the trained model encoding ability by generating encodings')
 	parser.add_argument('--test_classify', default=False, action='store_true', help='classify speakers on all testing files')
+	parser.add_argument('--test_stream', default=False, action='store_true', help='stream utterances of --synthesis_list through the streaming converter and compare with offline conversion')
+	parser.add_argument('--check_codes', default=False, action='store_true', help='compare decoding binary encodings from integer codes against dense encodings on held-out segments of --valid_dset')
+	parser.add_argument('--export_onnx', default=False, action='store_true', help='export the test model to a single onnx graph at --onnx_path and check it against the trainer')
 	parser.add_argument('--encode', default=False, action='store_true', help='encode all wav files under --target_path')
 	parser.add_argument('--load_model', default=False, action='store_true', help='whether to load training session from previous checkpoints')
+	parser.add_argument('--make_enc_cache', default=False, action='store_true', help='encode all stage 2 training segments once with the encoder restored from --load_train_model_name')
 
 	static_setting = parser.add_argument_group('static_setting')
 	static_setting.add_argument('--flag', type=str, default='train', help='constant flag')
@@ -51,7 +60,25 @@ def argument_runner():
 	static_setting.add_argument('--enc_only', default=False, action='store_true', help='whether to predict only with stage 1 audoencoder')
 	static_setting.add_argument('--s_speaker', type=str, default='S015', help='for the --test_single mode, set voice convergence source speaker')
 	static_setting.add_argument('--t_speaker', type=str, default='V002', help='for the --test_single mode, set voice convergence target speaker')
+	static_setting.add_argument('--quantize', default=False, action='store_true', help='run the --test_* and --encode commands with dynamic int8 quantized networks on CPU')
+	static_setting.add_argument('--quantize_report', default=False, action='store_true', help='with --quantize, compare int8 against fp32 outputs on held-out segments of --valid_dset before testing')
+	static_setting.add_argument('--deterministic', default=False, action='store_true', help='run the --test_* and --encode commands with the argmax of the encoder instead of sampling gumbel noise, so that identical inputs get identical encodings')
+	static_setting.add_argument('--student', default=False, action='store_true', help='run the --test_* and --encode commands with a compact student made by --train_d')
+	static_setting.add_argument('--student_report', default=False, action='store_true', help='with --student, compare against the teacher at --load_train_model_name on held-out segments of --valid_dset before testing')
+	static_setting.add_argument('--test_batch_size', type=int, default=16, help='for the --test mode, segments converted per forward, bucketed over all the utterances of --synthesis_list by target speaker and length')
+	static_setting.add_argument('--vocoder_workers', type=int, default=0, help='for the --test and --cross_test modes, processes that vocode and write the wav files while the next utterances are converted, 0 vocodes in the main process')
+	static_setting.add_argument('--stream_hop', type=int, default=32, help='for the --test_stream mode, frames converted per block, a multiple of 8')
+	static_setting.add_argument('--stream_lookahead', type=int, default=None, help='for the --test_stream mode, future frames waited for before converting a block, a multiple of 8, defaults to the receptive field of the convolutions')
 	static_setting.add_argument('--encode_t', choices=['V001', 'V002'], default=None, help='target to be encoded by --encode, must be specified (V001, or V002).')
+	static_setting.add_argument('--distributed', default=False, action='store_true', help='data-parallel training over processes launched by torchrun, on one or several machines')
+	static_setting.add_argument('--dist_backend', type=str, default='gloo', help='collective backend for --distributed, gloo for CPU training')
+	static_setting.add_argument('--scaling_baseline', type=str, default=None, help='with --distributed, a benchmark.py <output>.json run with one process on the same hps and threads, to report the scaling efficiency against')
+	static_setting.add_argument('--fused_conv_banks', type=str, nargs='*', default=['cuda'], help='device types (cpu, cuda) that run the Encoder and CBHG convolution banks as one zero padded convolution instead of one convolution per kernel size, see benchmark.py --conv_banks')
+	static_setting.add_argument('--time_phases', default=False, action='store_true', help='log per-iteration time spent in data fetch, forward, backward, clip and step of every network')
+	static_setting.add_argument('--profile_start', type=int, default=-1, help='capture a torch.profiler trace starting at this training iteration, disabled if negative')
+	static_setting.add_argument('--profile_steps', type=int, default=5, help='number of training iterations captured by --profile_start')
+	static_setting.add_argument('--valid_dset', type=str, default='test', help='hdf5 group to draw the held-out segments from, validated every hps.valid_interval training iterations')
+	static_setting.add_argument('--enc_cache', default=False, action='store_true', help='read precomputed encodings from --enc_cache_*_path instead of running the frozen encoder in stage 2 / tacotron training, the cache holds one eval-mode encoding per segment (no encoder dropout, one fixed gumbel sample) instead of a fresh train-mode encoding every batch')
 	
 	data_path = parser.add_argument_group('data_path')
 	data_path.add_argument('--dataset', choices=['english', 'surprise'], default='english', help='which dataset to use')
@@ -66,10 +93,14 @@ def argument_runner():
 	data_path.add_argument('--speaker2id_path', type=str, default='./data/speaker2id_english.json', help='records speaker and speaker id')
 	data_path.add_argument('--multi2idx_path', type=str, default='./data/multi2idx.json', help='records encoding and idx mapping')
 	data_path.add_argument('--metadata_path', type=str, default='./data/metadata_english_target.csv', help='path to store encodings for Tacotron')
+	data_path.add_argument('--enc_cache_source_path', type=str, default='./data/enc_cache_english_source.hdf5', help='encodings of the stage 2 training source segments, made by --make_enc_cache')
+	data_path.add_argument('--enc_cache_target_path', type=str, default='./data/enc_cache_english_target.hdf5', help='encodings of the stage 2 training target segments, made by --make_enc_cache')
 
 	model_path = parser.add_argument_group('model_path')
 	model_path.add_argument('--hps_path', type=str, default='./hps/zerospeech_english.json', help='hyperparameter path, please refer to the default settings in zerospeech.json')
 	model_path.add_argument('--ckpt_dir', type=str, default='./ckpt_english', help='checkpoint directory for training storage')
+	model_path.add_argument('--profile_dir', type=str, default='./log/profile/', help='directory to save chrome traces captured by --profile_start')
+	model_path.add_argument('--onnx_path', type=str, default='./result/model.onnx', help='where --export_onnx saves the onnx graph')
 	model_path.add_argument('--result_dir', type=str, default='./result', help='result directory for generating test results')
 	model_path.add_argument('--sub_result_dir', type=str, default='./english/', help='sub result directory for generating zerospeech synthesis results')
 	model_path.add_argument('--model_name', type=str, default='model.pth', help='base model name for training')
@@ -99,6 +130,7 @@ def argument_runner():
 	print('[Runner] - Generator mode: ', args.g_mode)
 	print('[Runner] - Encoder mode: ', args.enc_mode)
 	print('[Runner] - Encoding dim: ', hps.enc_size)
+	ConvBank.fused_devices = set(args.fused_conv_banks)
 
 	return args, hps
 
@@ -126,12 +158,21 @@ def main():
 				   remake=args.remake)
 
 
-	if args.train or args.train_ae or args.train_p or args.train_tgat or args.train_al or args.train_c or args.train_t:
+	if args.train or args.train_ae or args.train_p or args.train_tgat or args.train_al or args.train_c or args.train_t or args.train_d:
 		
+		#---initialize process group---#
+		rank, world_size = 0, 1
+		if args.distributed:
+			dist.init_process_group(backend=args.dist_backend, init_method='env://')
+			rank, world_size = dist.get_rank(), dist.get_world_size()
+			print('[Runner] - Distributed training: process {}/{}'.format(rank, world_size))
+
 		#---create datasets---#
-		dataset = Dataset(args.dataset_path, args.index_path, seg_len=hps.seg_len)
-		sourceset = Dataset(args.dataset_path, args.index_source_path, seg_len=hps.seg_len)
-		targetset = Dataset(args.dataset_path, args.index_target_path, seg_len=hps.seg_len, load_mel=True if args.train_t else False)
+		dataset = Dataset(args.dataset_path, args.index_path, seg_len=hps.seg_len, rank=rank, world_size=world_size)
+		sourceset = Dataset(args.dataset_path, args.index_source_path, seg_len=hps.seg_len, rank=rank, world_size=world_size,
+							enc_cache_path=args.enc_cache_source_path if args.enc_cache else None)
+		targetset = Dataset(args.dataset_path, args.index_target_path, seg_len=hps.seg_len, load_mel=True if args.train_t else False,
+							rank=rank, world_size=world_size, enc_cache_path=args.enc_cache_target_path if args.enc_cache else None)
 		
 		#---create data loaders---#
 		data_loader = DataLoader(dataset, hps.batch_size)
@@ -143,7 +184,11 @@ def main():
 		model_path = os.path.join(args.ckpt_dir, args.model_name)
 
 		#---initialize trainer---#
-		trainer = Trainer(hps, data_loader, args.g_mode, args.enc_mode)
+		trainer = Trainer(hps, data_loader, args.g_mode, args.enc_mode, student=args.train_d)
+		if hps.valid_interval > 0:
+			trainer.set_valid_set(load_valid_set(args.dataset_path, args.speaker2id_path, args.valid_dset, hps.seg_len, hps.valid_segments))
+		if args.scaling_baseline is not None: trainer.set_scaling_baseline(single_process_throughput(args.scaling_baseline, hps.batch_size, hps.seg_len, args.enc_mode, torch.get_num_threads()))
+		if args.time_phases or args.profile_start >= 0: trainer.enable_profiling(args.time_phases, args.profile_start, args.profile_steps, args.profile_dir)
 		if args.load_model: trainer.load_model(os.path.join(args.ckpt_dir, args.load_train_model_name), load_model_list=hps.load_model_list)
 
 		if args.train or args.train_ae:
@@ -154,12 +199,12 @@ def main():
 
 		if args.train or args.train_p or args.train_tgat:	
 			trainer.add_duo_loader(source_loader, target_loader)
-			trainer.train(model_path, args.flag, mode='patchGAN', target_guided=args.train_tgat)		# Stage 2 training
+			trainer.train(model_path, args.flag, mode='patchGAN', target_guided=args.train_tgat, use_enc_cache=args.enc_cache)		# Stage 2 training
 			trainer.reset_keep()
 
 		if args.train or args.train_al:	
 			trainer.add_duo_loader(source_loader, target_loader)
-			trainer.train(model_path, args.flag, mode='autolocker', target_guided=True)		# Stage 2 training
+			trainer.train(model_path, args.flag, mode='autolocker', target_guided=True, use_enc_cache=args.enc_cache)		# Stage 2 training
 			trainer.reset_keep()
 			
 		if args.train or args.train_c:	
@@ -168,25 +213,45 @@ def main():
 
 		if args.train or args.train_t:
 			trainer.switch_loader(target_loader)
-			trainer.train(model_path, args.flag, mode='train_Tacotron')
+			trainer.train(model_path, args.flag, mode='train_Tacotron', use_enc_cache=args.enc_cache)
+			trainer.reset_keep()
+
+		if args.train_d:
+			teacher_path = os.path.join(args.ckpt_dir, args.load_train_model_name)
+			trainer.load_model(teacher_path, load_model_list='encoder')
+			trainer.load_teacher(teacher_path)
+			trainer.switch_loader(data_loader)
+			trainer.train(model_path, args.flag, mode='distill') 	# Distill decoder and generator into the student
 			trainer.reset_keep()
 
 
-	if args.test or args.test_asr or args.cross_test or args.test_single or args.test_encode or args.test_classify or args.encode:
+	if args.make_enc_cache:
+
+		#---encode stage 2 training segments with the frozen encoder---#
+		trainer = get_trainer(args.hps_path, os.path.join(args.ckpt_dir, args.load_train_model_name), args.g_mode, args.enc_mode, None)
+		for index_path, cache_path in zip([args.index_source_path, args.index_target_path], [args.enc_cache_source_path, args.enc_cache_target_path]):
+			encode_for_cache(trainer, Dataset(args.dataset_path, index_path, seg_len=hps.seg_len), cache_path)
+
+
+	if args.test or args.test_asr or args.cross_test or args.test_single or args.test_encode or args.test_classify or args.test_stream or args.check_codes or args.encode or args.export_onnx:
 
 		os.makedirs(args.result_dir, exist_ok=True)
 		if args.ckpt_pth is not None:
 			model_path = args.ckpt_pth
 		else:
 			model_path = os.path.join(args.ckpt_dir, args.load_test_model_name)
-		trainer = get_trainer(args.hps_path, model_path, args.g_mode, args.enc_mode, args.load_tclf_model_name)
+		trainer = get_trainer(args.hps_path, model_path, args.g_mode, args.enc_mode, args.load_tclf_model_name, quantize=args.quantize and not args.quantize_report, student=args.student, deterministic=args.deterministic)
+		if args.student and args.student_report:
+			student_report(trainer, os.path.join(args.ckpt_dir, args.load_train_model_name), load_valid_set(args.dataset_path, args.speaker2id_path, args.valid_dset, hps.seg_len, hps.valid_segments), args.enc_only)
+		if args.quantize and args.quantize_report:
+			quantization_report(trainer, load_valid_set(args.dataset_path, args.speaker2id_path, args.valid_dset, hps.seg_len, hps.valid_segments), args.enc_only)
 
 		if args.test or args.test_asr:
 			result_dir = os.path.join(args.result_dir, args.sub_result_dir)
 			os.makedirs(result_dir, exist_ok=True)
-			test_from_list(trainer, hps.seg_len, args.synthesis_list, args.dataset_path, args.speaker2id_path, result_dir, args.enc_only, run_asr=args.test_asr)
+			test_from_list(trainer, hps.seg_len, args.synthesis_list, args.dataset_path, args.speaker2id_path, result_dir, args.enc_only, run_asr=args.test_asr, batch_size=args.test_batch_size, n_workers=args.vocoder_workers)
 		if args.cross_test:
-			cross_test(trainer, hps.seg_len, args.dataset_path, args.speaker2id_path, args.result_dir, args.enc_only, flag='test')
+			cross_test(trainer, hps.seg_len, args.dataset_path, args.speaker2id_path, args.result_dir, args.enc_only, flag='test', n_workers=args.vocoder_workers)
 		if args.test_single:
 			test_single(trainer, hps.seg_len, args.speaker2id_path, args.result_dir, args.enc_only, args.s_speaker, args.t_speaker)
 		if args.test_encode:
@@ -197,6 +262,13 @@ def main():
 			result_dir = os.path.join(args.result_dir, args.sub_result_dir)
 			os.makedirs(result_dir, exist_ok=True)
 			target_classify(trainer, hps.seg_len, args.synthesis_list, result_dir, flag='test')
+		if args.test_stream:
+			test_stream(trainer, hps.seg_len, args.synthesis_list, args.dataset_path, args.speaker2id_path, args.enc_only, args.stream_hop, args.stream_lookahead)
+		if args.check_codes:
+			check_code_parity(trainer, load_valid_set(args.dataset_path, args.speaker2id_path, args.valid_dset, hps.seg_len, hps.valid_segments), args.enc_only)
+		if args.export_onnx:
+			export_onnx(trainer, args.onnx_path, args.enc_only)
+			check_onnx_parity(trainer, args.onnx_path, load_valid_set(args.dataset_path, args.speaker2id_path, args.valid_dset, hps.seg_len, hps.valid_segments), args.enc_only)
 		if args.encode:
 			if args.encode_t == None:
 				raise RuntimeError('Please specified encode target! (--encode_t=V001 or --encode_t=V002)')
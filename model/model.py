@@ -14,7 +14,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 
 
 def pad_layer(inp, layer, seg_len, is_2d=False):
@@ -40,14 +40,120 @@ def pad_layer(inp, layer, seg_len, is_2d=False):
 	return out
 
 
+def downsample_lengths(lengths, n_strides):
+	# valid lengths after `n_strides` padded stride-2 convolutions
+	for _ in range(n_strides):
+		lengths = (lengths + 1) // 2
+	return lengths
+
+
+def masked_instance_norm(x, lengths, eps=1e-5):
+	# instance norm over the valid time steps only, x: (batch_size, channels, ..., t_step)
+	mask = (torch.arange(x.size(-1), device=x.device)[None, :] < lengths[:, None]).to(x.dtype)
+	mask = mask.view(mask.size(0), *([1] * (x.dim() - 2)), x.size(-1))
+	dims = tuple(range(2, x.dim()))
+	count = mask.sum(dim=dims, keepdim=True) * int(np.prod(x.shape[2:-1]))
+	mean = (x * mask).sum(dim=dims, keepdim=True) / count
+	var = (((x - mean) * mask) ** 2).sum(dim=dims, keepdim=True) / count
+	return (x - mean) / torch.sqrt(var + eps) * mask
+
+
+def pool_to_width(x, width, lengths=None):
+	# adaptive average pooling of the last axis into `width` bins, restricted to the valid time steps
+	if lengths is None:
+		if x.size(-1) == width:
+			return x
+		lengths = torch.full((x.size(0),), x.size(-1), dtype=torch.long, device=x.device)
+	bins = torch.arange(width, device=x.device)
+	start = (bins[None, :] * lengths[:, None]) // width
+	end = ((bins[None, :] + 1) * lengths[:, None] + width - 1) // width
+	steps = torch.arange(x.size(-1), device=x.device)[None, :, None]
+	weight = ((steps >= start[:, None, :]) & (steps < end[:, None, :])).to(x.dtype) # shape: (batch_size, t_step, width)
+	weight = weight / weight.sum(dim=1, keepdim=True)
+	out = torch.bmm(x.reshape(x.size(0), -1, x.size(-1)), weight)
+	return out.view(*x.shape[:-1], width)
+
+
+def run_block(module, block, *inputs):
+	# recompute the block during backward instead of keeping its activations
+	if module.grad_checkpoint and module.training and torch.is_grad_enabled():
+		return checkpoint(block, *inputs, use_reentrant=False)
+	return block(*inputs)
+
+
+class ConvBank(nn.Module):
+	"""
+		Convolutions of several kernel sizes over the same input run as one convolution.
+		The kernels are zero padded to a common width and masked, so outputs and gradients equal those of
+		separate convolutions padded like pad_layer: (k//2, k - 1 - k//2) steps on each side.
+		Output channels are ordered by bank, as if the separate outputs were concatenated.
+		Device types in fused_devices run the single zero padded convolution, the others run each bank on its slice
+		of the fused kernel. Which is faster depends on the device and the shapes, benchmark.py --conv_banks measures both.
+	"""
+	fused_devices = set(['cuda']) # set by main.py --fused_conv_banks
+
+	def __init__(self, c_in, c_out, kernel_sizes, bias=True, pad_mode='reflect'):
+		super(ConvBank, self).__init__()
+		self.kernel_sizes = list(kernel_sizes)
+		self.c_out = c_out
+		self.pad_mode = pad_mode
+		self.left = max([k // 2 for k in self.kernel_sizes])
+		self.right = max([k - 1 - k // 2 for k in self.kernel_sizes])
+		width = self.left + self.right + 1
+		self.weight = nn.Parameter(torch.zeros(c_out * len(self.kernel_sizes), c_in, width))
+		self.bias = nn.Parameter(torch.zeros(c_out * len(self.kernel_sizes))) if bias else None
+		mask = torch.zeros(c_out * len(self.kernel_sizes), 1, width)
+		for i, k in enumerate(self.kernel_sizes):
+			mask[i*c_out:(i+1)*c_out, :, self.left - k//2:self.left - k//2 + k] = 1
+		self.register_buffer('mask', mask, persistent=False)
+		# every bank starts like a nn.Conv1d of its own kernel size
+		convs = [nn.Conv1d(c_in, c_out, kernel_size=k, bias=bias) for k in self.kernel_sizes]
+		weight, fused_bias = self.fuse([conv.weight.data for conv in convs], [conv.bias.data for conv in convs] if bias else None)
+		self.weight.data.copy_(weight)
+		if bias: self.bias.data.copy_(fused_bias)
+
+	def fuse(self, weights, biases=None):
+		# separate (c_out, c_in, k) kernels -> one zero padded (n_banks*c_out, c_in, width) kernel
+		weight = torch.cat([F.pad(w, (self.left - k//2, self.right - (k - 1 - k//2))) for w, k in zip(weights, self.kernel_sizes)], dim=0)
+		bias = torch.cat(biases, dim=0) if biases is not None else None
+		return weight, bias
+
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		# weight-conversion shim for state_dicts saved with a nn.ModuleList of separate convolutions
+		if prefix + '0.weight' in state_dict:
+			n = len(self.kernel_sizes)
+			weights = [state_dict.pop(prefix + '{}.weight'.format(i)) for i in range(n)]
+			biases = [state_dict.pop(prefix + '{}.bias'.format(i)) for i in range(n)] if self.bias is not None else None
+			state_dict[prefix + 'weight'], bias = self.fuse(weights, biases)
+			if bias is not None: state_dict[prefix + 'bias'] = bias
+		super(ConvBank, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+	def forward(self, x, fused=None):
+		# fused: run the single zero padded convolution, by default if the device type of x is in fused_devices
+		x = F.pad(x, pad=(self.left, self.right), mode=self.pad_mode)
+		if fused is None:
+			fused = x.device.type in ConvBank.fused_devices
+		if fused:
+			return F.conv1d(x, self.weight * self.mask, self.bias)
+		# each bank runs on its slice of the fused kernel, over the whole padded input so that it is not copied,
+		# and its valid window is taken by the concatenation
+		outs = []
+		t_step = x.size(2) - self.left - self.right
+		for i, k in enumerate(self.kernel_sizes):
+			start = self.left - k//2
+			bias = self.bias[i*self.c_out:(i+1)*self.c_out] if self.bias is not None else None
+			out = F.conv1d(x, self.weight[i*self.c_out:(i+1)*self.c_out, :, start:start + k], bias)
+			outs.append(out[:, :, start:start + t_step])
+		return torch.cat(outs, dim=1)
+
+
 def pixel_shuffle_1d(inp, upscale_factor=2):
 	batch_size, channels, in_width = inp.size()
 	channels //= upscale_factor
 	
 	out_width = in_width * upscale_factor
-	inp_view = inp.contiguous().view(batch_size, channels, upscale_factor, in_width)
-	shuffle_out = inp_view.permute(0, 1, 3, 2).contiguous()
-	shuffle_out = shuffle_out.view(batch_size, channels, out_width)
+	inp_view = inp.reshape(batch_size, channels, upscale_factor, in_width)
+	shuffle_out = inp_view.transpose(2, 3).reshape(batch_size, channels, out_width) # the only copy
 	return shuffle_out
 
 
@@ -56,33 +162,51 @@ def upsample(x, scale_factor=2):
 	return x_up
 
 
+"""
+	The dense and rnn layers work on channels-last (batch_size, t_step, channels) tensors,
+	so that nn.Linear and the batch_first GRUs consume them without permuting,
+	while the convolutions keep the channels-first (batch_size, channels, t_step) layout.
+	Each model switches to channels-last once after its conv layers, and returns channels-first views.
+"""
+def to_channels_last(inp):
+	return inp.transpose(1, 2).contiguous()
+
+
 def RNN(inp, layer):
-	inp_permuted = inp.permute(2, 0, 1)
-	state_mul = (int(layer.bidirectional) + 1) * layer.num_layers
-	zero_state = Variable(torch.zeros(state_mul, inp.size(0), layer.hidden_size))
-	zero_state = zero_state.cuda() if torch.cuda.is_available() else zero_state
-	out_permuted, _ = layer(inp_permuted, zero_state)
-	out_rnn = out_permuted.permute(1, 2, 0)
+	# inp: (batch_size, t_step, channels), layer: a batch_first rnn, its zero initial state is made on the input's device
+	out_rnn, _ = layer(inp)
 	return out_rnn
 
 
-def linear(inp, layer):
-	batch_size = inp.size(0)
-	hidden_dim = inp.size(1)
-	seg_len = inp.size(2)
-	inp_permuted = inp.permute(0, 2, 1)
-	inp_expand = inp_permuted.contiguous().view(batch_size*seg_len, hidden_dim)
-	out_expand = layer(inp_expand)
-	out_permuted = out_expand.view(batch_size, seg_len, out_expand.size(1))
-	out = out_permuted.permute(0, 2, 1)
-	return out
+def instance_norm(inp, layer):
+	# nn.InstanceNorm1d over the t_step axis of a channels-last input, without transposing it
+	mean = inp.mean(dim=1, keepdim=True)
+	var = inp.var(dim=1, unbiased=False, keepdim=True)
+	return (inp - mean) / torch.sqrt(var + layer.eps)
+
+
+def append_emb(emb, outputs):
+	# concatenates channels-last outputs and the embedding repeated over t_step in a single copy
+	emb_expand = emb.unsqueeze(dim=1).expand(emb.size(0), outputs[0].size(1), emb.size(1))
+	return torch.cat(outputs + [emb_expand], dim=2)
+
+
+"""
+	Integer codes of binary encodings, one per encoding step, with the first unit as the most significant bit:
+	the unit string of a step written by convert.write_encodings read as a binary number,
+	and the bit order of dataloader.pack_encodings.
+"""
+def pack_codes(enc):
+	# enc: (batch_size, enc_size, t_step) binary encodings -> (batch_size, t_step) integer codes
+	shifts = torch.arange(enc.size(1) - 1, -1, -1, device=enc.device)
+	return ((enc > 0.5).long() << shifts.view(1, -1, 1)).sum(dim=1)
 
 
-def append_emb(emb, expand_size, output):
-	emb = emb.unsqueeze(dim=2)
-	emb_expand = emb.expand(emb.size(0), emb.size(1), expand_size)
-	output = torch.cat([output, emb_expand], dim=1)
-	return output
+def code_bits(enc_size, device=None):
+	# all 2^enc_size binary encodings, code i in row i: (2^enc_size, enc_size)
+	codes = torch.arange(2 ** enc_size, device=device)
+	shifts = torch.arange(enc_size - 1, -1, -1, device=device)
+	return ((codes.view(-1, 1) >> shifts.view(1, -1)) & 1).float()
 
 
 """
@@ -90,12 +214,15 @@ def append_emb(emb, expand_size, output):
 	input: [*, n_class]
 	return: [*, n_class] an one-hot vector
 """
-def gumbel_softmax(logits, temperature=0.1):
+def gumbel_softmax(logits, temperature=0.1, sample=True):
 	
+	if not sample:
+		return hard_argmax(logits)
+
 	def _sample_gumbel(shape, eps=1e-20):
-		U = torch.rand(shape, requires_grad=True)
-		dist = -Variable(torch.log(-torch.log(U + eps) + eps))
-		return dist.cuda() if torch.cuda.is_available() else dist
+		U = torch.rand(shape, device=logits.device) # drawn where the logits are
+		dist = -torch.log(-torch.log(U + eps) + eps)
+		return dist
 
 	def _gumbel_softmax_sample(logits, temperature):
 		y = logits + _sample_gumbel(logits.size())
@@ -110,6 +237,11 @@ def gumbel_softmax(logits, temperature=0.1):
 	return (y_hard - y).detach() + y
 
 
+def hard_argmax(logits):
+	# the one-hot vector of the largest logit, gumbel_softmax without noise: deterministic and allocating only the output
+	return torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.)
+
+
 class PatchDiscriminator(nn.Module):
 	def __init__(self, n_class=33, ns=0.2, dp=0.1, seg_len=128):
 		super(PatchDiscriminator, self).__init__()
@@ -121,17 +253,11 @@ class PatchDiscriminator(nn.Module):
 		self.conv4 = nn.Conv2d(256, 512, kernel_size=5, stride=2)
 		self.conv5 = nn.Conv2d(512, 512, kernel_size=5, stride=2)
 		self.conv6 = nn.Conv2d(512, 32, kernel_size=1)
-		if self.seg_len == 128:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 4))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 4))
-		elif self.seg_len == 64:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 2))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 2))
-		elif self.seg_len == 32:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 1))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 1))
-		else:
-			raise NotImplementedError('Segement length {} is not supported!'.format(seg_len))
+		# the output layers see the feature map pooled to the width of a seg_len input (4 for 128 frames),
+		# so inputs of any length are accepted and seg_len inputs are computed exactly as before
+		self.out_width = max(seg_len // 32, 1)
+		self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, self.out_width))
+		self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, self.out_width))
 		self.drop1 = nn.Dropout2d(p=dp)
 		self.drop2 = nn.Dropout2d(p=dp)
 		self.drop3 = nn.Dropout2d(p=dp)
@@ -145,21 +271,27 @@ class PatchDiscriminator(nn.Module):
 		self.ins_norm5 = nn.InstanceNorm2d(self.conv5.out_channels)
 		self.ins_norm6 = nn.InstanceNorm2d(self.conv6.out_channels)
 
-	def conv_block(self, x, conv_layer, after_layers):
+	def conv_block(self, x, conv_layer, after_layers, lengths=None):
 		out = pad_layer(x, conv_layer, self.seg_len, is_2d=True)
 		out = F.leaky_relu(out, negative_slope=self.ns)
 		for layer in after_layers:
-			out = layer(out)
+			if lengths is not None and isinstance(layer, nn.InstanceNorm2d):
+				out = masked_instance_norm(out, lengths)
+			else:
+				out = layer(out)
 		return out 
 
-	def forward(self, x, classify=False):
+	def forward(self, x, classify=False, lengths=None):
+		# lengths: valid frames of each input in a zero padded batch, None if all are full length
+		lens = [None] * 6 if lengths is None else [downsample_lengths(lengths, n) for n in [1, 2, 3, 4, 5, 5]]
 		x = torch.unsqueeze(x, dim=1)
-		out = self.conv_block(x, self.conv1, [self.ins_norm1, self.drop1])
-		out = self.conv_block(out, self.conv2, [self.ins_norm2, self.drop2])
-		out = self.conv_block(out, self.conv3, [self.ins_norm3, self.drop3])
-		out = self.conv_block(out, self.conv4, [self.ins_norm4, self.drop4])
-		out = self.conv_block(out, self.conv5, [self.ins_norm5, self.drop5])
-		out = self.conv_block(out, self.conv6, [self.ins_norm6, self.drop6])
+		out = self.conv_block(x, self.conv1, [self.ins_norm1, self.drop1], lens[0])
+		out = self.conv_block(out, self.conv2, [self.ins_norm2, self.drop2], lens[1])
+		out = self.conv_block(out, self.conv3, [self.ins_norm3, self.drop3], lens[2])
+		out = self.conv_block(out, self.conv4, [self.ins_norm4, self.drop4], lens[3])
+		out = self.conv_block(out, self.conv5, [self.ins_norm5, self.drop5], lens[4])
+		out = self.conv_block(out, self.conv6, [self.ins_norm6, self.drop6], lens[5])
+		out = pool_to_width(out, self.out_width, lens[5])
 		# GAN output value
 		val = self.conv7(out)
 		val = val.view(val.size(0), -1)
@@ -184,17 +316,11 @@ class TargetClassifier(nn.Module):
 		self.conv4 = nn.Conv2d(256, 512, kernel_size=5, stride=2)
 		self.conv5 = nn.Conv2d(512, 512, kernel_size=5, stride=2)
 		self.conv6 = nn.Conv2d(512, 32, kernel_size=1)
-		if self.seg_len == 128:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 4))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 4))
-		elif self.seg_len == 64:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 2))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 2))
-		elif self.seg_len == 32:
-			self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, 1))
-			self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, 1))
-		else:
-			raise NotImplementedError('Segement length {} is not supported!'.format(seg_len))
+		# the output layers see the feature map pooled to the width of a seg_len input (4 for 128 frames),
+		# so inputs of any length are accepted and seg_len inputs are computed exactly as before
+		self.out_width = max(seg_len // 32, 1)
+		self.conv7 = nn.Conv2d(32, 1, kernel_size=(17, self.out_width))
+		self.conv_classify = nn.Conv2d(32, n_class, kernel_size=(17, self.out_width))
 		self.drop1 = nn.Dropout2d(p=dp)
 		self.drop2 = nn.Dropout2d(p=dp)
 		self.drop3 = nn.Dropout2d(p=dp)
@@ -208,21 +334,27 @@ class TargetClassifier(nn.Module):
 		self.ins_norm5 = nn.InstanceNorm2d(self.conv5.out_channels)
 		self.ins_norm6 = nn.InstanceNorm2d(self.conv6.out_channels)
 
-	def conv_block(self, x, conv_layer, after_layers):
+	def conv_block(self, x, conv_layer, after_layers, lengths=None):
 		out = pad_layer(x, conv_layer, self.seg_len, is_2d=True)
 		out = F.leaky_relu(out, negative_slope=self.ns)
 		for layer in after_layers:
-			out = layer(out)
+			if lengths is not None and isinstance(layer, nn.InstanceNorm2d):
+				out = masked_instance_norm(out, lengths)
+			else:
+				out = layer(out)
 		return out 
 
-	def forward(self, x):
+	def forward(self, x, lengths=None):
+		# lengths: valid frames of each input in a zero padded batch, None if all are full length
+		lens = [None] * 6 if lengths is None else [downsample_lengths(lengths, n) for n in [1, 2, 3, 4, 5, 5]]
 		x = torch.unsqueeze(x, dim=1)
-		out = self.conv_block(x, self.conv1, [self.ins_norm1, self.drop1])
-		out = self.conv_block(out, self.conv2, [self.ins_norm2, self.drop2])
-		out = self.conv_block(out, self.conv3, [self.ins_norm3, self.drop3])
-		out = self.conv_block(out, self.conv4, [self.ins_norm4, self.drop4])
-		out = self.conv_block(out, self.conv5, [self.ins_norm5, self.drop5])
-		out = self.conv_block(out, self.conv6, [self.ins_norm6, self.drop6])
+		out = self.conv_block(x, self.conv1, [self.ins_norm1, self.drop1], lens[0])
+		out = self.conv_block(out, self.conv2, [self.ins_norm2, self.drop2], lens[1])
+		out = self.conv_block(out, self.conv3, [self.ins_norm3, self.drop3], lens[2])
+		out = self.conv_block(out, self.conv4, [self.ins_norm4, self.drop4], lens[3])
+		out = self.conv_block(out, self.conv5, [self.ins_norm5, self.drop5], lens[4])
+		out = self.conv_block(out, self.conv6, [self.ins_norm6, self.drop6], lens[5])
+		out = pool_to_width(out, self.out_width, lens[5])
 		logits = self.conv_classify(out)
 		logits = logits.view(logits.size(0), -1)
 		return logits
@@ -242,14 +374,9 @@ class SpeakerClassifier(nn.Module):
 		self.conv6 = nn.Conv1d(c_h, c_h, kernel_size=5)
 		self.conv7 = nn.Conv1d(c_h, c_h//2, kernel_size=3)
 		self.conv8 = nn.Conv1d(c_h//2, c_h//4, kernel_size=3)
-		if self.seg_len == 128:
-			self.conv9 = nn.Conv1d(c_h//4, n_class, kernel_size=16)
-		elif self.seg_len == 64:
-			self.conv9 = nn.Conv1d(c_h//4, n_class, kernel_size=8)
-		elif self.seg_len == 32:
-			self.conv9 = nn.Conv1d(c_h//4, n_class, kernel_size=4)
-		else:
-			raise NotImplementedError('Segement length {} is not supported!'.format(seg_len))
+		# inputs of any length are pooled to the encoding length of a seg_len segment (16 for 128 frames)
+		self.out_width = max(seg_len // 8, 1)
+		self.conv9 = nn.Conv1d(c_h//4, n_class, kernel_size=self.out_width)
 		self.drop1 = nn.Dropout(p=dp)
 		self.drop2 = nn.Dropout(p=dp)
 		self.drop3 = nn.Dropout(p=dp)
@@ -259,52 +386,61 @@ class SpeakerClassifier(nn.Module):
 		self.ins_norm3 = nn.InstanceNorm1d(c_h)
 		self.ins_norm4 = nn.InstanceNorm1d(c_h//4)
 
-	def conv_block(self, x, conv_layers, after_layers, res=True):
+	def conv_block(self, x, conv_layers, after_layers, res=True, lengths=None):
 		out = x
 		for layer in conv_layers:
 			out = pad_layer(out, layer, self.seg_len)
 			out = F.leaky_relu(out, negative_slope=self.ns)
 		for layer in after_layers:
-			out = layer(out)
+			if lengths is not None and isinstance(layer, nn.InstanceNorm1d):
+				out = masked_instance_norm(out, lengths)
+			else:
+				out = layer(out)
 		if res:
 			out = out + x
 		return out
 
-	def forward(self, x):
-		out = self.conv_block(x, [self.conv1, self.conv2], [self.ins_norm1, self.drop1], res=False)
-		out = self.conv_block(out, [self.conv3, self.conv4], [self.ins_norm2, self.drop2], res=True)
-		out = self.conv_block(out, [self.conv5, self.conv6], [self.ins_norm3, self.drop3], res=True)
-		out = self.conv_block(out, [self.conv7, self.conv8], [self.ins_norm4, self.drop4], res=False)
+	def forward(self, x, lengths=None):
+		# lengths: valid encoding steps of each input in a zero padded batch, None if all are full length
+		out = self.conv_block(x, [self.conv1, self.conv2], [self.ins_norm1, self.drop1], res=False, lengths=lengths)
+		out = self.conv_block(out, [self.conv3, self.conv4], [self.ins_norm2, self.drop2], res=True, lengths=lengths)
+		out = self.conv_block(out, [self.conv5, self.conv6], [self.ins_norm3, self.drop3], res=True, lengths=lengths)
+		out = self.conv_block(out, [self.conv7, self.conv8], [self.ins_norm4, self.drop4], res=False, lengths=lengths)
+		out = pool_to_width(out, self.out_width, lengths)
 		out = self.conv9(out)
 		out = out.view(out.size()[0], -1)
 		return out
 
 
 class Decoder(nn.Module):
-	def __init__(self, c_in=512, c_out=513, c_h=512, c_a=8, ns=0.2, seg_len=64, output_mask=False):
+	def __init__(self, c_in=512, c_out=513, c_h=512, c_a=8, ns=0.2, seg_len=64, output_mask=False, n_dense_blocks=2, grad_checkpoint=False):
 		super(Decoder, self).__init__()
 		self.output_mask = output_mask
 		self.ns = ns
 		self.seg_len = seg_len
+		self.n_dense_blocks = n_dense_blocks # 0 to 2, compact students use fewer
+		self.grad_checkpoint = grad_checkpoint
 		self.conv1 = nn.Conv1d(c_h, 2*c_h, kernel_size=3)
 		self.conv2 = nn.Conv1d(c_h, c_h, kernel_size=3)
 		self.conv3 = nn.Conv1d(c_h, 2*c_h, kernel_size=3)
 		self.conv4 = nn.Conv1d(c_h, c_h, kernel_size=3)
 		self.conv5 = nn.Conv1d(c_h, 2*c_h, kernel_size=3)
 		self.conv6 = nn.Conv1d(c_h, c_h, kernel_size=3)
-		self.dense1 = nn.Linear(c_h, c_h)
-		self.dense2 = nn.Linear(c_h, c_h)
-		self.dense3 = nn.Linear(c_h, c_h)
-		self.dense4 = nn.Linear(c_h, c_h)
-		self.RNN = nn.GRU(input_size=c_h, hidden_size=c_h//2, num_layers=1, bidirectional=True)
+		if n_dense_blocks > 0:
+			self.dense1 = nn.Linear(c_h, c_h)
+			self.dense2 = nn.Linear(c_h, c_h)
+			self.ins_norm4 = nn.InstanceNorm1d(c_h)
+		if n_dense_blocks > 1:
+			self.dense3 = nn.Linear(c_h, c_h)
+			self.dense4 = nn.Linear(c_h, c_h)
+			self.ins_norm5 = nn.InstanceNorm1d(c_h)
+		self.RNN = nn.GRU(input_size=c_h, hidden_size=c_h//2, num_layers=1, bidirectional=True, batch_first=True)
 		self.dense5 = nn.Linear(2*c_h + c_h, c_h)
 		self.linear = nn.Linear(c_h, c_out)
 		# normalization layer
 		self.ins_norm1 = nn.InstanceNorm1d(c_h)
 		self.ins_norm2 = nn.InstanceNorm1d(c_h)
 		self.ins_norm3 = nn.InstanceNorm1d(c_h)
-		self.ins_norm4 = nn.InstanceNorm1d(c_h)
-		self.ins_norm5 = nn.InstanceNorm1d(c_h)
 		# embedding layer
 		self.input_emb = nn.Linear(c_in, c_h)
 		self.emb1 = nn.Embedding(c_a, c_h)
@@ -313,6 +449,26 @@ class Decoder(nn.Module):
 		self.emb4 = nn.Embedding(c_a, c_h)
 		self.emb5 = nn.Embedding(c_a, c_h)
 		self.mask = nn.Tanh()
+		# input projections of all 2^c_in binary codes, built once at test time, see code_table()
+		self.cached_code_table = None
+
+	def train(self, mode=True):
+		# eval() lands here as well, the weights may have changed since the table was built
+		self.cached_code_table = None
+		return super(Decoder, self).train(mode)
+
+	def load_state_dict(self, *args, **kwargs):
+		self.cached_code_table = None
+		return super(Decoder, self).load_state_dict(*args, **kwargs)
+
+	def code_table(self, device):
+		# training keeps the gradients of input_emb, in eval mode the table is kept until the weights change
+		if self.training:
+			return self.input_emb(code_bits(self.input_emb.in_features, device=device))
+		if self.cached_code_table is None or self.cached_code_table.device != device:
+			with torch.no_grad():
+				self.cached_code_table = self.input_emb(code_bits(self.input_emb.in_features, device=device))
+		return self.cached_code_table
 
 	def conv_block(self, x, conv_layers, norm_layer, emb, res=True):
 		# first layer
@@ -331,51 +487,64 @@ class Decoder(nn.Module):
 		return out
 
 	def dense_block(self, x, emb, layers, norm_layer, res=True):
+		# channels-last
 		out = x
 		for layer in layers:
-			out = out + emb.view(emb.size(0), emb.size(1), 1)
-			out = linear(out, layer)
+			out = out + emb.unsqueeze(dim=1)
+			out = layer(out)
 			out = F.leaky_relu(out, negative_slope=self.ns)
-		out = norm_layer(out)
+		out = instance_norm(out, norm_layer)
 		if res:
 			out = out + x
 		return out
 
-	def forward(self, x, c):
+	def rnn_block(self, x, emb):
+		# channels-last
+		out_add = x + emb.unsqueeze(dim=1)
+		out_rnn = RNN(out_add, self.RNN)
+		return append_emb(emb, [x, out_rnn])
+
+	def forward(self, x, c, codes=None):
+		# input layer, x: (batch_size, c_in, t_step), its output is made channels-first for the conv layers
+		if codes is not None:
+			# binary encodings given as pack_codes() integers: look up the projections of all 2^c_in encodings instead
+			x = F.embedding(codes, self.code_table(codes.device))
+		else:
+			x = self.input_emb(x.transpose(1, 2))
+		x = x.transpose(1, 2).contiguous()
 		# conv layer
-		out = self.conv_block(linear(x, self.input_emb), [self.conv1, self.conv2], self.ins_norm1, self.emb1(c), res=True)
-		out = self.conv_block(out, [self.conv3, self.conv4], self.ins_norm2, self.emb2(c), res=True)
-		out = self.conv_block(out, [self.conv5, self.conv6], self.ins_norm3, self.emb3(c), res=True)
+		out = run_block(self, lambda x, emb: self.conv_block(x, [self.conv1, self.conv2], self.ins_norm1, emb, res=True), x, self.emb1(c))
+		out = run_block(self, lambda x, emb: self.conv_block(x, [self.conv3, self.conv4], self.ins_norm2, emb, res=True), out, self.emb2(c))
+		out = run_block(self, lambda x, emb: self.conv_block(x, [self.conv5, self.conv6], self.ins_norm3, emb, res=True), out, self.emb3(c))
+		out = to_channels_last(out)
 		# dense layer
-		out = self.dense_block(out, self.emb4(c), [self.dense1, self.dense2], self.ins_norm4, res=True)
-		out = self.dense_block(out, self.emb4(c), [self.dense3, self.dense4], self.ins_norm5, res=True)
-		emb = self.emb5(c)
-		out_add = out + emb.view(emb.size(0), emb.size(1), 1)
+		if self.n_dense_blocks > 0:
+			out = run_block(self, lambda x, emb: self.dense_block(x, emb, [self.dense1, self.dense2], self.ins_norm4, res=True), out, self.emb4(c))
+		if self.n_dense_blocks > 1:
+			out = run_block(self, lambda x, emb: self.dense_block(x, emb, [self.dense3, self.dense4], self.ins_norm5, res=True), out, self.emb4(c))
 		# rnn layer
-		out_rnn = RNN(out_add, self.RNN)
-		out = torch.cat([out, out_rnn], dim=1)
-		out = append_emb(self.emb5(c), out.size(2), out)
-		out = linear(out, self.dense5)
+		out = run_block(self, self.rnn_block, out, self.emb5(c))
+		out = self.dense5(out)
 		out = F.leaky_relu(out, negative_slope=self.ns)
-		out = linear(out, self.linear)
+		out = self.linear(out)
 		if self.output_mask:
 			out = self.mask(out)
 		else:
 			out = torch.sigmoid(out)
-		return out
+		return out.transpose(1, 2) # shape: (batch_size, c_out, t_step)
 
 
 class Encoder(nn.Module):
-	def __init__(self, c_in=513, c_h1=128, c_h2=512, c_h3=128, ns=0.2, dp=0.5, enc_size=512, seg_len=64, enc_mode='continues'):
+	def __init__(self, c_in=513, c_h1=128, c_h2=512, c_h3=128, ns=0.2, dp=0.5, enc_size=512, seg_len=64, enc_mode='continues', grad_checkpoint=False):
 		super(Encoder, self).__init__()
 		self.ns = ns
 		self.enc_size = enc_size
 		self.seg_len = seg_len
 		self.enc_mode = enc_mode
-		self.conv1s = nn.ModuleList(
-				[nn.Conv1d(c_in, c_h1, kernel_size=k) for k in range(1, 8)]
-			)
-		self.conv2 = nn.Conv1d(len(self.conv1s)*c_h1 + c_in, c_h2, kernel_size=1)
+		self.grad_checkpoint = grad_checkpoint
+		self.sample = True # gumbel noise on the encodings in eval mode, without it they are the argmax of the logits
+		self.conv1s = ConvBank(c_in, c_h1, kernel_sizes=range(1, 8), pad_mode='constant' if seg_len < 64 else 'reflect')
+		self.conv2 = nn.Conv1d(len(self.conv1s.kernel_sizes)*c_h1 + c_in, c_h2, kernel_size=1)
 		self.conv3 = nn.Conv1d(c_h2, c_h2, kernel_size=5)
 		self.conv4 = nn.Conv1d(c_h2, c_h2, kernel_size=5, stride=2)
 		self.conv5 = nn.Conv1d(c_h2, c_h2, kernel_size=5)
@@ -386,7 +555,7 @@ class Encoder(nn.Module):
 		self.dense2 = nn.Linear(c_h2, c_h2)
 		self.dense3 = nn.Linear(c_h2, c_h2)
 		self.dense4 = nn.Linear(c_h2, c_h2)
-		self.RNN = nn.GRU(input_size=c_h2, hidden_size=c_h3, num_layers=1, bidirectional=True)
+		self.RNN = nn.GRU(input_size=c_h2, hidden_size=c_h3, num_layers=1, bidirectional=True, batch_first=True)
 		
 		if self.enc_mode == 'binary':
 			self.linear = nn.Linear(c_h2 + 2*c_h3, enc_size * enc_size)
@@ -427,74 +596,74 @@ class Encoder(nn.Module):
 		return out
 
 	def dense_block(self, x, layers, norm_layers, res=True):
+		# channels-last
 		out = x
 		for layer in layers:
-			out = linear(out, layer)
+			out = layer(out)
 			out = F.leaky_relu(out, negative_slope=self.ns)
 		for layer in norm_layers:
-			out = layer(out)
+			out = instance_norm(out, layer) if isinstance(layer, nn.InstanceNorm1d) else layer(out)
 		if res:
 			out = out + x
 		return out
 
-	def forward(self, x):
-		outs = []
-		for l in self.conv1s:
-			out = pad_layer(x, l, self.seg_len)
-			outs.append(out)
-		out = torch.cat(outs + [x], dim=1)
+	def bank_block(self, x):
+		out = torch.cat([self.conv1s(x), x], dim=1)
 		out = F.leaky_relu(out, negative_slope=self.ns)
-		out = self.conv_block(out, [self.conv2], [self.ins_norm1, self.drop1], self.seg_len, res=False)
-		out = self.conv_block(out, [self.conv3, self.conv4], [self.ins_norm2, self.drop2], self.seg_len)
-		out = self.conv_block(out, [self.conv5, self.conv6], [self.ins_norm3, self.drop3], self.seg_len)
-		out = self.conv_block(out, [self.conv7, self.conv8], [self.ins_norm4, self.drop4], self.seg_len)
+		return self.conv_block(out, [self.conv2], [self.ins_norm1, self.drop1], self.seg_len, res=False)
+
+	def rnn_block(self, x):
+		# channels-last
+		out_rnn = RNN(x, self.RNN)
+		return torch.cat([x, out_rnn], dim=2)
+
+	def forward(self, x):
+		out = run_block(self, self.bank_block, x)
+		out = run_block(self, lambda x: self.conv_block(x, [self.conv3, self.conv4], [self.ins_norm2, self.drop2], self.seg_len), out)
+		out = run_block(self, lambda x: self.conv_block(x, [self.conv5, self.conv6], [self.ins_norm3, self.drop3], self.seg_len), out)
+		out = run_block(self, lambda x: self.conv_block(x, [self.conv7, self.conv8], [self.ins_norm4, self.drop4], self.seg_len), out)
+		out = to_channels_last(out)
 		# dense layer
-		out = self.dense_block(out, [self.dense1, self.dense2], [self.ins_norm5, self.drop5], res=True)
-		out = self.dense_block(out, [self.dense3, self.dense4], [self.ins_norm6, self.drop6], res=True)
-		out_rnn = RNN(out, self.RNN)
-		out = torch.cat([out, out_rnn], dim=1)
+		out = run_block(self, lambda x: self.dense_block(x, [self.dense1, self.dense2], [self.ins_norm5, self.drop5], res=True), out)
+		out = run_block(self, lambda x: self.dense_block(x, [self.dense3, self.dense4], [self.ins_norm6, self.drop6], res=True), out)
+		out = run_block(self, self.rnn_block, out)
 		
+		out = self.linear(out) # shape: (batch_size, t_step, enc_size or enc_size^2 or enc_size*2)
+		sample = self.sample or self.training
+
 		if self.enc_mode == 'continues':
-			out = linear(out, self.linear)
 			out_act = F.leaky_relu(out, negative_slope=self.ns)
 		
 		elif self.enc_mode == 'one_hot':
-			out = linear(out, self.linear)
-			out_act = gumbel_softmax(out.permute(0, 2, 1))
-			out_act = out_act.permute(0, 2, 1).contiguous()
+			out_act = gumbel_softmax(out, sample=sample)
 		
 		elif self.enc_mode == 'binary':
-			out = linear(out, self.linear)
-			out_proj = out.permute(0, 2, 1) # shape: (batch_size, t_step, enc_size^2)
-			out_proj = out_proj.view(out_proj.size(0), out_proj.size(1), self.enc_size, self.enc_size) # shape: (batch_size, t_step, enc_size, enc_size)
-			out_act = gumbel_softmax(out_proj).sum(2).view(out_proj.size(0), out_proj.size(1), -1) # shape: (batch_size, t_step, enc_size)
+			out_proj = out.view(out.size(0), out.size(1), self.enc_size, self.enc_size) # shape: (batch_size, t_step, enc_size, enc_size)
+			out_act = gumbel_softmax(out_proj, sample=sample).sum(2).view(out_proj.size(0), out_proj.size(1), -1) # shape: (batch_size, t_step, enc_size)
 			out_act = torch.clamp(out_act, min=0, max=1) # binarize output
-			out_act = out_act.permute(0, 2, 1).contiguous() # shape: (batch_size, enc_size, t_step)
 		
 		elif self.enc_mode == 'multilabel_binary':
-			out = linear(out, self.linear) # shape: (batch_size, enc_size*2, t_step)
-			out_proj = out.permute(0, 2, 1) # shape: (batch_size, t_step, enc_size*2)
-			out_proj = out_proj.view(out_proj.size(0), out_proj.size(1), self.enc_size, 2) # shape: (batch_size, t_step, enc_size, 2)
-			out_act = gumbel_softmax(out_proj)[:, :, :, 0] # shape: (batch_size, t_step, enc_size, 1)
-			out_act = out_act.view(out_act.size(0), out_act.size(1), self.enc_size) # shape: (batch_size, t_step, enc_size)
-			out_act = out_act.permute(0, 2, 1).contiguous() # shape: (batch_size, enc_size, t_step)
+			out_proj = out.view(out.size(0), out.size(1), self.enc_size, 2) # shape: (batch_size, t_step, enc_size, 2)
+			if sample:
+				out_act = gumbel_softmax(out_proj)[:, :, :, 0] # shape: (batch_size, t_step, enc_size)
+			else:
+				out_act = (out_proj[:, :, :, 0] >= out_proj[:, :, :, 1]).to(out.dtype) # the unit is on where argmax picks the first logit
 
 		elif self.enc_mode == 'gumbel_t':
-			out = linear(out, self.linear)
-			out_act = gumbel_softmax(out)
+			out_act = gumbel_softmax(out.transpose(1, 2), sample=sample).transpose(1, 2) # over t_step
 
 		else:
 			raise NotImplementedError('Invalid encoding mode!')
 		
-		return out_act, out
+		return out_act.transpose(1, 2), out.transpose(1, 2) # shape: (batch_size, enc_size, t_step)
 
 
 class Enhanced_Generator(nn.Module):
-	def __init__(self, ns, dp, enc_size, emb_size, seg_len, n_speakers):
+	def __init__(self, ns, dp, enc_size, emb_size, seg_len, n_speakers, grad_checkpoint=False):
 		super(Enhanced_Generator, self).__init__()
 		
-		self.Encoder = Encoder(ns=ns, dp=dp, enc_size=enc_size, seg_len=seg_len, enc_mode='continues')
-		self.Decoder = Decoder(ns=ns, c_in=enc_size, c_h=emb_size, c_a=n_speakers, seg_len=seg_len)
+		self.Encoder = Encoder(ns=ns, dp=dp, enc_size=enc_size, seg_len=seg_len, enc_mode='continues', grad_checkpoint=grad_checkpoint)
+		self.Decoder = Decoder(ns=ns, c_in=enc_size, c_h=emb_size, c_a=n_speakers, seg_len=seg_len, grad_checkpoint=grad_checkpoint)
 
 	def forward(self, x, c):
 		enc_act, enc = self.Encoder(x)
@@ -512,7 +681,7 @@ class Spectrogram_Patcher(nn.Module):
 		self.dense2 = nn.Linear(c_h, c_h)
 		self.dense3 = nn.Linear(c_h, c_h)
 		self.dense4 = nn.Linear(c_h, c_h)
-		self.RNN = nn.GRU(input_size=c_h, hidden_size=c_h//2, num_layers=1, bidirectional=True)
+		self.RNN = nn.GRU(input_size=c_h, hidden_size=c_h//2, num_layers=1, bidirectional=True, batch_first=True)
 		self.dense5 = nn.Linear(2*c_h + c_h, c_h)
 		self.linear = nn.Linear(c_h, c_out)
 		# normalization layer
@@ -523,30 +692,30 @@ class Spectrogram_Patcher(nn.Module):
 		self.emb2 = nn.Embedding(c_a, c_h)
 
 	def dense_block(self, x, emb, layers, norm_layer, res=True):
+		# channels-last
 		out = x
 		for layer in layers:
-			out = out + emb.view(emb.size(0), emb.size(1), 1)
-			out = linear(out, layer)
+			out = out + emb.unsqueeze(dim=1)
+			out = layer(out)
 			out = F.leaky_relu(out, negative_slope=self.ns)
-		out = norm_layer(out)
+		out = instance_norm(out, norm_layer)
 		if res:
 			out = out + x
 		return out
 
 	def forward(self, x, c):
-		# input layer
-		out = linear(x, self.input_layer)
+		# input layer, x: (batch_size, c_in, t_step)
+		out = self.input_layer(x.transpose(1, 2))
 		# dense layer
 		out = self.dense_block(out, self.emb1(c), [self.dense1, self.dense2], self.ins_norm1, res=True)
 		out = self.dense_block(out, self.emb1(c), [self.dense3, self.dense4], self.ins_norm2, res=True)
 		emb = self.emb2(c)
-		out_add = out + emb.view(emb.size(0), emb.size(1), 1)
+		out_add = out + emb.unsqueeze(dim=1)
 		# rnn layer
 		out_rnn = RNN(out_add, self.RNN)
-		out = torch.cat([out, out_rnn], dim=1)
-		out = append_emb(self.emb2(c), out.size(2), out)
-		out = linear(out, self.dense5)
+		out = append_emb(emb, [out, out_rnn])
+		out = self.dense5(out)
 		out = F.leaky_relu(out, negative_slope=self.ns)
-		out = linear(out, self.linear)
+		out = self.linear(out)
 		out = torch.sigmoid(out)
-		return out		
+		return out.transpose(1, 2) # shape: (batch_size, c_out, t_step)		
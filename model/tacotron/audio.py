@@ -16,6 +16,7 @@ import librosa
 import librosa.filters
 from scipy import signal
 from model.tacotron.config import config
+from model.vocoder import GriffinLim
 from scipy.io import wavfile
 
 
@@ -71,18 +72,17 @@ def find_endpoint(wav, threshold_db=-40, min_silence_sec=0.8):
 	return len(wav)
 
 
+_vocoder = None
+
 def _griffin_lim(S):
 	"""
-		librosa implementation of Griffin-Lim
-		Based on https://github.com/librosa/librosa/issues/434
+		Griffin-Lim from random phase, with the batched vocoder of model/vocoder.py
 	"""
-	angles = np.exp(2j * np.pi * np.random.rand(*S.shape))
-	S_complex = np.abs(S).astype(np.complex)
-	y = _istft(S_complex * angles)
-	for i in range(config.griffin_lim_iters):
-		angles = np.exp(1j * np.angle(_stft(y)))
-		y = _istft(S_complex * angles)
-	return y
+	global _vocoder
+	if _vocoder is None:
+		n_fft, hop_length, win_length = _stft_parameters()
+		_vocoder = GriffinLim(n_fft, hop_length, win_length, config.griffin_lim_iters, random_phase=True)
+	return _vocoder([np.abs(S).astype(np.float32)])[0]
 
 
 def _stft(y):
@@ -16,6 +16,7 @@ from torch.autograd import Variable
 from model.tacotron.attention import BahdanauAttention, LocationSensitiveAttention
 from model.tacotron.attention import AttentionRNN
 from model.tacotron.loss import get_rnn_mask_from_lengths
+from model.model import ConvBank
 
 
 ##########
@@ -62,6 +63,36 @@ class BatchNormConv1d(nn.Module):
 		return self.bn(x)
 
 
+##########################
+# BATCH NORM CONV1D BANK #
+##########################
+class BatchNormConv1dBank(nn.Module):
+	
+	def __init__(self, in_dim, out_dim, kernel_sizes, activation=None):
+
+		super(BatchNormConv1dBank, self).__init__()
+		self.conv1d = ConvBank(in_dim, out_dim, kernel_sizes, bias=False, pad_mode='constant') # one convolution for all kernel sizes
+		self.bn = nn.BatchNorm1d(out_dim * len(self.conv1d.kernel_sizes), momentum=0.99, eps=1e-3)
+		self.activation = activation
+
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		# weight-conversion shim for state_dicts saved with a nn.ModuleList of BatchNormConv1d
+		if prefix + '0.conv1d.weight' in state_dict:
+			n = len(self.conv1d.kernel_sizes)
+			state_dict[prefix + 'conv1d.weight'], _ = self.conv1d.fuse([state_dict.pop(prefix + '{}.conv1d.weight'.format(i)) for i in range(n)])
+			for name in ['weight', 'bias', 'running_mean', 'running_var']:
+				state_dict[prefix + 'bn.' + name] = torch.cat([state_dict.pop(prefix + '{}.bn.{}'.format(i, name)) for i in range(n)], dim=0)
+			tracked = [state_dict.pop(prefix + '{}.bn.num_batches_tracked'.format(i)) for i in range(n) if prefix + '{}.bn.num_batches_tracked'.format(i) in state_dict]
+			if len(tracked) > 0: state_dict[prefix + 'bn.num_batches_tracked'] = tracked[0]
+		super(BatchNormConv1dBank, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+	def forward(self, x):
+		x = self.conv1d(x)
+		if self.activation is not None:
+			x = self.activation(x)
+		return self.bn(x)
+
+
 ###########
 # HIGHWAY #
 ###########
@@ -99,10 +130,8 @@ class CBHG(nn.Module):
 		super(CBHG, self).__init__()
 		self.in_dim = in_dim
 		self.relu = nn.ReLU()
-		self.conv1d_banks = nn.ModuleList(
-			[BatchNormConv1d(in_dim, in_dim, kernel_size=k, stride=1,
-							 padding=k // 2, activation=self.relu)
-			 for k in range(1, K + 1)])
+		self.K = K
+		self.conv1d_banks = BatchNormConv1dBank(in_dim, in_dim, kernel_sizes=range(1, K + 1), activation=self.relu)
 		self.max_pool1d = nn.MaxPool1d(kernel_size=2, stride=1, padding=1)
 
 		in_sizes = [K * in_dim] + projections[:-1]
@@ -129,8 +158,8 @@ class CBHG(nn.Module):
 
 		T = x.size(-1)
 
-		x = torch.cat([conv1d(x)[:, :, :T] for conv1d in self.conv1d_banks], dim=1) # (B, in_dim*K, T_in) -> Concat conv1d bank outputs
-		assert x.size(1) == self.in_dim * len(self.conv1d_banks)
+		x = self.conv1d_banks(x) # (B, in_dim*K, T_in) -> Concat conv1d bank outputs
+		assert x.size(1) == self.in_dim * self.K
 		x = self.max_pool1d(x)[:, :, :T]
 
 		for conv1d in self.conv1d_projections:
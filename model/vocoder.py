@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*- #
+"""*********************************************************************************************"""
+#   FileName     [ vocoder.py ]
+#   Synopsis     [ batched griffin-lim vocoder on torch tensors ]
+#   Author       [ Ting-Wei Liu (Andi611) ]
+#   Copyright    [ Copyleft(c), NTUEE, NTU, Taiwan ]
+"""*********************************************************************************************"""
+
+
+###############
+# IMPORTATION #
+###############
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class GriffinLim(object):
+	"""
+		Griffin-Lim phase reconstruction of a batch of magnitude spectrograms, with the stft / istft of librosa
+		(periodic hann window, centered frames padded by reflection). The spectrograms are zero padded to the longest one
+		and iterated together in complex64, on the gpu if there is one, else on the cpu with torch's intra-op threads.
+		Each one is still reflect padded and overlap-added over its own length, so its waveform is the one it gets alone.
+		random_phase=False starts from zero phase as convert.griffin_lim, True from random phase as tacotron's audio._griffin_lim.
+
+		momentum > 0 runs the fast Griffin-Lim of Perraudin et al. (2013), which extrapolates every phase estimate
+		along its last update (librosa.griffinlim uses 0.99). With a tolerance, a spectrogram stops iterating once
+		an iteration improves its spectral convergence || |stft(y)| - mag || / || mag || by less than that fraction,
+		and the batch stops when all of them have, before n_iter. The iterations run and the last spectral
+		convergence of every spectrogram are kept in self.iterations and self.convergence.
+	"""
+	def __init__(self, n_fft, hop_length, win_length, n_iter, random_phase=False, momentum=0., tolerance=None, device=None):
+		self.n_fft = n_fft
+		self.hop_length = hop_length
+		self.win_length = win_length
+		self.n_iter = n_iter
+		self.random_phase = random_phase
+		self.momentum = momentum
+		self.tolerance = tolerance
+		self.iterations = []
+		self.convergence = []
+		self.device = torch.device(device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu'))
+		left = (n_fft - win_length) // 2
+		self.window = F.pad(torch.hann_window(win_length, periodic=True, device=self.device), (left, n_fft - win_length - left)) # centered in n_fft
+
+	def frame_index(self, lengths, n_frames):
+		# (batch_size, n_fft + hop_length * (n_frames - 1)) indices of the reflect padded signals in the signals with a zero sample appended
+		n_samples = self.hop_length * (n_frames - 1)
+		index = np.full((len(lengths), n_samples + self.n_fft), n_samples, dtype=np.int64)
+		for i, length in enumerate(lengths):
+			padded = np.pad(np.arange(self.hop_length * (length - 1)), self.n_fft // 2, mode='reflect')
+			index[i, :len(padded)] = padded
+		return torch.from_numpy(index).to(self.device)
+
+	def frame_mask(self, lengths, n_frames):
+		# (batch_size, n_frames) 1. for the frames of each signal, 0. for the zero padding
+		return (torch.arange(n_frames, device=self.device).view(1, -1) < torch.tensor(lengths, device=self.device).view(-1, 1)).float()
+
+	def inverse_envelope(self, mask):
+		# (batch_size, n_samples) inverse of the squared window overlap-added over the frames of each signal, zero where there is none
+		envelope = self.overlap_add((self.window ** 2).view(1, -1, 1) * mask.unsqueeze(1))
+		return torch.where(envelope > 1e-11, 1. / envelope, torch.zeros_like(envelope))
+
+	def spectral_convergence(self, est, mag, mask):
+		# || |est| - mag || / || mag || of every spectrogram, the padding frames of est overlap the end of the signal and are left out
+		return ((est.abs() - mag) * mask.unsqueeze(2)).flatten(1).norm(dim=1) / mag.flatten(1).norm(dim=1).clamp(min=1e-8)
+
+	def overlap_add(self, frames):
+		# frames: (batch_size, n_fft, n_frames) -> (batch_size, hop_length * (n_frames - 1)), centered
+		n_frames = frames.size(2)
+		out = F.fold(frames, output_size=(1, self.n_fft + self.hop_length * (n_frames - 1)), kernel_size=(1, self.n_fft), stride=(1, self.hop_length))
+		return out.view(frames.size(0), -1)[:, self.n_fft // 2:self.n_fft // 2 + self.hop_length * (n_frames - 1)]
+
+	def stft(self, y, index):
+		# y: (batch_size, n_samples) -> (batch_size, n_frames, 1 + n_fft // 2) complex64
+		padded = F.pad(y, (0, 1)).gather(1, index)
+		frames = padded.unfold(1, self.n_fft, self.hop_length) * self.window
+		return torch.fft.rfft(frames, dim=2)
+
+	def istft(self, spec, inv_envelope):
+		# spec: (batch_size, n_frames, 1 + n_fft // 2) complex64 -> (batch_size, n_samples)
+		frames = torch.fft.irfft(spec, n=self.n_fft, dim=2) * self.window
+		return self.overlap_add(frames.transpose(1, 2)) * inv_envelope
+
+	def __call__(self, mags):
+		# mags: list of (1 + n_fft // 2, t_step) magnitudes, returns a list of float32 waveforms of hop_length * (t_step - 1) samples
+		lengths = [mag.shape[1] for mag in mags]
+		n_frames = max(lengths)
+		batch = np.zeros((len(mags), n_frames, mags[0].shape[0]), dtype=np.float32) # frames first, the ffts run over the last axis
+		for i, mag in enumerate(mags):
+			batch[i, :lengths[i]] = mag.T
+		with torch.no_grad():
+			mag = torch.from_numpy(batch).to(self.device)
+			index = self.frame_index(lengths, n_frames)
+			mask = self.frame_mask(lengths, n_frames)
+			inv_envelope = self.inverse_envelope(mask)
+			if self.random_phase:
+				spec = mag * torch.exp(2j * np.pi * torch.rand(mag.shape, device=self.device)).to(torch.complex64)
+			else:
+				spec = mag.to(torch.complex64)
+			convergence = torch.ones(len(mags), device=self.device) # best spectral convergence so far
+			iterations = torch.zeros(len(mags), dtype=torch.long, device=self.device)
+			active = torch.ones(len(mags), dtype=torch.bool, device=self.device)
+			est_prev = None
+			for _ in range(self.n_iter):
+				est = self.stft(self.istft(spec, inv_envelope), index)
+				if self.tolerance is not None:
+					sc = self.spectral_convergence(est, mag, mask) # of the spectrogram the istft was taken of
+					active = active & (sc < convergence * (1. - self.tolerance))
+					convergence = torch.where(active, sc, convergence)
+				if self.momentum > 0:
+					est_fast = est if est_prev is None else torch.add(est, est_prev, alpha=-self.momentum / (1. + self.momentum))
+					est_prev, est = est, est_fast
+				update = est * (mag / est.abs().clamp(min=1e-8)) # the magnitudes with the estimated phase, scaled by a real factor
+				if self.tolerance is None:
+					spec = update
+				else:
+					spec = torch.where(active.view(-1, 1, 1), update, spec) # finished spectrograms keep their last estimate
+					iterations += active.long()
+					if not active.any():
+						break
+			if self.tolerance is None:
+				iterations.fill_(self.n_iter)
+			y = self.istft(spec, inv_envelope)
+			self.iterations = iterations.tolist()
+			self.convergence = self.spectral_convergence(self.stft(y, index), mag, mask).tolist()
+			y = y.cpu().numpy()
+		return [y[i, :self.hop_length * (length - 1)] for i, length in enumerate(lengths)]
@@ -11,113 +11,251 @@
 # IMPORTATION #
 ###############
 import os
+import time
 import pickle
 import numpy as np
 import torch
+from collections import OrderedDict
 import torch.nn.functional as F
 from hps.hps import hp
 from torch import nn
 from torch import optim
-from torch.autograd import Variable
-from model.model import Encoder, Decoder
+from model.model import Encoder, Decoder, pack_codes
 from model.model import TargetClassifier
 from model.model import SpeakerClassifier
 from model.model import PatchDiscriminator
 from model.model import Enhanced_Generator, Spectrogram_Patcher
 from model.tacotron_integrate.tacotron import Tacotron, learning_rate_decay
 from model.tacotron_integrate.loss import TacotronLoss
-from utils import Logger, cc, to_var
+from utils import Logger, MetricCollector, PhaseTimer, cc, to_var
 from utils import grad_clip, reset_grad
+from utils import get_rank, get_world_size, all_reduce_grad, broadcast_params
 from utils import calculate_gradients_penalty
+from utils import save_sectioned_checkpoint, load_sectioned_checkpoint, is_sectioned_checkpoint
+
+
+############
+# CONSTANT #
+############
+NETWORKS = {
+	'encoder' : 'Encoder',
+	'decoder' : 'Decoder',
+	'generator' : 'Generator',
+	'classifier' : 'SpeakerClassifier',
+	'patch_discriminator' : 'PatchDiscriminator',
+	'target_classifier' : 'TargetClassifier',
+}
+OPTIMIZERS = {
+	'ae_opt' : ['encoder', 'decoder'],
+	'clf_opt' : ['classifier'],
+	'gen_opt' : ['generator'],
+	'patch_opt' : ['patch_discriminator'],
+	'tclf_opt' : ['target_classifier'],
+	'distill_opt' : ['decoder', 'generator'],
+}
+MODE_REQUIREMENTS = {
+	'pretrain_AE' : (['encoder', 'decoder'], ['ae_opt']),
+	'pretrain_C' : (['encoder', 'classifier'], ['clf_opt']),
+	'train' : (['encoder', 'decoder', 'classifier'], ['ae_opt', 'clf_opt']),
+	'patchGAN' : (['encoder', 'decoder', 'generator', 'patch_discriminator'], ['gen_opt', 'patch_opt']),
+	'autolocker' : (['encoder', 'decoder', 'generator'], ['gen_opt']),
+	't_classify' : (['target_classifier'], ['tclf_opt']),
+	'train_Tacotron' : (['encoder', 'generator'], ['gen_opt']),
+	'distill' : (['encoder', 'decoder', 'generator'], ['distill_opt']),
+	'test' : (['encoder', 'decoder', 'generator', 'target_classifier'], []),
+}
+CODE_ENC_MODES = ['binary', 'multilabel_binary'] # every encoding step is one of 2^enc_size binary codes
+MAX_CODE_BITS = 12 # largest enc_size decoded through a table of all codes at test time, the Decoders keep 2^enc_size x c_h floats
 
 
 class Trainer(object):
-	def __init__(self, hps, data_loader, g_mode, enc_mode, log_dir='./log/'):
+	def __init__(self, hps, data_loader, g_mode, enc_mode, log_dir='./log/', model_list=None, student=False):
 		self.hps = hps
+		self.student = student # build the compact decoder / generator of hps.student_emb_size
+		self.teacher = None
 		self.data_loader = data_loader
 		self.model_kept = []
 		self.max_keep = hps.max_to_keep
-		self.logger = Logger(log_dir)
+		self.rank = get_rank()
+		self.world_size = get_world_size()
+		self.comm_time = 0.
+		self.single_proc_throughput = {} # benchmark mode : samples/sec of one process, see set_scaling_baseline()
+		self.timer = PhaseTimer(enabled=False)
+		self.profile_start = -1
+		self.profiler = None
+		self.logger = Logger(log_dir) if self.rank == 0 else None # only the first process logs and saves
 		self.g_mode = g_mode
 		self.enc_mode = enc_mode
+		self.pending_states = {}
+		self.training = True # mode of the networks built from now on, see set_eval() / set_train()
+		self.valid_set = None
 		if self.g_mode != 'naive': 
 			self.shift_c = to_var(torch.from_numpy(np.array([int(hps.n_speakers-hps.n_target_speakers) \
 						   					 for _ in range(hps.batch_size)])), requires_grad=False)
-		self.build_model()
-
-	def build_model(self):
+		if model_list is not None:
+			self.build_model(model_list)
+
+	def __getattr__(self, name):
+		# networks and optimizers are built on first use
+		if name in NETWORKS.values():
+			self.build_network([net for net, attr in NETWORKS.items() if attr == name][0])
+			return self.__dict__[name]
+		if name in OPTIMIZERS:
+			self.build_optimizer(name)
+			return self.__dict__[name]
+		raise AttributeError('\'{}\' object has no attribute \'{}\''.format(type(self).__name__, name))
+
+	def built_networks(self):
+		return [net for net, attr in NETWORKS.items() if attr in self.__dict__]
+
+	def build_model(self, model_list, opt_list=[]):
+		for net in model_list:
+			if NETWORKS[net] not in self.__dict__:
+				self.build_network(net)
+		for opt in opt_list:
+			if opt not in self.__dict__:
+				self.build_optimizer(opt)
+
+	def build_mode(self, mode):
+		model_list, opt_list = MODE_REQUIREMENTS[mode]
+		self.build_model(model_list, opt_list)
+
+	def make_network(self, net, student=False):
 		hps = self.hps
 		ns = self.hps.ns
 		enc_mode = self.enc_mode
 		seg_len = self.hps.seg_len
 		enc_size = self.hps.enc_size
 		emb_size = self.hps.emb_size
-		betas = (0.5, 0.9)
+		dec_size = self.hps.student_emb_size if student else self.hps.emb_size
+		n_dense = self.hps.student_dense_blocks if student else 2
 
 		#---stage one---#
-		self.Encoder = cc(Encoder(ns=ns, dp=hps.enc_dp, enc_size=enc_size, seg_len=seg_len, enc_mode=enc_mode))
-		self.Decoder = cc(Decoder(ns=ns, c_in=enc_size, c_h=emb_size, c_a=hps.n_speakers, seg_len=seg_len))
-		self.SpeakerClassifier = cc(SpeakerClassifier(ns=ns, c_in=enc_size * enc_size if enc_mode == 'binary' else \
-													  (2*enc_size if enc_mode == 'multilabel_binary' else enc_size), \
-													  c_h=emb_size, n_class=hps.n_speakers, dp=hps.dis_dp, seg_len=seg_len))
-		
-		#---stage one opts---#
-		params = list(self.Encoder.parameters()) + list(self.Decoder.parameters())
-		self.ae_opt = optim.Adam(params, lr=self.hps.lr, betas=betas)
-		self.clf_opt = optim.Adam(self.SpeakerClassifier.parameters(), lr=self.hps.lr, betas=betas)
+		if net == 'encoder':
+			model = cc(Encoder(ns=ns, dp=hps.enc_dp, enc_size=enc_size, seg_len=seg_len, enc_mode=enc_mode, grad_checkpoint=hps.grad_checkpoint))
+		elif net == 'decoder':
+			model = cc(Decoder(ns=ns, c_in=enc_size, c_h=dec_size, c_a=hps.n_speakers, seg_len=seg_len, n_dense_blocks=n_dense, grad_checkpoint=hps.grad_checkpoint))
+		elif net == 'classifier':
+			model = cc(SpeakerClassifier(ns=ns, c_in=enc_size * enc_size if enc_mode == 'binary' else \
+										 (2*enc_size if enc_mode == 'multilabel_binary' else enc_size), \
+										 c_h=emb_size, n_class=hps.n_speakers, dp=hps.dis_dp, seg_len=seg_len))
 		
 		#---stage two---#
-		if self.g_mode == 'naive':
-			self.Generator = cc(Decoder(ns=ns, c_in=enc_size, c_h=emb_size, c_a=hps.n_speakers, seg_len=seg_len))
-		elif self.g_mode == 'targeted' or self.g_mode == 'targeted_residual':
-			self.Generator = cc(Decoder(ns=ns, c_in=enc_size, c_h=emb_size, c_a=hps.n_target_speakers, seg_len=seg_len, \
-										output_mask=True if self.g_mode == 'targeted_residual' else False))
-		elif self.g_mode == 'enhanced':
-			self.Generator = cc(Enhanced_Generator(ns=ns, dp=hps.enc_dp, enc_size=1024, emb_size=1024, seg_len=seg_len, n_speakers=hps.n_speakers))
-		elif self.g_mode == 'spectrogram':
-			self.Generator = cc(Spectrogram_Patcher(ns=ns, c_in=513, c_h=emb_size, c_a=hps.n_target_speakers, seg_len=seg_len))
-		elif self.g_mode == 'tacotron':
-			self.Generator = cc(Tacotron(enc_size, hps.n_target_speakers, mel_dim=hp.n_mels, linear_dim=int(hp.n_fft/2)+1))
-			self.tacotron_input_lengths = torch.tensor([self.hps.seg_len//8 for _ in range(hps.batch_size)])
-		else:
-			raise NotImplementedError('Invalid Generator mode!')
-			
-		self.PatchDiscriminator = cc(nn.DataParallel(PatchDiscriminator(ns=ns, n_class=hps.n_speakers \
-																		if self.g_mode == 'naive' else hps.n_target_speakers,
-																		seg_len=seg_len)))
-		
-		#---stage two opts---#
-		self.gen_opt = optim.Adam(self.Generator.parameters(), lr=self.hps.lr, betas=betas)
-		self.patch_opt = optim.Adam(self.PatchDiscriminator.parameters(), lr=self.hps.lr, betas=betas)
-		
+		elif net == 'generator':
+			if student and self.g_mode not in ['naive', 'targeted', 'targeted_residual']:
+				raise NotImplementedError('Only the decoder based generators have a student!')
+			if self.g_mode == 'naive':
+				model = cc(Decoder(ns=ns, c_in=enc_size, c_h=dec_size, c_a=hps.n_speakers, seg_len=seg_len, n_dense_blocks=n_dense, grad_checkpoint=hps.grad_checkpoint))
+			elif self.g_mode == 'targeted' or self.g_mode == 'targeted_residual':
+				model = cc(Decoder(ns=ns, c_in=enc_size, c_h=dec_size, c_a=hps.n_target_speakers, seg_len=seg_len, n_dense_blocks=n_dense, \
+								   output_mask=True if self.g_mode == 'targeted_residual' else False, grad_checkpoint=hps.grad_checkpoint))
+			elif self.g_mode == 'enhanced':
+				model = cc(Enhanced_Generator(ns=ns, dp=hps.enc_dp, enc_size=1024, emb_size=1024, seg_len=seg_len, n_speakers=hps.n_speakers, grad_checkpoint=hps.grad_checkpoint))
+			elif self.g_mode == 'spectrogram':
+				model = cc(Spectrogram_Patcher(ns=ns, c_in=513, c_h=emb_size, c_a=hps.n_target_speakers, seg_len=seg_len))
+			elif self.g_mode == 'tacotron':
+				model = cc(Tacotron(enc_size, hps.n_target_speakers, mel_dim=hp.n_mels, linear_dim=int(hp.n_fft/2)+1))
+				self.tacotron_input_lengths = torch.tensor([self.hps.seg_len//8 for _ in range(hps.batch_size)])
+			else:
+				raise NotImplementedError('Invalid Generator mode!')
+		elif net == 'patch_discriminator':
+			model = cc(nn.DataParallel(PatchDiscriminator(ns=ns, n_class=hps.n_speakers \
+														  if self.g_mode == 'naive' else hps.n_target_speakers,
+														  seg_len=seg_len)))
 		
 		#---target classifier---#
-		self.TargetClassifier = cc(nn.DataParallel(TargetClassifier(ns=ns, n_class=3, seg_len=seg_len)))
-		
-		#---target classifier opts---#
-		self.tclf_opt = optim.Adam(self.TargetClassifier.parameters(), lr=self.hps.lr, betas=betas)
+		elif net == 'target_classifier':
+			model = cc(nn.DataParallel(TargetClassifier(ns=ns, n_class=3, seg_len=seg_len)))
+		else:
+			raise NotImplementedError('Invalid network: {}'.format(net))
+		return model
+
+	def build_network(self, net):
+		model = self.make_network(net, student=self.student)
+
+		# apply weights that were loaded before the network was built
+		if net in self.pending_states:
+			try: model.load_state_dict(self.pending_states.pop(net))
+			except: print('[Trainer] - [{} - X]'.format(net))
+		if self.world_size > 1:
+			broadcast_params(model)
+		setattr(self, NETWORKS[net], model)
+		if not self.training:
+			self.set_network_eval(net)
+
+	def build_optimizer(self, opt):
+		betas = (0.5, 0.9)
+		params = []
+		for net in OPTIMIZERS[opt]:
+			params += list(getattr(self, NETWORKS[net]).parameters())
+		setattr(self, opt, optim.Adam(params, lr=self.hps.lr, betas=betas))
 
 	def reset_keep(self):
 		self.model_kept = []
 
+	def sync_grad(self, net_list):
+		if self.world_size > 1:
+			start_time = time.time()
+			all_reduce_grad(net_list)
+			self.comm_time += time.time() - start_time
+
+	def update(self, loss, opt, net_list, reset_list=None, clip=True):
+		# backward, gradient all-reduce, clip and step for the networks updated by `opt`, timed per phase
+		name = opt.split('_')[0]
+		self.timer.lap('forward')
+		reset_grad(net_list if reset_list is None else reset_list)
+		loss.backward()
+		self.timer.lap('backward_' + name)
+		if self.world_size > 1:
+			self.sync_grad(net_list)
+			self.timer.lap('allreduce_' + name)
+		if clip:
+			grad_clip(net_list, self.hps.max_grad_norm)
+			self.timer.lap('clip_' + name)
+		getattr(self, opt).step()
+		self.timer.lap('step_' + name)
+
+	def enable_profiling(self, time_phases=True, profile_start=-1, profile_steps=5, profile_dir='./log/profile/'):
+		self.timer = PhaseTimer(enabled=time_phases)
+		self.profile_start = profile_start
+		self.profile_steps = profile_steps
+		self.profile_dir = profile_dir
+
+	def profile_step(self, iteration, mode):
+		self.timer.start()
+		if self.profile_start < 0 or self.rank != 0:
+			return
+		if iteration == self.profile_start:
+			activities = [torch.profiler.ProfilerActivity.CPU]
+			if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+			self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+			self.profiler.start()
+			self.profile_name = '{}_iter{}-{}.json'.format(mode, self.profile_start, self.profile_start + self.profile_steps)
+		elif iteration == self.profile_start + self.profile_steps:
+			self.stop_profiler()
+
+	def stop_profiler(self):
+		if self.profiler is None:
+			return
+		self.profiler.stop()
+		os.makedirs(self.profile_dir, exist_ok=True)
+		trace_path = os.path.join(self.profile_dir, self.profile_name)
+		self.profiler.export_chrome_trace(trace_path) # open with chrome://tracing or https://ui.perfetto.dev
+		print('[Trainer] - Profiler trace saved to: ', trace_path)
+		self.profiler = None
+
 	def save_model(self, model_path, name, iteration, model_all=True):
-		if model_all:
-			all_model = {
-				'encoder': self.Encoder.state_dict(),
-				'decoder': self.Decoder.state_dict(),
-				'generator': self.Generator.state_dict(),
-				'classifier': self.SpeakerClassifier.state_dict(),
-				'patch_discriminator': self.PatchDiscriminator.state_dict(),
-				'target_classifier': self.TargetClassifier.state_dict(),
-			}
-		else:
-			all_model = {
-				'encoder': self.Encoder.state_dict(),
-				'decoder': self.Decoder.state_dict(),
-				'generator': self.Generator.state_dict(),
-			}
+		if self.rank != 0:
+			return
+		save_list = list(NETWORKS.keys()) if model_all else ['encoder', 'decoder', 'generator']
+		all_model = {}
+		for net in save_list:
+			if NETWORKS[net] in self.__dict__:
+				all_model[net] = getattr(self, NETWORKS[net]).state_dict()
+			elif net in self.pending_states: # carry loaded but unused weights over
+				all_model[net] = self.pending_states[net]
 		new_model_path = '{}-{}-{}'.format(model_path, name, iteration)
-		torch.save(all_model, new_model_path)
+		save_sectioned_checkpoint(new_model_path, all_model, fp16=self.hps.ckpt_fp16)
 		self.model_kept.append(new_model_path)
 
 		if len(self.model_kept) >= self.max_keep:
@@ -125,49 +263,66 @@ class Trainer(object):
 			self.model_kept.pop(0)
 
 
+	@staticmethod
+	def read_checkpoint(model_path, sections):
+		# sectioned checkpoints only map the requested networks, legacy pickles are loaded whole onto the cpu
+		if is_sectioned_checkpoint(model_path):
+			return load_sectioned_checkpoint(model_path, sections)
+		return torch.load(model_path, map_location='cpu')
+
+
 	def load_model(self, model_path, load_model_list, verbose=True, clf_path = None):
 		if verbose: print('[Trainer] - load model from {}'.format(model_path))
 		load_model_list = load_model_list.split(', ')
-		all_model = torch.load(model_path)
+		all_model = self.read_checkpoint(model_path, load_model_list)
 		if verbose: print('[Trainer] - ', end = '')
-		if 'encoder' in load_model_list:
-			try:
-				self.Encoder.load_state_dict(all_model['encoder'])
-				if verbose: print('[encoder], ', end = '')
-			except: print('[encoder - X], ', end = '')
-		if 'decoder' in load_model_list:
-			try:
-				self.Decoder.load_state_dict(all_model['decoder'])
-				if verbose: print('[decoder], ', end = '')
-			except: print('[generator - X], ', end = '')
-		if 'generator' in load_model_list:
-			try:
-				self.Generator.load_state_dict(all_model['generator'])
-				if verbose: print('[generator], ', end = '')
-			except: print('[generator - X], ', end = '')
-		if 'classifier' in load_model_list:
-			try:
-				self.SpeakerClassifier.load_state_dict(all_model['classifier'])
-				if verbose: print('[classifier], ', end = '')
-			except: print('[classifier - X], ', end = '')
-		if 'patch_discriminator' in load_model_list:
+		for net in NETWORKS:
+			if net not in load_model_list:
+				continue
 			try:
-				self.PatchDiscriminator.load_state_dict(all_model['patch_discriminator'])
-				if verbose: print('[patch_discriminator], ', end = '')
-			except: print('[patch_discriminator - X], ', end = '')
-		if 'target_classifier' in load_model_list:
-			try:
-				if clf_path != None:
-					clf_model = torch.load(clf_path)
-					self.TargetClassifier.load_state_dict(clf_model['target_classifier'])
-					if verbose: print('[target_classifier_another], ', end = '')
+				if net == 'target_classifier' and clf_path != None:
+					state_dict = self.read_checkpoint(clf_path, [net])[net]
+					tag = 'target_classifier_another'
+				else:
+					state_dict = all_model[net]
+					tag = net
+				# networks that are not built yet receive their weights on first use
+				if NETWORKS[net] in self.__dict__:
+					getattr(self, NETWORKS[net]).load_state_dict(state_dict)
 				else:
-					self.TargetClassifier.load_state_dict(all_model['target_classifier'])
-					if verbose: print('[target_classifier], ', end = '')
-			except: print('[target_classifier - X], ', end = '')
+					self.pending_states[net] = state_dict
+				if verbose: print('[{}], '.format(tag), end = '')
+			except: print('[{} - X], '.format(net), end = '')
 		if verbose: print('Loaded!')
 
 
+	def quantize(self):
+		# dynamic int8 quantization of the Linear / GRU layers for CPU inference, call after load_model
+		if torch.cuda.is_available():
+			raise RuntimeError('Quantized inference runs on CPU only, hide the GPUs with CUDA_VISIBLE_DEVICES=""')
+		quantized = []
+		for net in ['encoder', 'decoder', 'generator']:
+			if net == 'generator' and self.g_mode == 'tacotron':
+				continue
+			model = getattr(self, NETWORKS[net]).eval() # also drops the float code table of a Decoder before it is copied
+			setattr(self, NETWORKS[net], torch.quantization.quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8))
+			quantized.append(net)
+		print('[Trainer] - Quantized to int8: {}'.format(', '.join(quantized)))
+
+
+	def load_teacher(self, model_path):
+		# frozen full size decoder and generator that the student networks are distilled from
+		states = self.read_checkpoint(model_path, ['decoder', 'generator'])
+		self.teacher = {}
+		for net in ['decoder', 'generator']:
+			model = self.make_network(net)
+			model.load_state_dict(states[net])
+			for p in model.parameters():
+				p.requires_grad = False
+			self.teacher[net] = model.eval()
+		print('[Trainer] - Teacher loaded from {}'.format(model_path))
+
+
 	def add_duo_loader(self, source_loader, target_loader):
 		self.source_loader = source_loader
 		self.target_loader = target_loader
@@ -178,70 +333,190 @@ class Trainer(object):
 
 
 	def set_eval(self):
-		self.testing_shift_c = Variable(torch.from_numpy(np.array([int(self.hps.n_speakers-self.hps.n_target_speakers)]))).cuda()
-		self.Encoder.eval()
-		self.Decoder.eval()
-		self.SpeakerClassifier.eval()
-		self.PatchDiscriminator.eval()
-		self.TargetClassifier.eval()
-		if self.g_mode == 'tacotron': # keep dropout in Tacotron's decoder
+		self.testing_shift_c = to_var(torch.from_numpy(np.array([int(self.hps.n_speakers-self.hps.n_target_speakers)])), requires_grad=False)
+		self.training = False # networks built on first use after this are put in eval mode too
+		for net in self.built_networks():
+			self.set_network_eval(net)
+
+
+	def set_network_eval(self, net):
+		if net == 'generator' and self.g_mode == 'tacotron': # keep dropout in Tacotron's decoder
 			self.Generator.encoder.eval()
 			self.Generator.postnet.eval()
 		else:
-			self.Generator.eval()
+			getattr(self, NETWORKS[net]).eval()
+
+
+	def set_train(self):
+		self.training = True
+		for net in self.built_networks():
+			getattr(self, NETWORKS[net]).train()
 
 
 	def test_step(self, x, c, enc_only=False, verbose=True):
 		self.set_eval()
 		x = to_var(x).permute(0, 2, 1)
 		enc, _ = self.Encoder(x)
-		if enc_only or self.g_mode != 'tacotron': 
-			x_dec = self.Decoder(enc, c)
 		if not enc_only:
 			if verbose: print('Testing with Autoencoder + Generator, encoding: ', enc.data.cpu().numpy())
 			if self.g_mode != 'naive' and (c - self.testing_shift_c).data.cpu().numpy()[0] not in range(self.hps.n_target_speakers):
 				raise RuntimeError('This generator can only convert to target speakers!')
-			
+		else:
+			if verbose: print('Testing with Autoencoder only, encoding: ', enc.data.cpu().numpy())
+		codes = pack_codes(enc) if self.use_codes() else None
+		x_dec = self.generate_step(enc, c, enc_only=enc_only, codes=codes)
+		return x_dec.data.cpu().numpy(), enc.data.cpu().numpy()
+
+
+	def test_targets_step(self, x, c, enc_only=False):
+		# x: (n_segments, t_step, 513) segments of one source, encoded once and converted to every speaker of c: (n_targets,) in one batch
+		self.set_eval()
+		with torch.no_grad():
+			x = to_var(x, requires_grad=False).permute(0, 2, 1)
+			enc, _ = self.Encoder(x)
+			if not enc_only and self.g_mode != 'naive' and not np.all(np.isin((c - self.testing_shift_c).data.cpu().numpy(), range(self.hps.n_target_speakers))):
+				raise RuntimeError('This generator can only convert to target speakers!')
+			n_targets, n_segments = c.size(0), enc.size(0)
+			codes = pack_codes(enc).repeat(n_targets, 1) if self.use_codes() else None
+			x_dec = self.generate_step(enc.repeat(n_targets, 1, 1), c.repeat_interleave(n_segments), enc_only=enc_only, codes=codes) # target-major
+		return x_dec.view(n_targets, n_segments, *x_dec.shape[1:]).data.cpu().numpy(), enc.data.cpu().numpy()
+
+
+	def use_codes(self):
+		# binary encodings are decoded from integer codes at test time, see Decoder.forward()
+		return self.enc_mode in CODE_ENC_MODES and self.hps.enc_size <= MAX_CODE_BITS
+
+
+	def generate_step(self, enc, c, enc_only=False, decoder=None, generator=None, codes=None):
+		# batched conversion of encodings to the speakers in c, c holds absolute speaker ids, codes: pack_codes(enc) for the decoder lookup
+		shift_c = int(self.hps.n_speakers - self.hps.n_target_speakers)
+		decoder = self.Decoder if decoder is None else decoder
+		generator = self.Generator if generator is None and not enc_only else generator
+		if enc_only or self.g_mode != 'tacotron': 
+			x_dec = decoder(enc, c, codes=codes)
+		if not enc_only:
 			#---select Generator mode---#
 			if self.g_mode == 'naive':
-				x_dec += self.Generator(enc, c)
+				x_dec = x_dec + generator(enc, c, codes=codes)
 			elif self.g_mode == 'targeted':
-				x_dec += self.Generator(enc, c - self.testing_shift_c)
+				x_dec = x_dec + generator(enc, c - shift_c, codes=codes)
 			elif self.g_mode == 'targeted_residual':
-				x_dec = (x_dec * 1.0) + (1.0 * x_dec * self.Generator(enc, c - self.testing_shift_c))
+				x_dec = (x_dec * 1.0) + (1.0 * x_dec * generator(enc, c - shift_c, codes=codes))
 			elif self.g_mode == 'enhanced' or self.g_mode == 'spectrogram':
-				x_dec += self.Generator(x_dec, c - self.testing_shift_c)
+				x_dec = x_dec + generator(x_dec, c - shift_c)
 			elif self.g_mode == 'tacotron':
-				_, x_dec = self.Generator(enc, targets=None, speaker_id=(c - self.testing_shift_c), input_lengths=None)
+				_, x_dec = generator(enc, targets=None, speaker_id=(c - shift_c), input_lengths=None)
 			else:
 				raise NotImplementedError('Invalid Generator mode!')
-		else:
-			if verbose: print('Testing with Autoencoder only, encoding: ', enc.data.cpu().numpy())
-		
-		return x_dec.data.cpu().numpy(), enc.data.cpu().numpy()
+		return x_dec
+
+
+	def set_scaling_baseline(self, single_proc_throughput):
+		self.single_proc_throughput = single_proc_throughput # measured by benchmark.py, keyed by its mode names
+
+
+	def set_valid_set(self, valid_set):
+		self.valid_set = valid_set # (x, c) of held-out segments, c is -1 for speakers without an id
+
+
+	def validate(self, flag, step):
+		# held-out metrics computed in large no-grad batches, only with the networks that are already built
+		if self.rank != 0:
+			return
+		hps = self.hps
+		built = self.built_networks()
+		shift_c = int(hps.n_speakers - hps.n_target_speakers)
+		x_all, c_all = self.valid_set
+		sums, counts = OrderedDict(), OrderedDict()
+		def accumulate(tag, value, n):
+			sums[tag] = sums.get(tag, 0.) + value.item() * n
+			counts[tag] = counts.get(tag, 0) + n
+
+		# the networks are put back in the mode each of their modules had, so a frozen network stays in eval mode
+		modes = {net : [(module, module.training) for module in getattr(self, NETWORKS[net]).modules()] for net in built}
+		training = self.training
+		self.set_eval()
+		with torch.no_grad():
+			for start in range(0, len(x_all), hps.valid_batch_size):
+				x = to_var(torch.from_numpy(x_all[start:start+hps.valid_batch_size]), requires_grad=False).permute(0, 2, 1)
+				c = to_var(torch.from_numpy(c_all[start:start+hps.valid_batch_size]), requires_grad=False)
+				c_tar = shift_c + torch.arange(x.size(0), device=x.device) % hps.n_target_speakers # alternate over target speakers
+				known = c >= 0
+
+				if 'target_classifier' in built:
+					label = torch.where(c >= shift_c, c - shift_c, torch.full_like(c, hps.n_target_speakers)) # last class: not a target
+					accumulate(f'{flag}/valid_tclf_acc', (self.TargetClassifier(x).argmax(dim=1) == label).float().mean(), x.size(0))
+				if 'encoder' not in built:
+					continue
+				enc_act, enc = self.Encoder(x)
+
+				# speaker classification of the encodings of known speakers
+				if 'classifier' in built and known.any():
+					accumulate(f'{flag}/valid_clf_acc', (self.SpeakerClassifier(enc[known]).argmax(dim=1) == c[known]).float().mean(), int(known.sum()))
+				if 'decoder' not in built:
+					continue
+
+				# reconstruction of segments from known speakers
+				if known.any():
+					x_rec = self.Decoder(enc_act[known], c[known])
+					accumulate(f'{flag}/valid_loss_rec', torch.mean(torch.abs(x_rec - x[known])), int(known.sum()))
+
+				# conversion to the target speakers should keep the units
+				enc_only = 'generator' not in built or self.g_mode == 'tacotron'
+				x_conv = self.generate_step(enc_act, c_tar, enc_only=enc_only)
+				re_enc, _ = self.Encoder(x_conv)
+				if self.enc_mode == 'continues':
+					accumulate(f'{flag}/valid_re_enc_l1', torch.mean(torch.abs(re_enc - enc_act)), x.size(0))
+				else:
+					accumulate(f'{flag}/valid_unit_acc', ((re_enc > 0.5) == (enc_act > 0.5)).float().mean(), x.size(0))
+
+				if 'patch_discriminator' in built and not enc_only:
+					_, logits = self.PatchDiscriminator(x_conv, classify=True)
+					label = c_tar if self.g_mode == 'naive' else c_tar - shift_c
+					accumulate(f'{flag}/valid_conv_acc', (logits.argmax(dim=1) == label).float().mean(), x.size(0))
+		self.training = training
+		for net in modes:
+			for module, mode in modes[net]:
+				module.training = mode
+
+		if len(sums) == 0:
+			return
+		log = '[Trainer] - Validation at step {}'.format(step)
+		for tag in sums:
+			value = sums[tag] / counts[tag]
+			self.logger.scalar_summary(tag, value, step)
+			log += ', {}={:.3f}'.format(tag.split('/')[-1], value)
+		print()
+		print(log)
 
 
 	def encoder_test_step(self, x):
 		self.set_eval()
-		x = to_var(x).permute(0, 2, 1)
-		enc, _ = self.Encoder(x)
+		with torch.no_grad():
+			x = to_var(x, requires_grad=False).permute(0, 2, 1)
+			enc, _ = self.Encoder(x)
 		return enc.data.cpu().numpy()
 
 		
-	def classify(self, x):
+	def classify(self, x, lengths=None):
 		self.set_eval()
 		x = to_var(x).permute(0, 2, 1)
-		logits = self.TargetClassifier(x)
+		if lengths is not None: lengths = to_var(lengths, requires_grad=False)
+		logits = self.TargetClassifier(x, lengths=lengths)
 		return logits.data.cpu().numpy()
 		
 
-	def permute_data(self, data, load_mel=False):
+	def permute_data(self, data, load_mel=False, load_enc=False):
 		C = to_var(data[0], requires_grad=False)
 		X = to_var(data[1]).permute(0, 2, 1)
+		outputs = [C, X]
 		if load_mel: 
 			M = to_var(data[2]).permute(0, 2, 1)
-			return C, X, M
-		return C, X
+			outputs.append(M)
+		if load_enc:
+			E = to_var(data[-1], requires_grad=False) # precomputed by the encoding cache
+			outputs.append(E)
+		return tuple(outputs)
 
 
 	def encode_step(self, x):
@@ -249,17 +524,31 @@ class Trainer(object):
 		return enc_act, enc
 
 
+	def cached_encode_step(self, x, enc_cached=None):
+		# the stage 1 encoder is frozen here, reuse its cached output when available
+		if enc_cached is not None:
+			return enc_cached
+		enc_act, _ = self.encode_step(x)
+		return enc_act
+
+
 	def decode_step(self, enc, c):
 		x_dec = self.Decoder(enc, c)
 		return x_dec
 
 
-	def patch_step(self, x, x_dec, is_dis=True):
+	def patch_step(self, x, x_dec, is_dis=True, compute_gp=True):
 		D_real, real_logits = self.PatchDiscriminator(x, classify=True)
 		D_fake, fake_logits = self.PatchDiscriminator(x_dec, classify=True)
 		if is_dis:
 			w_dis = torch.mean(D_real - D_fake)
-			gp = calculate_gradients_penalty(self.PatchDiscriminator, x, x_dec)
+			if compute_gp:
+				n_gp = self.hps.gp_batch_size if self.hps.gp_batch_size > 0 else x.size(0) # penalty on a sub-batch
+				self.timer.lap('forward')
+				gp = calculate_gradients_penalty(self.PatchDiscriminator, x[:n_gp], x_dec[:n_gp])
+				self.timer.lap('gradient_penalty')
+			else:
+				gp = None
 			return w_dis, real_logits, gp
 		else:
 			return -torch.mean(D_fake), fake_logits
@@ -305,52 +594,54 @@ class Trainer(object):
 
 
 	def cal_acc(self, logits, y_true, shift=False):
-		_, ind = torch.max(logits, dim=1)
+		# stays on the logits' device, no host synchronization
+		_, ind = torch.max(logits.detach(), dim=1)
 		if shift:
-			acc = torch.sum((ind == y_true - self.shift_c).type(torch.FloatTensor)) / y_true.size(0)
+			acc = (ind == y_true - self.shift_c).float().mean()
 		else:
-			acc = torch.sum((ind == y_true).type(torch.FloatTensor)) / y_true.size(0)
+			acc = (ind == y_true).float().mean()
 		return acc
 
 
-	def train(self, model_path, flag='train', mode='train', target_guided=False):
+	def train(self, model_path, flag='train', mode='train', target_guided=False, use_enc_cache=False):
 		# load hyperparams
 		hps = self.hps
+		if mode in MODE_REQUIREMENTS: self.build_mode(mode)
+		mode_start_time, self.comm_time = time.time(), 0.
 
 		if mode == 'pretrain_AE':
+			metrics = MetricCollector(self.logger, 'pre_AE', hps.enc_pretrain_iters, hps.log_interval)
 			for iteration in range(hps.enc_pretrain_iters):
+				self.profile_step(iteration, mode)
 				data = next(self.data_loader)
 				c, x = self.permute_data(data)
+				self.timer.lap('data')
 				
 				# encode
 				enc_act, enc = self.encode_step(x)
 				x_dec = self.decode_step(enc_act, c)
 				loss_rec = torch.mean(torch.abs(x_dec - x))
-				reset_grad([self.Encoder, self.Decoder])
-				loss_rec.backward()
-				grad_clip([self.Encoder, self.Decoder], hps.max_grad_norm)
-				self.ae_opt.step()
+				self.update(loss_rec, 'ae_opt', [self.Encoder, self.Decoder])
 				
 				# tb info
-				info = {
-					f'{flag}/pre_loss_rec': loss_rec.item(),
-				}
-				slot_value = (iteration + 1, hps.enc_pretrain_iters) + tuple([value for value in info.values()])
-				log = 'pre_AE:[%06d/%06d], loss_rec=%.3f'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				metrics.add(f'{flag}/pre_loss_rec', loss_rec)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 'ae', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 
 		elif mode == 'pretrain_C':
+			metrics = MetricCollector(self.logger, 'pre_C', hps.dis_pretrain_iters, hps.log_interval)
 			for iteration in range(hps.dis_pretrain_iters):
+				self.profile_step(iteration, mode)
 				
 				data = next(self.data_loader)
 				c, x = self.permute_data(data)
+				self.timer.lap('data')
 				
 				# encode
 				enc_act, enc = self.encode_step(x)
@@ -360,30 +651,25 @@ class Trainer(object):
 				loss_clf = self.cal_loss(logits, c)
 				
 				# update 
-				reset_grad([self.SpeakerClassifier])
-				loss_clf.backward()
-				grad_clip([self.SpeakerClassifier], hps.max_grad_norm)
-				self.clf_opt.step()
+				self.update(loss_clf, 'clf_opt', [self.SpeakerClassifier])
 				
 				# calculate acc
 				acc = self.cal_acc(logits, c)
-				info = {
-					f'{flag}/pre_loss_clf': loss_clf.item(),
-					f'{flag}/pre_acc': acc,
-				}
-				slot_value = (iteration + 1, hps.dis_pretrain_iters) + tuple([value for value in info.values()])
-				log = 'pre_C:[%06d/%06d], loss_clf=%.2f, acc=%.2f'
-				
-				print(log % slot_value, end='\r')
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				metrics.add(f'{flag}/pre_loss_clf', loss_clf)
+				metrics.add(f'{flag}/pre_acc', acc)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 'c', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 
 		elif mode == 'train':
+			metrics = MetricCollector(self.logger, 'train', hps.iters, hps.log_interval)
 			for iteration in range(hps.iters):
+				self.profile_step(iteration, mode)
 				
 				# calculate current alpha
 				if iteration < hps.lat_sched_iters:
@@ -395,6 +681,7 @@ class Trainer(object):
 				for step in range(hps.n_latent_steps):
 					data = next(self.data_loader)
 					c, x = self.permute_data(data)
+					self.timer.lap('data')
 					
 					# encode
 					enc_act, enc = self.encode_step(x)
@@ -405,28 +692,17 @@ class Trainer(object):
 					loss = hps.alpha_dis * loss_clf
 					
 					# update 
-					reset_grad([self.SpeakerClassifier])
-					loss.backward()
-					grad_clip([self.SpeakerClassifier], hps.max_grad_norm)
-					self.clf_opt.step()
+					self.update(loss, 'clf_opt', [self.SpeakerClassifier])
 					
 					# calculate acc
 					acc = self.cal_acc(logits, c)
-					info = {
-						f'{flag}/D_loss_clf': loss_clf.item(),
-						f'{flag}/D_acc': acc,
-					}
-					slot_value = (step, iteration + 1, hps.iters) + tuple([value for value in info.values()])
-					log = 'D-%d:[%06d/%06d], loss_clf=%.2f, acc=%.2f'
-					
-					print(log % slot_value, end='\r')
-					if iteration % 100 == 0:
-						for tag, value in info.items():
-							self.logger.scalar_summary(tag, value, iteration + 1)
+					metrics.add(f'{flag}/D_loss_clf', loss_clf)
+					metrics.add(f'{flag}/D_acc', acc)
 							
 				#==================train G==================#
 				data = next(self.data_loader)
 				c, x = self.permute_data(data)
+				self.timer.lap('data')
 				
 				# encode
 				enc_act, enc = self.encode_step(x)
@@ -442,80 +718,68 @@ class Trainer(object):
 				
 				# maximize classification loss
 				loss = loss_rec - current_alpha * loss_clf
-				reset_grad([self.Encoder, self.Decoder])
-				loss.backward()
-				grad_clip([self.Encoder, self.Decoder], hps.max_grad_norm)
-				self.ae_opt.step()
-				
-				info = {
-					f'{flag}/loss_rec': loss_rec.item(),
-					f'{flag}/G_loss_clf': loss_clf.item(),
-					f'{flag}/alpha': current_alpha,
-					f'{flag}/G_acc': acc,
-				}
-				slot_value = (iteration + 1, hps.iters) + tuple([value for value in info.values()])
-				log = 'G:[%06d/%06d], loss_rec=%.3f, loss_clf=%.2f, alpha=%.2e, acc=%.2f'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				self.update(loss, 'ae_opt', [self.Encoder, self.Decoder])
+				
+				metrics.add(f'{flag}/loss_rec', loss_rec)
+				metrics.add(f'{flag}/G_loss_clf', loss_clf)
+				metrics.add(f'{flag}/alpha', current_alpha)
+				metrics.add(f'{flag}/G_acc', acc)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 's1', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 
 		elif mode == 'patchGAN':
+			metrics = MetricCollector(self.logger, 'patchGAN', hps.patch_iters, hps.log_interval)
 			for iteration in range(hps.patch_iters):
+				self.profile_step(iteration, mode)
+				start_time = time.time()
 				#==================train D==================#
 				for step in range(hps.n_patch_steps):
 					
 					data_s = next(self.source_loader)
 					data_t = next(self.target_loader)
-					_, x_s = self.permute_data(data_s)
+					_, x_s, *enc_s = self.permute_data(data_s, load_enc=use_enc_cache)
 					c_t, x_t = self.permute_data(data_t)
+					self.timer.lap('data')
 					
 					# encode
-					enc_act, _ = self.encode_step(x_s)
+					enc_act = self.cached_encode_step(x_s, *enc_s)
 					
 					# generator
 					x_dec = self.gen_step(enc_act, c_t)
 					
-					# discriminstor
-					w_dis, real_logits, gp = self.patch_step(x_t, x_dec, is_dis=True)
+					# discriminstor, lazy regularization: the gradient penalty is computed every gp_interval steps and scaled up accordingly
+					compute_gp = (iteration * hps.n_patch_steps + step) % hps.gp_interval == 0
+					w_dis, real_logits, gp = self.patch_step(x_t, x_dec, is_dis=True, compute_gp=compute_gp)
 					
 					# aux classification loss 
 					loss_clf = self.cal_loss(real_logits, c_t, shift=True)
 					
-					loss = -hps.beta_dis * w_dis + hps.beta_clf * loss_clf + hps.lambda_ * gp
-					reset_grad([self.PatchDiscriminator])
-					loss.backward()
-					grad_clip([self.PatchDiscriminator], hps.max_grad_norm)
-					self.patch_opt.step()
+					loss = -hps.beta_dis * w_dis + hps.beta_clf * loss_clf
+					if compute_gp: loss = loss + hps.lambda_ * hps.gp_interval * gp
+					self.update(loss, 'patch_opt', [self.PatchDiscriminator])
 					
 					# calculate acc
 					acc = self.cal_acc(real_logits, c_t, shift=True)
-					info = {
-						f'{flag}/w_dis': w_dis.item(),
-						f'{flag}/gp': gp.item(), 
-						f'{flag}/real_loss_clf': loss_clf.item(),
-						f'{flag}/real_acc': acc, 
-					}
-					slot_value = (step, iteration+1, hps.patch_iters) + tuple([value for value in info.values()])
-					log = 'patch_D-%d:[%06d/%06d], w_dis=%.2f, gp=%.2f, loss_clf=%.2f, acc=%.2f'
-					print(log % slot_value, end='\r')
-					
-					if iteration % 100 == 0:
-						for tag, value in info.items():
-							self.logger.scalar_summary(tag, value, iteration + 1)
+					metrics.add(f'{flag}/w_dis', w_dis)
+					if compute_gp: metrics.add(f'{flag}/gp', gp)
+					metrics.add(f'{flag}/real_loss_clf', loss_clf)
+					metrics.add(f'{flag}/real_acc', acc)
 
 				#==================train G==================#
 				data_s = next(self.source_loader)
 				data_t = next(self.target_loader)
-				_, x_s = self.permute_data(data_s)
-				c_t, x_t = self.permute_data(data_t)
+				_, x_s, *enc_s = self.permute_data(data_s, load_enc=use_enc_cache)
+				c_t, x_t, *enc_t = self.permute_data(data_t, load_enc=use_enc_cache)
+				self.timer.lap('data')
 
 				# encode
-				enc_act, _ = self.encode_step(x_s)
+				enc_act = self.cached_encode_step(x_s, *enc_s)
 				
 				# generator
 				x_dec = self.gen_step(enc_act, c_t)
@@ -526,51 +790,46 @@ class Trainer(object):
 				# aux classification loss 
 				loss_clf = self.cal_loss(fake_logits, c_t, shift=True)
 				loss = hps.beta_clf * loss_clf + hps.beta_gen * loss_adv
-				reset_grad([self.Generator])
-				loss.backward()
-				grad_clip([self.Generator], hps.max_grad_norm)
-				self.gen_opt.step()
+				self.update(loss, 'gen_opt', [self.Generator])
 
 				if target_guided:
 					# teacher forcing
-					enc_tf, _ = self.encode_step(x_t)
+					enc_tf = self.cached_encode_step(x_t, *enc_t)
 					x_dec_tf = self.gen_step(enc_tf, c_t)
 					loss_rec = torch.mean(torch.abs(x_dec_tf - x_t))
-					reset_grad([self.Generator])
-					loss_rec.backward()
-					self.gen_opt.step()
+					self.update(loss_rec, 'gen_opt', [self.Generator], clip=False)
 				
 				# calculate acc
 				acc = self.cal_acc(fake_logits, c_t, shift=True)
-				info = {
-					f'{flag}/loss_adv': loss_adv.item(),
-					f'{flag}/fake_loss_clf': loss_clf.item(),
-					f'{flag}/fake_acc': acc, 
-					f'{flag}/tg_rec': loss_rec.item() if target_guided else 0.000, 
-				}
-				slot_value = (iteration+1, hps.patch_iters) + tuple([value for value in info.values()])
-				log = 'patch_G:[%06d/%06d], loss_adv=%.2f, loss_clf=%.2f, acc=%.2f, tg_rec=%.3f'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				metrics.add(f'{flag}/loss_adv', loss_adv)
+				metrics.add(f'{flag}/fake_loss_clf', loss_clf)
+				metrics.add(f'{flag}/fake_acc', acc)
+				if target_guided: metrics.add(f'{flag}/tg_rec', loss_rec)
+				metrics.add(f'{flag}/iter_time', time.time() - start_time)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 's2', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 		
 
 		elif mode == 'autolocker':
 			criterion = torch.nn.BCELoss()
+			metrics = MetricCollector(self.logger, 'autolocker', hps.patch_iters, hps.log_interval)
 			for iteration in range(hps.patch_iters):
+				self.profile_step(iteration, mode)
 				#==================train G==================#
 				data_s = next(self.source_loader)
 				data_t = next(self.target_loader)
-				_, x_s = self.permute_data(data_s)
-				c_t, x_t = self.permute_data(data_t)
+				_, x_s, *enc_s = self.permute_data(data_s, load_enc=use_enc_cache)
+				c_t, x_t, *enc_t = self.permute_data(data_t, load_enc=use_enc_cache)
+				self.timer.lap('data')
 
 				# encode
-				enc_act, _ = self.encode_step(x_s)
+				enc_act = self.cached_encode_step(x_s, *enc_s)
 				
 				# decode
 				residual_output = self.gen_step(enc_act, c_t)
@@ -580,41 +839,35 @@ class Trainer(object):
 				
 				# re-encode loss
 				loss_reenc = criterion(re_enc, enc_act.data)
-				reset_grad([self.Encoder, self.Decoder, self.Generator])
-				loss_reenc.backward()
-				grad_clip([self.Generator], hps.max_grad_norm)
-				self.gen_opt.step()
+				self.update(loss_reenc, 'gen_opt', [self.Generator], reset_list=[self.Encoder, self.Decoder, self.Generator])
 
 				if target_guided:
 					# teacher forcing
-					enc_tf, _ = self.encode_step(x_t)
+					enc_tf = self.cached_encode_step(x_t, *enc_t)
 					x_dec_tf = self.gen_step(enc_tf, c_t)
 					loss_rec = torch.mean(torch.abs(x_dec_tf - x_t))
-					reset_grad([self.Encoder, self.Decoder, self.Generator])
-					loss_rec.backward()
-					self.gen_opt.step()
+					self.update(loss_rec, 'gen_opt', [self.Generator], reset_list=[self.Encoder, self.Decoder, self.Generator], clip=False)
+				
+				# tb info
+				metrics.add(f'{flag}/re_enc', loss_reenc)
+				if target_guided: metrics.add(f'{flag}/tg_rec', loss_rec)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
 				
-				# calculate acc
-				info = {
-					f'{flag}/re_enc': loss_reenc.item(),
-					f'{flag}/tg_rec': loss_rec.item() if target_guided else 0.000, 
-				}
-				slot_value = (iteration+1, hps.patch_iters) + tuple([value for value in info.values()])
-				log = 'patch_G:[%06d/%06d], re_enc=%.3f, tg_rec=%.3f'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 's2', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 		
 		elif mode == 't_classify':
+			metrics = MetricCollector(self.logger, 'Target Classifier', hps.tclf_iters, hps.log_interval)
 			for iteration in range(hps.tclf_iters):
+				self.profile_step(iteration, mode)
 			#======train target classifier======#					
 				data = next(self.data_loader)
 				c, x = self.permute_data(data)
+				self.timer.lap('data')
 				c[c < 100] = 102
 
 				# classification
@@ -622,34 +875,29 @@ class Trainer(object):
 				
 				# classification loss 
 				loss = self.cal_loss(logits, c-self.shift_c)
-				reset_grad([self.TargetClassifier])
-				loss.backward()
-				grad_clip([self.TargetClassifier], hps.max_grad_norm)
-				self.tclf_opt.step()
+				self.update(loss, 'tclf_opt', [self.TargetClassifier])
 				
 				# calculate acc
 				acc = self.cal_acc(logits, c-self.shift_c)
-				info = {
-					f'{flag}/acc': acc,
-				}
-				slot_value = (iteration+1, hps.tclf_iters) + tuple([value for value in info.values()])
-				log = 'Target Classifier:[%05d/%05d], acc=%.2f'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				metrics.add(f'{flag}/acc', acc)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 'tclf', iteration + 1)
-			print()
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+			metrics.close()
 
 		elif mode == 'train_Tacotron':
 			
 			assert self.g_mode == 'tacotron'
 			criterion = TacotronLoss()
 			self.Encoder.eval()
+			metrics = MetricCollector(self.logger, 'train_Tacotron', hps.tacotron_iters, hps.log_interval)
 
 			for iteration in range(hps.tacotron_iters):
+				self.profile_step(iteration, mode)
 			#======train tacotron======#
 
 				cur_lr = learning_rate_decay(init_lr=0.002, global_step=iteration)
@@ -657,39 +905,98 @@ class Trainer(object):
 					param_group['lr'] = cur_lr
 
 				data = next(self.data_loader)
-				c, x, m = self.permute_data(data, load_mel=True)
+				c, x, m, *enc_cached = self.permute_data(data, load_mel=True, load_enc=use_enc_cache)
+				self.timer.lap('data')
 				
 				# encode
-				enc_act, enc = self.encode_step(x)
+				enc_act = self.cached_encode_step(x, *enc_cached)
 
 				# tacotron synthesis
 				m_dec, x_dec = self.tacotron_step(enc_act.data, m, c)
 				
 				# reconstruction loss 
 				loss_rec = criterion([m_dec, x_dec], [m, x])
-				reset_grad([self.Generator])
-				loss_rec.backward()
-				grad_clip([self.Generator], hps.max_grad_norm)
-				self.gen_opt.step()
+				self.update(loss_rec, 'gen_opt', [self.Generator])
 				
 				# tb info
-				info = {
-					f'{flag}/tacotron_loss_rec': loss_rec.item(),
-					f'{flag}/tacotron_lr': cur_lr,
-				}
-				slot_value = (iteration + 1, hps.tacotron_iters) + tuple([value for value in info.values()])
-				log = 'train_Tacotron:[%06d/%06d], loss_rec=%.3f, lr=%.2e'
-				print(log % slot_value, end='\r')
-				
-				if iteration % 100 == 0:
-					for tag, value in info.items():
-						self.logger.scalar_summary(tag, value, iteration + 1)
+				metrics.add(f'{flag}/tacotron_loss_rec', loss_rec)
+				metrics.add(f'{flag}/tacotron_lr', cur_lr)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+				
 				if (iteration + 1) % 1000 == 0:
 					self.save_model(model_path, 't', iteration + 1)
-			print()
+			metrics.close()
+
+		elif mode == 'distill':
+
+			assert self.student and self.teacher is not None, 'Distillation needs a student trainer and load_teacher()!'
+			self.Encoder.eval()
+			shift_c = int(hps.n_speakers - hps.n_target_speakers)
+			metrics = MetricCollector(self.logger, 'distill', hps.distill_iters, hps.log_interval)
+
+			for iteration in range(hps.distill_iters):
+				self.profile_step(iteration, mode)
+			#======distill decoder and generator======#
+				data = next(self.data_loader)
+				c, x = self.permute_data(data)
+				c_tar = torch.randint_like(c, shift_c, hps.n_speakers) # conversion targets
+				self.timer.lap('data')
+
+				# teacher outputs for the same codes
+				with torch.no_grad():
+					enc_act, _ = self.Encoder(x)
+					t_dec = self.generate_step(enc_act, c, enc_only=True, decoder=self.teacher['decoder'])
+					t_conv = self.generate_step(enc_act, c_tar, decoder=self.teacher['decoder'], generator=self.teacher['generator'])
+				s_dec = self.generate_step(enc_act, c, enc_only=True)
+				s_conv = self.generate_step(enc_act, c_tar)
+				loss_dec = torch.mean(torch.abs(s_dec - t_dec))
+				loss_conv = torch.mean(torch.abs(s_conv - t_conv))
+				self.update(loss_dec + loss_conv, 'distill_opt', [self.Decoder, self.Generator])
+
+				# tb info
+				metrics.add(f'{flag}/distill_loss_dec', loss_dec)
+				metrics.add(f'{flag}/distill_loss_conv', loss_conv)
+				self.timer.collect(metrics, flag)
+				metrics.step(iteration + 1)
+
+				if (iteration + 1) % 1000 == 0:
+					self.save_model(model_path, 'd', iteration + 1)
+				if self.valid_set is not None and hps.valid_interval > 0 and (iteration + 1) % hps.valid_interval == 0:
+					self.validate(flag, iteration + 1)
+					self.Encoder.eval() # the student is distilled against encodings without dropout
+			metrics.close()
 
 		else: 
 			raise NotImplementedError()
 
+		self.stop_profiler()
+		self.report_throughput(mode, time.time() - mode_start_time, target_guided)
+
+
+	def report_throughput(self, mode, elapsed, target_guided=False):
+		n_iters = {
+			'pretrain_AE' : self.hps.enc_pretrain_iters,
+			'pretrain_C' : self.hps.dis_pretrain_iters,
+			'train' : self.hps.iters,
+			'patchGAN' : self.hps.patch_iters,
+			'autolocker' : self.hps.patch_iters,
+			't_classify' : self.hps.tclf_iters,
+			'train_Tacotron' : self.hps.tacotron_iters,
+			'distill' : self.hps.distill_iters,
+		}[mode]
+		if self.rank != 0 or elapsed <= 0:
+			return
+		throughput = n_iters * self.hps.batch_size * self.world_size / elapsed
+		print('[Trainer] - {}: {:.2f} iters/sec, {:.1f} samples/sec over {} process(es)'.format(mode, n_iters / elapsed, throughput, self.world_size))
+		if self.world_size > 1:
+			print('[Trainer] - {}: all-reduce time share: {:.1%}'.format(mode, self.comm_time / elapsed))
+			benchmark_mode = mode + '_tgat' if mode == 'patchGAN' and target_guided else mode
+			if benchmark_mode in self.single_proc_throughput:
+				# against world_size times the samples/sec of one process on the same shapes, so stragglers, loader imbalance and sharding count too
+				single = self.single_proc_throughput[benchmark_mode]
+				print('[Trainer] - {}: scaling efficiency: {:.1%} ({:.1f} samples/sec against {} x {:.1f} of one process)'.format(
+					  mode, throughput / (self.world_size * single), throughput, self.world_size, single))
+
 
 
@@ -10,10 +10,16 @@
 ###############
 # IMPORTATION #
 ###############
+import json
+import time
+import queue
 import torch
+import threading
 import numpy as np
 import torch.nn as nn
+import torch.distributed as dist
 from torch.autograd import Variable
+from collections import OrderedDict
 from tensorboardX import SummaryWriter
 
 
@@ -55,6 +61,109 @@ def grad_clip(net_list, max_grad_norm):
 		nn.utils.clip_grad_norm_(net.parameters(), max_grad_norm)
 
 
+def get_rank():
+	return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+	return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def broadcast_params(net):
+	# start every process from the same weights as the first one
+	for tensor in list(net.parameters()) + list(net.buffers()):
+		dist.broadcast(tensor.data, src=0)
+
+
+def all_reduce_grad(net_list):
+	# average gradients over processes with one flattened all-reduce
+	grads = [p.grad for net in net_list for p in net.parameters() if p.grad is not None]
+	if len(grads) == 0:
+		return
+	flat = torch.cat([g.contiguous().view(-1) for g in grads])
+	dist.all_reduce(flat)
+	flat /= dist.get_world_size()
+	offset = 0
+	for g in grads:
+		g.copy_(flat[offset:offset + g.numel()].view_as(g))
+		offset += g.numel()
+
+
+def load_benchmark_results(results_path):
+	# the rows of a <output>.json written by benchmark.py
+	with open(results_path, 'r') as f:
+		return json.load(f)
+
+
+def single_process_throughput(results_path, batch_size, seg_len, enc_mode, threads):
+	# {benchmark mode : samples/sec} of the benchmark.py results run with this batch size, segment length, encoder mode and threads
+	return {r['mode'] : r['samples_per_sec'] for r in load_benchmark_results(results_path) \
+			if (r['batch_size'], r['seg_len'], r['enc_mode'], r['threads']) == (batch_size, seg_len, enc_mode, threads)}
+
+
+CKPT_MAGIC = b'VCCKPT01'
+CKPT_ALIGN = 64
+
+
+def is_sectioned_checkpoint(path):
+	with open(path, 'rb') as f:
+		return f.read(len(CKPT_MAGIC)) == CKPT_MAGIC
+
+
+def save_sectioned_checkpoint(path, sections, fp16=False):
+	"""
+		Write {section: state_dict} as a json header followed by raw, aligned tensor blobs,
+		so that every network can be memory-mapped and read on its own.
+		With fp16=True floating point tensors are stored in half precision.
+	"""
+	header, blobs, offset = {}, [], 0
+	for name, state_dict in sections.items():
+		header[name] = OrderedDict()
+		for key, tensor in state_dict.items():
+			array = tensor.detach().cpu().numpy()
+			if fp16 and array.dtype in (np.float32, np.float64):
+				array = array.astype(np.float16)
+			array = np.asarray(array, order='C')
+			header[name][key] = {'dtype' : array.dtype.str, 'shape' : list(array.shape), 'offset' : offset}
+			blobs.append((offset, array))
+			offset += -(-array.nbytes // CKPT_ALIGN) * CKPT_ALIGN
+	header = json.dumps(header).encode('utf-8')
+	data_start = -(-(len(CKPT_MAGIC) + 8 + len(header)) // CKPT_ALIGN) * CKPT_ALIGN
+	with open(path, 'wb') as f:
+		f.write(CKPT_MAGIC)
+		f.write(np.uint64(len(header)).tobytes())
+		f.write(header)
+		for blob_offset, array in blobs:
+			f.seek(data_start + blob_offset)
+			f.write(array.tobytes())
+		f.truncate(data_start + offset)
+
+
+def load_sectioned_checkpoint(path, sections=None):
+	"""
+		Return {section: state_dict} for the requested sections only (all if None),
+		tensors are copy-on-write views of the memory-mapped file and are read from disk on first use.
+	"""
+	with open(path, 'rb') as f:
+		assert f.read(len(CKPT_MAGIC)) == CKPT_MAGIC, 'Not a sectioned checkpoint: {}'.format(path)
+		header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+		header = json.loads(f.read(header_len).decode('utf-8'), object_pairs_hook=OrderedDict)
+	data_start = -(-(len(CKPT_MAGIC) + 8 + header_len) // CKPT_ALIGN) * CKPT_ALIGN
+	states = {}
+	for name, entries in header.items():
+		if sections is not None and name not in sections:
+			continue
+		states[name] = OrderedDict()
+		for key, entry in entries.items():
+			shape = tuple(entry['shape'])
+			if int(np.prod(shape)) == 0:
+				array = np.zeros(shape, dtype=np.dtype(entry['dtype']))
+			else:
+				array = np.memmap(path, dtype=np.dtype(entry['dtype']), mode='c', offset=data_start + entry['offset'], shape=(int(np.prod(shape)),)).reshape(shape)
+			states[name][key] = torch.from_numpy(array)
+	return states
+
+
 def calculate_gradients_penalty(netD, real_data, fake_data):
 	alpha = torch.rand(real_data.size(0))
 	alpha = alpha.view(real_data.size(0), 1, 1)
@@ -84,3 +193,98 @@ class Logger(object):
 	def scalar_summary(self, tag, value, step):
 		self.writer.add_scalar(tag, value, step)
 
+
+class MetricCollector(object):
+	"""
+		Buffers training metrics as detached tensors and reduces them every `interval` steps.
+		Only the reduction synchronizes with the device; the mean / min / max of each window
+		are formatted, printed and written to tensorboard by a background thread.
+	"""
+	def __init__(self, logger, name, total, interval=100):
+		self.logger = logger
+		self.enabled = logger is not None # disabled on all but the first process
+		self.name = name
+		self.total = total
+		self.interval = interval
+		self.buffers = OrderedDict()
+		self.last_step = 0
+		self.queue = queue.Queue()
+		self.thread = threading.Thread(target=self._writer, daemon=True)
+		if self.enabled: self.thread.start()
+
+	def add(self, tag, value):
+		if not self.enabled:
+			return
+		if torch.is_tensor(value):
+			value = value.detach()
+		self.buffers.setdefault(tag, []).append(value)
+
+	def step(self, step):
+		self.last_step = step
+		if step % self.interval == 0:
+			self.flush(step)
+
+	def flush(self, step):
+		if len(self.buffers) == 0:
+			return
+		reduced = OrderedDict()
+		for tag, values in self.buffers.items():
+			values = torch.stack(values).float() if torch.is_tensor(values[0]) else torch.tensor(values, dtype=torch.float32)
+			reduced[tag] = torch.stack([values.mean(), values.min(), values.max()]).cpu()
+		self.buffers = OrderedDict()
+		self.queue.put((step, reduced))
+
+	def close(self):
+		if not self.enabled:
+			return
+		self.flush(self.last_step)
+		self.queue.put(None)
+		self.thread.join()
+		print()
+
+	def _writer(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			step, reduced = item
+			log = '{}:[{:06d}/{:06d}]'.format(self.name, step, self.total)
+			for tag, (mean, min_, max_) in reduced.items():
+				self.logger.scalar_summary(tag, mean.item(), step)
+				self.logger.scalar_summary(tag + '/min', min_.item(), step)
+				self.logger.scalar_summary(tag + '/max', max_.item(), step)
+				log += ', {}={:.3f}'.format(tag.split('/')[-1], mean.item())
+			print(log, end='\r')
+
+
+class PhaseTimer(object):
+	"""
+		Lap timer for the training loop: the wall time between two consecutive laps is attributed
+		to the phase named by the later lap and summed over one iteration.
+		Disabled by default, since timing GPU work requires a device synchronization per lap.
+	"""
+	def __init__(self, enabled=False):
+		self.enabled = enabled
+		self.times = OrderedDict()
+		self.last = None
+
+	def start(self):
+		if self.enabled:
+			self.last = self._now()
+
+	def lap(self, phase):
+		if not self.enabled:
+			return
+		now = self._now()
+		self.times[phase] = self.times.get(phase, 0.) + now - self.last
+		self.last = now
+
+	def collect(self, metrics, prefix):
+		for phase, elapsed in self.times.items():
+			metrics.add('{}/time_{}'.format(prefix, phase), elapsed)
+		self.times = OrderedDict()
+
+	def _now(self):
+		if torch.cuda.is_available():
+			torch.cuda.synchronize()
+		return time.time()